@@ -90,6 +90,7 @@ module kb_kaiju {
 	==========================
 	kaiju2krona -t nodes.dmp -n names.dmp -i kaiju.out -o kaiju.out.krona
 	ktImportText -o kaiju.out.html kaiju.out.krona
+	ktImportText -o krona.html sample1.krona,sample1 sample2.krona,sample2   (combined_krona)
 
     */
 
@@ -101,6 +102,7 @@ module kb_kaiju {
 	workspace_name workspace_name;
 	data_obj_ref   input_refs;
 	list<string>   tax_levels;
+	data_obj_name  output_biom_name;  /* Communities.Biom objects are saved as <output_biom_name>-<tax_level> (default kaiju_abundance.BIOM) */
 
 	string         db_type;
 	float          filter_percent;
@@ -116,6 +118,8 @@ module kb_kaiju {
 	/*bool           filter_unclassified;*/  /* always filter unclassified */
 	/*bool           full_tax_path;*/  /* will implement later */
 	string         sort_taxa_by;
+	bool           combined_krona;  /* one Krona chart with every sample as a dataset, instead of one per sample (default 0) */
+	bool           resume;  /* reuse completed stages of an interrupted run with the same params (default 0) */
     } KaijuInputParams;
 
 
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import errno
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+MB = 1024*1024
+
+# linux/fs.h _IOW(0x94, 9, int): share the extents of another file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+LINK_MODES = ['auto', 'hardlink', 'reflink', 'copy']
+
+# where a link can't be made and a copy will do
+HARDLINK_FALLBACK_ERRNOS = [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP]
+REFLINK_FALLBACK_ERRNOS  = [errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP,
+                            errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.ENOSYS]
+
+
+def reflink(src_path, dst_path):
+    '''
+    Make dst_path a copy-on-write clone of src_path.  Raises OSError (or
+    IOError) where the filesystem can't clone.
+    '''
+    if fcntl is None:
+        raise OSError (errno.ENOSYS, 'no reflinks on this platform')
+    with open(src_path, 'rb') as src_handle:
+        with open(dst_path, 'wb') as dst_handle:
+            try:
+                fcntl.ioctl(dst_handle.fileno(), FICLONE, src_handle.fileno())
+            except (IOError, OSError):
+                dst_handle.close()
+                os.remove(dst_path)
+                raise
+    shutil.copystat(src_path, dst_path)
+
+
+class ArtifactManager(object):
+    '''
+    Places each artifact (plot, page asset) once on scratch and exposes it
+    in the other package trees (e.g. output_<suffix> and html_<suffix>)
+    without copying its data.  link_mode is one of:
+        hardlink - a second name for the same file
+        reflink  - a copy-on-write clone, a file of its own sharing the data
+        auto     - hardlink, else reflink
+        copy     - always copy
+    Anything that can't be linked (e.g. across filesystems) is copied.
+
+    Files are shared, so they must be replaced rather than rewritten in
+    place: write a new file and rename it over the old one, as
+    OutputBuilder.insert_top_nav does.
+    '''
+
+    def __init__(self, link_mode='auto'):
+        if link_mode not in LINK_MODES:
+            raise ValueError ('bad artifact-link-mode: '+str(link_mode)+' (must be one of "'+'", "'.join(LINK_MODES)+'")')
+        self.link_mode = link_mode
+        self.placed = dict()  # method -> [count, bytes]
+        self.lock = threading.Lock()
+
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        From deploy.cfg artifact-link-mode
+        '''
+        return cls(link_mode=config.get('artifact-link-mode') or 'auto')
+
+
+    def _get_methods(self):
+        if self.link_mode == 'auto':
+            return ['hardlink', 'reflink', 'copy']
+        if self.link_mode == 'copy':
+            return ['copy']
+        return [self.link_mode, 'copy']
+
+
+    def expose(self, src_path, dst_path):
+        '''
+        Make the artifact at src_path also available at dst_path, replacing
+        what's there.  Returns dst_path.
+        '''
+        if os.path.exists(dst_path):
+            if os.path.samefile(src_path, dst_path):
+                return dst_path
+            os.remove(dst_path)
+
+        for method in self._get_methods():
+            try:
+                if method == 'hardlink':
+                    os.link(src_path, dst_path)
+                elif method == 'reflink':
+                    reflink(src_path, dst_path)
+                else:
+                    shutil.copy2(src_path, dst_path)
+            except (IOError, OSError) as e:
+                if method == 'hardlink' and e.errno in HARDLINK_FALLBACK_ERRNOS:
+                    continue
+                if method == 'reflink' and e.errno in REFLINK_FALLBACK_ERRNOS:
+                    continue
+                raise
+            self._count(method, os.path.getsize(dst_path))
+            return dst_path
+
+
+    def unshare(self, path):
+        '''
+        Remove path if it's hard linked elsewhere, so rewriting it (e.g. a
+        plot redrawn on resume) leaves the other names alone
+        '''
+        if os.path.exists(path) and os.stat(path).st_nlink > 1:
+            os.remove(path)
+        return path
+
+
+    def _count(self, method, size):
+        with self.lock:
+            if method not in self.placed:
+                self.placed[method] = [0, 0]
+            self.placed[method][0] += 1
+            self.placed[method][1] += size
+
+
+    def get_placed(self):
+        '''
+        Artifacts exposed so far, as method -> (count, bytes)
+        '''
+        with self.lock:
+            return dict([(method, tuple(placed)) for (method, placed) in self.placed.items()])
+
+
+    def get_usage(self, folder_paths):
+        '''
+        Bytes under folder_paths as (apparent, on disk), where a file hard
+        linked into several of them (or twice into one) counts once on disk.
+        Reflinked files share extents the filesystem doesn't report, so they
+        count in full.
+        '''
+        apparent = 0
+        inodes = dict()
+        for folder_path in folder_paths:
+            for (dir_path, dir_names, file_names) in os.walk(folder_path):
+                for file_name in file_names:
+                    file_stat = os.lstat(os.path.join(dir_path, file_name))
+                    apparent += file_stat.st_size
+                    inodes[(file_stat.st_dev, file_stat.st_ino)] = file_stat.st_size
+        return (apparent, sum(inodes.values()))
+
+
+    def log_usage(self, folder_paths):
+        (apparent, on_disk) = self.get_usage(folder_paths)
+        placed = self.get_placed()
+        log('packaging '+str(apparent // MB)+' MB of outputs and report, '+str(on_disk // MB)+' MB on scratch ('
+            +', '.join([method+' '+str(placed[method][0]) for method in sorted(placed.keys())] or ['nothing shared'])+')')
+        return (apparent, on_disk)
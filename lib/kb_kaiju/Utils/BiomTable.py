@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import numpy as np
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+TEXT_TYPE = type(u'')
+
+
+def _to_text(val):
+    if isinstance(val, TEXT_TYPE):
+        return val
+    return val.decode('utf-8')
+
+
+class BiomTable(object):
+    '''
+    Sparse taxon (row) by sample (column) count table, accumulated in COO
+    form: one array each of row indices, column indices and values per
+    sample.  Only the nonzero counts are ever touched, so building the
+    table is O(nnz) rather than O(rows * samples).
+
+    Rows are numbered in order of first appearance across samples.
+    '''
+
+    def __init__(self):
+        self.row_ids = []
+        self.row_index = dict()
+        self.col_ids = []
+        self.coo_rows = []
+        self.coo_cols = []
+        self.coo_vals = []
+
+
+    def add_sample(self, sample_name, abundance_cnts, lineage_order=None):
+        '''
+        abundance_cnts maps lineage name to count.  lineage_order, if given,
+        sets the order in which new lineage names get row indices.
+        '''
+        if lineage_order is None:
+            lineage_order = list(abundance_cnts.keys())
+        col_i = len(self.col_ids)
+        self.col_ids.append(sample_name)
+
+        row_index = self.row_index
+        row_ids = self.row_ids
+        for lineage_name in lineage_order:
+            if lineage_name not in row_index:
+                row_index[lineage_name] = len(row_ids)
+                row_ids.append(lineage_name)
+
+        n = len(lineage_order)
+        self.coo_rows.append(np.fromiter((row_index[name] for name in lineage_order), dtype=np.int64, count=n))
+        self.coo_cols.append(np.full(n, col_i, dtype=np.int64))
+        self.coo_vals.append(np.fromiter((abundance_cnts[name] for name in lineage_order), dtype=np.int64, count=n))
+
+
+    @property
+    def shape(self):
+        return [len(self.row_ids), len(self.col_ids)]
+
+
+    def to_coo(self):
+        '''
+        (rows, cols, vals) arrays of the nonzero entries, ordered by row
+        then column
+        '''
+        if len(self.coo_rows) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return (empty, empty, empty)
+        rows = np.concatenate(self.coo_rows)
+        cols = np.concatenate(self.coo_cols)
+        vals = np.concatenate(self.coo_vals)
+        keep = (vals != 0)
+        (rows, cols, vals) = (rows[keep], cols[keep], vals[keep])
+        order = np.lexsort((cols, rows))
+        return (rows[order], cols[order], vals[order])
+
+
+    def to_biom1_0_data(self):
+        '''
+        [row, col, value] triples for a biom-1.0 sparse 'data' field
+        '''
+        (rows, cols, vals) = self.to_coo()
+        return np.column_stack((rows, cols, vals)).tolist()
+
+
+    def write_biom2_hdf5(self, out_file, table_id, table_type='Taxon table', generated_by='', timestamp_iso=''):
+        '''
+        Write the table as BIOM 2.1 HDF5, with the matrix stored both by
+        observation (CSR) and by sample (CSC) as the format requires
+        '''
+        import h5py  # only needed for BIOM 2.1 output, so not at module load
+
+        (rows, cols, vals) = self.to_coo()
+        (n_rows, n_cols) = self.shape
+        text_dtype = h5py.special_dtype(vlen=TEXT_TYPE)
+
+        tmp_file = out_file+'.tmp'
+        with h5py.File(tmp_file, 'w') as h5_handle:
+            h5_handle.attrs['id'] = _to_text(table_id)
+            h5_handle.attrs['type'] = _to_text(table_type)
+            h5_handle.attrs['format-url'] = u'http://biom-format.org'
+            h5_handle.attrs['format-version'] = np.array([2, 1], dtype=np.int32)
+            h5_handle.attrs['generated-by'] = _to_text(generated_by)
+            h5_handle.attrs['creation-date'] = _to_text(timestamp_iso)
+            h5_handle.attrs['shape'] = np.array([n_rows, n_cols], dtype=np.int32)
+            h5_handle.attrs['nnz'] = len(vals)
+
+            # observation axis: CSR over rows (already row-major from to_coo())
+            self._write_axis(h5_handle, 'observation', self.row_ids, n_rows, rows, cols, vals, text_dtype)
+
+            # sample axis: CSC, so reorder column-major
+            order = np.lexsort((rows, cols))
+            self._write_axis(h5_handle, 'sample', self.col_ids, n_cols, cols[order], rows[order], vals[order], text_dtype)
+        os.rename(tmp_file, out_file)
+        log('wrote BIOM 2.1 table '+out_file)
+        return out_file
+
+
+    def _write_axis(self, h5_handle, axis, ids, n, major, minor, vals, text_dtype):
+        grp = h5_handle.create_group(axis)
+        grp.create_dataset('ids', data=[_to_text(axis_id) for axis_id in ids], dtype=text_dtype)
+        grp.create_group('metadata')
+        grp.create_group('group-metadata')
+        indptr = np.zeros(n+1, dtype=np.int32)
+        np.cumsum(np.bincount(major, minlength=n), out=indptr[1:])
+        matrix_grp = grp.create_group('matrix')
+        matrix_grp.create_dataset('data', data=vals.astype(np.float64))
+        matrix_grp.create_dataset('indices', data=minor.astype(np.int32))
+        matrix_grp.create_dataset('indptr', data=indptr)
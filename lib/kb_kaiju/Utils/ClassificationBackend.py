@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import json
+import uuid
+import socket
+import threading
+from multiprocessing.pool import ThreadPool
+
+from kb_kaiju.Utils.ResourceGovernor import ResourceGovernor, get_resource_governor
+from kb_kaiju.Utils.ToolRunner import ToolRunner
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+def run_classification_task(task, cwd=None, governor=None, tool_runner=None):
+    '''
+    Run a single classification task (a kaiju command line) to completion and
+    remove its input files on success.  Returns the exit code, or -1 if it
+    timed out, was cancelled or couldn't start.
+
+    task is a dict of the form:
+        {'name':          <replicate name>,
+         'command':       [<kaiju bin>, <arg>, ...],
+         'log_file':      <path for stdout/stderr, or None for this process's stdout>,
+         'cleanup_files': [<input file to remove after success>, ...],
+         'ram':           <estimated bytes of RAM kaiju needs>,
+         'cpus':          <kaiju threads>,
+         'timeout':       <seconds before kaiju is killed, 0 or None for never>
+        }
+
+    kaiju runs on tool_runner (a job's runner, so cancelling the job kills
+    it), or a runner of its own with governor.  Either way the task first
+    waits until its ram and cpus fit.
+    '''
+    if tool_runner is None:
+        tool_runner = ToolRunner(cwd=cwd, governor=governor)
+    tool_task = tool_runner.start(task['command'],
+                                  log_file=task.get('log_file'),
+                                  timeout=(task.get('timeout') or 0),
+                                  ram=task.get('ram', 0),
+                                  cpus=task.get('cpus', 1),
+                                  name='kaiju '+str(task['name']))
+    try:
+        tool_runner.wait([tool_task])
+    except ValueError as e:
+        log('classification task '+str(task['name'])+' failed: '+str(e))
+        return tool_task.exit_code if tool_task.exit_code else -1
+
+    # remove input files to free up disk
+    for cleanup_file in task.get('cleanup_files', []):
+        if os.path.exists(cleanup_file):
+            os.remove(cleanup_file)
+    return tool_task.exit_code
+
+
+def get_classification_backend(config, scratch, tool_runner=None):
+    '''
+    Build the classification backend selected in deploy.cfg.  Defaults to a
+    single local worker, which matches running kaiju one library at a time.
+    kaiju runs on tool_runner, where given, when classified in this process.
+    '''
+    backend_type = config.get('classification-backend') or 'local'
+    workers = int(config.get('classification-workers') or 1)
+    governor = get_resource_governor(config)
+
+    if backend_type == 'local':
+        return LocalProcessPoolBackend(workers=workers, cwd=scratch, governor=governor, tool_runner=tool_runner)
+    elif backend_type == 'queue':
+        queue_dir = config.get('classification-queue-dir')
+        if not queue_dir:
+            raise ValueError("classification-backend 'queue' requires classification-queue-dir to be set")
+        return SharedQueueBackend(queue_dir, local_workers=workers, cwd=scratch, governor=governor, tool_runner=tool_runner)
+    else:
+        raise ValueError("bad classification-backend: '"+str(backend_type)+"' (must be one of 'local', 'queue')")
+
+
+class LocalProcessPoolBackend(object):
+    '''
+    Runs classification tasks as child processes of this container, at most
+    `workers` at a time, and fewer if the governor says they won't fit in
+    memory.  submit() returns immediately so staging of the next library can
+    overlap classification of the previous one.
+    '''
+
+    def __init__(self, workers=1, cwd=None, governor=None, tool_runner=None):
+        self.workers = max(1, int(workers))
+        self.cwd = cwd
+        self.governor = governor
+        self.tool_runner = tool_runner
+        self.pool = None
+        self.pending = []
+
+    def submit(self, task, callback=None):
+        '''
+        callback(task) is called as soon as the task finishes successfully.
+        '''
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+
+        def on_finish(exitCode):
+            if exitCode == 0 and callback is not None:
+                try:
+                    callback(task)
+                except Exception as e:
+                    log('callback for classification task '+str(task['name'])+' failed: '+str(e))
+
+        self.pending.append((task, self.pool.apply_async(run_classification_task, (task, self.cwd, self.governor, self.tool_runner),
+                                                         callback=on_finish)))
+
+    def wait(self):
+        failed = []
+        try:
+            for (task, result) in self.pending:
+                exitCode = result.get()
+                if exitCode != 0:
+                    failed.append('Error running command: ' + ' '.join(task['command']) + '\n' +
+                                  'Exit Code: ' + str(exitCode))
+        finally:
+            self.pending = []
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        if len(failed) > 0:
+            raise ValueError("\n".join(failed))
+
+
+class SharedQueueBackend(object):
+    '''
+    Directory-backed work queue on shared scratch.  Tasks are JSON files that
+    move between pending/, claimed/, done/ and failed/ by atomic rename, so any
+    number of worker containers mounting the same queue_dir (see
+    run_queue_worker) can consume them.  The submitting job also works the
+    queue with `local_workers` threads while it waits, so a run never stalls
+    when no external worker is attached.
+
+    All paths in a task (reads, DB, output folder) must be visible at the same
+    location on every node.
+    '''
+
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    DONE    = 'done'
+    FAILED  = 'failed'
+
+    def __init__(self, queue_dir, local_workers=1, cwd=None, poll_interval=5, stale_claim_secs=600, governor=None,
+                 tool_runner=None):
+        self.queue_dir = queue_dir
+        self.local_workers = max(0, int(local_workers))
+        self.cwd = cwd
+        self.governor = governor
+        self.tool_runner = tool_runner
+        self.poll_interval = poll_interval
+        self.stale_claim_secs = stale_claim_secs
+        self.remaining = dict()
+        self.failed = []
+        for state in [self.PENDING, self.CLAIMED, self.DONE, self.FAILED]:
+            state_dir = os.path.join(self.queue_dir, state)
+            if not os.path.exists(state_dir):
+                os.makedirs(state_dir)
+
+    def _state_path(self, state, task_file):
+        return os.path.join(self.queue_dir, state, task_file)
+
+    def submit(self, task, callback=None):
+        '''
+        callback(task) is called from submit() or wait() once the task is seen
+        to have finished successfully.
+        '''
+        task = dict(task)
+        task['id'] = str(uuid.uuid4())
+        task['cwd'] = self.cwd
+        task_file = task['id']+'.json'
+
+        # write then rename so workers never see a partial task
+        tmp_path = os.path.join(self.queue_dir, '.'+task_file+'.tmp')
+        with open(tmp_path, 'w') as task_handle:
+            json.dump(task, task_handle)
+        os.rename(tmp_path, self._state_path(self.PENDING, task_file))
+        self.remaining[task_file] = (task, callback)
+        self._collect_finished()
+
+    def _collect_finished(self):
+        for task_file in list(self.remaining.keys()):
+            (task, callback) = self.remaining[task_file]
+            if os.path.exists(self._state_path(self.DONE, task_file)):
+                del self.remaining[task_file]
+                if callback is not None:
+                    try:
+                        callback(task)
+                    except Exception as e:
+                        log('callback for classification task '+str(task['name'])+' failed: '+str(e))
+            elif os.path.exists(self._state_path(self.FAILED, task_file)):
+                with open(self._state_path(self.FAILED, task_file), 'r') as task_handle:
+                    result = json.load(task_handle)
+                self.failed.append('Error running command: ' + ' '.join(result['command']) + '\n' +
+                                   'Exit Code: ' + str(result.get('exit_code')) +
+                                   ' (worker: ' + str(result.get('worker')) + ')')
+                del self.remaining[task_file]
+
+    def wait(self):
+        # local workers only take this job's tasks; other jobs sharing the
+        # queue are left to their own workers and to external ones
+        stop_event = threading.Event()
+        local_threads = []
+        for worker_i in range(self.local_workers):
+            t = threading.Thread(target=run_queue_worker,
+                                 args=(self.queue_dir,),
+                                 kwargs={'stop_event': stop_event, 'poll_interval': 1, 'governor': self.governor,
+                                         'task_files': self.remaining, 'tool_runner': self.tool_runner})
+            t.daemon = True
+            t.start()
+            local_threads.append(t)
+
+        try:
+            self._collect_finished()
+            while len(self.remaining) > 0:
+                self._requeue_stale_claims(self.remaining)
+                time.sleep(self.poll_interval)
+                self._collect_finished()
+        finally:
+            stop_event.set()
+            for t in local_threads:
+                t.join()
+
+        failed = self.failed
+        self.remaining = dict()
+        self.failed = []
+        if len(failed) > 0:
+            raise ValueError("\n".join(failed))
+
+    def _requeue_stale_claims(self, remaining):
+        '''
+        A worker that dies mid-task leaves its claim behind.  Claims are
+        heartbeated by touching the file, so an old mtime means a dead worker.
+        '''
+        now = time.time()
+        for task_file in remaining.keys():
+            claimed_path = self._state_path(self.CLAIMED, task_file)
+            try:
+                if now - os.path.getmtime(claimed_path) > self.stale_claim_secs:
+                    log('requeueing stale classification task '+task_file)
+                    os.rename(claimed_path, self._state_path(self.PENDING, task_file))
+            except OSError:
+                pass
+
+
+def _claim_next_task(queue_dir, task_files=None):
+    pending_dir = os.path.join(queue_dir, SharedQueueBackend.PENDING)
+    for task_file in sorted(os.listdir(pending_dir)):
+        if not task_file.endswith('.json'):
+            continue
+        if task_files is not None and task_file not in task_files:
+            continue
+        claimed_path = os.path.join(queue_dir, SharedQueueBackend.CLAIMED, task_file)
+        try:
+            os.rename(os.path.join(pending_dir, task_file), claimed_path)
+        except OSError:
+            continue  # another worker got it first
+        return (task_file, claimed_path)
+    return (None, None)
+
+
+def run_queue_worker(queue_dir, stop_event=None, poll_interval=10, exit_when_empty=False, heartbeat_secs=60, governor=None,
+                     task_files=None, tool_runner=None):
+    '''
+    Consume classification tasks from a SharedQueueBackend queue_dir until
+    stop_event is set (or the queue is empty, if exit_when_empty).  Tasks
+    are admitted through governor, if given.  With task_files (a container
+    of task file names, checked at each claim), only those tasks are taken.
+    A submitting job's own workers run kaiju on its tool_runner.
+    '''
+    worker_name = socket.gethostname()+':'+str(os.getpid())
+    while stop_event is None or not stop_event.is_set():
+        (task_file, claimed_path) = _claim_next_task(queue_dir, task_files=task_files)
+        if task_file is None:
+            if exit_when_empty:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        with open(claimed_path, 'r') as task_handle:
+            task = json.load(task_handle)
+
+        # heartbeat the claim so the submitter doesn't requeue a live task
+        task_done = threading.Event()
+
+        def heartbeat():
+            while not task_done.wait(heartbeat_secs):
+                try:
+                    os.utime(claimed_path, None)
+                except OSError:
+                    return
+        heartbeat_thread = threading.Thread(target=heartbeat)
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+        try:
+            exitCode = run_classification_task(task, cwd=task.get('cwd'), governor=governor, tool_runner=tool_runner)
+        except Exception as e:
+            log('classification task '+task_file+' failed: '+str(e))
+            exitCode = -1
+        finally:
+            task_done.set()
+
+        task['exit_code'] = exitCode
+        task['worker'] = worker_name
+        final_state = SharedQueueBackend.DONE if exitCode == 0 else SharedQueueBackend.FAILED
+        with open(claimed_path, 'w') as task_handle:
+            json.dump(task, task_handle)
+        os.rename(claimed_path, os.path.join(queue_dir, final_state, task_file))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('usage: ClassificationBackend.py <classification-queue-dir>')
+        sys.exit(1)
+    run_queue_worker(sys.argv[1], governor=ResourceGovernor.from_config(dict()))
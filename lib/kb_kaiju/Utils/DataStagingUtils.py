@@ -10,6 +10,8 @@ from Workspace.WorkspaceClient import Workspace
 from ReadsUtils.ReadsUtilsClient import ReadsUtils
 from SetAPI.SetAPIServiceClient import SetAPI
 
+from kb_kaiju.Utils.ReadsSubsampler import ReadsSubsampler
+
 
 class DataStagingUtils(object):
 
@@ -245,6 +247,14 @@ class DataStagingUtils(object):
                                   subsample_replicates=1,
                                   subsample_seed=1):
 
+        # single synchronized pass with ordinal-indexed membership when mates are in the same order
+        replicate_files = ReadsSubsampler(subsample_percent    = subsample_percent,
+                                          subsample_replicates = subsample_replicates,
+                                          subsample_seed       = subsample_seed).subsample(input_item)
+        if replicate_files is not None:
+            return replicate_files
+
+        # otherwise pair mates by read id
         replicate_files = []
         split_num = subsample_replicates
 
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+IMAGE_FORMATS = ['auto', 'png', 'webp', 'svg']
+
+
+class ImageOutputPolicy(object):
+    '''
+    How report plots are written.  image_format is one of:
+        png  - PNG, quantized to a palette of image_colors colors (if PIL is
+               installed and image_colors > 0) and optimized
+        webp - lossless WebP, falling back to png where PIL has no WebP support
+        svg  - SVG, sharp at any zoom, but text is drawn as paths so it's
+               only compact for plots of few shapes
+        auto - svg for plots of up to svg_max_elements drawn shapes, else png
+    Quantizing roughly halves a stacked plot PNG, and lossless WebP takes a
+    further third off.
+    '''
+
+    def __init__(self, image_format='png', image_colors=256, svg_max_elements=2000, dpi=200):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError ('bad report-image-format: '+str(image_format)+' (must be one of "'+'", "'.join(IMAGE_FORMATS)+'")')
+        self.image_format = image_format
+        self.image_colors = int(image_colors)
+        self.svg_max_elements = int(svg_max_elements)
+        self.dpi = dpi
+        if Image is None and image_format in ['png', 'webp', 'auto'] and (self.image_colors > 0 or image_format == 'webp'):
+            log('PIL is not installed, report plots are written as plain PNG')
+
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        From deploy.cfg report-image-format, report-image-colors and
+        report-image-svg-max-elements
+        '''
+        image_colors = config.get('report-image-colors')
+        return cls(image_format=config.get('report-image-format') or 'png',
+                   image_colors=(image_colors if image_colors not in [None, ''] else 256),
+                   svg_max_elements=config.get('report-image-svg-max-elements') or 2000)
+
+
+    def get_format(self, num_elements):
+        if self.image_format == 'auto':
+            if num_elements <= self.svg_max_elements:
+                return 'svg'
+            return 'png'
+        return self.image_format
+
+
+    def save_figure(self, fig, out_file_basename, num_elements):
+        '''
+        Write fig as out_file_basename.<format> for num_elements drawn shapes.
+        Returns the file written.
+        '''
+        image_format = self.get_format(num_elements)
+        if image_format == 'svg':
+            out_file = out_file_basename+'.svg'
+            fig.savefig(out_file, format='svg')
+            return out_file
+
+        png_buf = BytesIO()
+        fig.savefig(png_buf, format='png', dpi=self.dpi)
+        if Image is None:
+            out_file = out_file_basename+'.png'
+            with open(out_file, 'wb') as out_handle:
+                out_handle.write(png_buf.getvalue())
+            return out_file
+
+        png_buf.seek(0)
+        img = Image.open(png_buf).convert('RGB')
+        if image_format == 'webp':
+            out_file = out_file_basename+'.webp'
+            try:
+                img.save(out_file, format='WEBP', lossless=True, method=6)
+                return out_file
+            except (IOError, KeyError, OSError) as e:
+                log('cannot write WebP ('+str(e)+'), writing PNG instead')
+                if os.path.exists(out_file):
+                    os.remove(out_file)
+
+        # plots are a few flat colors, so a palette loses nothing visible
+        if self.image_colors > 0:
+            img = img.quantize(colors=min(self.image_colors, 256))
+        out_file = out_file_basename+'.png'
+        img.save(out_file, format='PNG', optimize=True)
+        return out_file
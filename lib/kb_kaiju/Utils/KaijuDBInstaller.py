@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import time
+import json
+import shutil
+import hashlib
+import tarfile
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib2 import urlopen, Request, HTTPError
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+
+from kb_kaiju.Utils.KaijuTaxonomy import prepare_taxonomy_db, read_index_manifest
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+KAIJU_DB_URL_BASE = 'http://kaiju.binf.ku.dk/database/'
+
+# db_type, tarball.  An optional 'md5' is checked against the downloaded tarball.
+KAIJU_DBS = [{'db_type': 'refseq',     'url': KAIJU_DB_URL_BASE+'kaiju_db_refseq_2021-02-26.tgz'},
+             {'db_type': 'progenomes', 'url': KAIJU_DB_URL_BASE+'kaiju_db_progenomes_2021-03-02.tgz'},
+             {'db_type': 'nr',         'url': KAIJU_DB_URL_BASE+'kaiju_db_nr_2021-02-24.tgz'},
+             {'db_type': 'nr_euk',     'url': KAIJU_DB_URL_BASE+'kaiju_db_nr_euk_2021-02-24.tgz'},
+             {'db_type': 'viruses',    'url': KAIJU_DB_URL_BASE+'kaiju_db_viruses_2021-02-24.tgz'},
+             {'db_type': 'plasmids',   'url': KAIJU_DB_URL_BASE+'kaiju_db_plasmids_2021-03-05.tgz'},
+             {'db_type': 'rvdb',       'url': KAIJU_DB_URL_BASE+'kaiju_db_rvdb_2021-03-05.tgz'},
+             {'db_type': 'fungi',      'url': KAIJU_DB_URL_BASE+'kaiju_db_fungi_2021-03-04.tgz'}
+         ]
+
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+
+class _ResumableDownloadStream(object):
+    '''
+    File-like stream of a download, for tarfile to extract from while it
+    arrives.  The rest of the file past part_file (from an earlier attempt)
+    is requested with a Range header; if the server honors it, part_file is
+    replayed first and the response appended to it, otherwise it starts
+    over.  Tracks md5 and length of everything read.
+    '''
+
+    def __init__(self, url, part_file, timeout=60):
+        self.url = url
+        self.part_file = part_file
+        self.timeout = timeout
+        self.md5 = hashlib.md5()
+        self.bytes_read = 0
+        self.total_size = None
+        self.response = None
+        self.part_handle = None
+        self.append_handle = None
+        self.part_size = 0
+        if os.path.exists(part_file):
+            self.part_size = os.path.getsize(part_file)
+        # ask for the rest first, so we know whether the part file is usable
+        self._open_response()
+        if self.part_size > 0:
+            self.part_handle = open(part_file, 'rb')
+
+    def _open_response(self):
+        request = Request(self.url)
+        if self.part_size > 0:
+            request.add_header('Range', 'bytes='+str(self.part_size)+'-')
+        try:
+            self.response = urlopen(request, timeout=self.timeout)
+        except HTTPError as e:
+            if e.code == 416:  # part file already holds the whole tarball
+                self.response = None
+                self.total_size = self.part_size
+                return
+            raise
+        status = self.response.getcode()
+        content_range = self.response.info().get('Content-Range')
+        if self.part_size > 0 and status == 206 and content_range:
+            range_match = CONTENT_RANGE_RE.match(content_range)
+            if range_match is None or int(range_match.group(1)) != self.part_size:
+                raise ValueError ('bad Content-Range "'+str(content_range)+'" for '+self.url)
+            if range_match.group(3) != '*':
+                self.total_size = int(range_match.group(3))
+        else:
+            # server ignored the range, start over
+            if self.part_size > 0:
+                log('server does not support resume for '+self.url+', restarting download')
+            self.part_size = 0
+            content_length = self.response.info().get('Content-Length')
+            if content_length is not None:
+                self.total_size = int(content_length)
+        self.append_handle = open(self.part_file, 'ab' if self.part_size > 0 else 'wb')
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = 1024*1024
+        data = b''
+        # replay what's already on disk
+        if self.part_handle is not None:
+            data = self.part_handle.read(size)
+            if len(data) == 0:
+                self.part_handle.close()
+                self.part_handle = None
+        # then the network
+        if len(data) == 0 and self.response is not None:
+            data = self.response.read(size)
+            if len(data) > 0:
+                self.append_handle.write(data)
+        self.md5.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def finish(self):
+        '''
+        Drain anything tarfile didn't read (e.g. trailing padding), close up
+        and return (size, md5) of the whole download
+        '''
+        while len(self.read(1024*1024)) > 0:
+            pass
+        self.close()
+        if self.total_size is not None and self.bytes_read != self.total_size:
+            raise ValueError ('incomplete download of '+self.url+': '+str(self.bytes_read)+' of '+str(self.total_size)+' bytes')
+        return (self.bytes_read, self.md5.hexdigest())
+
+    def close(self):
+        for handle in [self.part_handle, self.append_handle, self.response]:
+            if handle is not None:
+                handle.close()
+        self.part_handle = self.append_handle = self.response = None
+
+
+def read_install_marker(db, data_dir):
+    '''
+    The .<db_type>.installed marker of a finished install of db, or None
+    unless it was installed from the same url (and md5, if given) and all of
+    its files are still in <data_dir>/<db_type> at their tarball sizes
+    '''
+    marker_file = os.path.join(data_dir, '.'+db['db_type']+'.installed')
+    if not os.path.isfile(marker_file):
+        return None
+    with open(marker_file, 'r') as marker_handle:
+        marker = json.load(marker_handle)
+    if marker.get('url') != db['url'] \
+       or (db.get('md5') and marker.get('md5') != db['md5']):
+        return None
+    for (file_name, file_size) in marker['files'].items():
+        file_path = os.path.join(data_dir, db['db_type'], file_name)
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) != file_size:
+            log(db['db_type']+' install is incomplete ('+file_name+' missing or changed)')
+            return None
+    return marker
+
+
+def install_kaiju_db(db, data_dir, attempts=3, retry_wait=10, prepare=True):
+    '''
+    Download and extract one kaiju db into <data_dir>/<db_type>.  The tarball
+    is extracted as it downloads, into a staging dir that only replaces the
+    db dir once the download is complete and verified.  A failed attempt
+    keeps its partial download, and the next attempt resumes it.  A db that
+    is already installed (see read_install_marker()) isn't downloaded again,
+    only its taxonomy index is rebuilt if that is missing or stale.
+    '''
+    db_type = db['db_type']
+    db_dir = os.path.join(data_dir, db_type)
+    stage_dir = os.path.join(data_dir, '.'+db_type+'.extracting')
+    part_file = os.path.join(data_dir, '.'+db_type+'.tgz.part')
+    marker_file = os.path.join(data_dir, '.'+db_type+'.installed')
+    fmi_name = 'kaiju_db_'+db_type+'.fmi'
+
+    marker = read_install_marker(db, data_dir)
+    if marker is not None:
+        if prepare and read_index_manifest(db_dir) is None:
+            prepare_taxonomy_db(db_dir, fmi_size=marker['files'][fmi_name])
+        log(db_type+' is already installed in '+db_dir+', skipping download')
+        return db_dir
+
+    last_error = None
+    for attempt_i in range(attempts):
+        if attempt_i > 0:
+            log('retrying '+db_type+' in '+str(retry_wait)+'s (attempt '+str(attempt_i+1)+' of '+str(attempts)+')')
+            time.sleep(retry_wait)
+        if os.path.exists(stage_dir):
+            shutil.rmtree(stage_dir)
+        os.makedirs(stage_dir)
+
+        log('downloading and extracting: '+db['url'])
+        stream = None
+        try:
+            stream = _ResumableDownloadStream(db['url'], part_file)
+            extracted = {}
+            with tarfile.open(fileobj=stream, mode='r|gz') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    # flatten, as the tarballs keep the .fmi and dmp files at the top
+                    out_name = os.path.basename(member.name)
+                    with open(os.path.join(stage_dir, out_name), 'wb') as out_handle:
+                        shutil.copyfileobj(tar.extractfile(member), out_handle, 1024*1024)
+                    extracted[out_name] = member.size
+            (tgz_size, tgz_md5) = stream.finish()
+        except Exception as e:
+            if stream is not None:
+                stream.close()
+            last_error = e
+            log('failed to download '+db_type+': '+str(e))
+            continue
+
+        if db.get('md5') and db['md5'] != tgz_md5:
+            # a corrupt tarball won't get better by resuming it
+            os.remove(part_file)
+            shutil.rmtree(stage_dir)
+            last_error = ValueError ('checksum mismatch for '+db['url']+': expected '+db['md5']+', got '+tgz_md5)
+            log(str(last_error))
+            continue
+        for required_file in [fmi_name, 'nodes.dmp', 'names.dmp']:
+            if required_file not in extracted:
+                os.remove(part_file)
+                shutil.rmtree(stage_dir)
+                raise ValueError ('tarball '+db['url']+' has no '+required_file)
+
+        # swap in the new db dir
+        if os.path.exists(marker_file):
+            os.remove(marker_file)
+        if os.path.exists(db_dir):
+            shutil.rmtree(db_dir)
+        os.rename(stage_dir, db_dir)
+        os.remove(part_file)
+        log('installed '+db_type+' ('+str(tgz_size)+' bytes, md5 '+tgz_md5+')')
+
+        if prepare:
+            prepare_taxonomy_db(db_dir, fmi_size=extracted[fmi_name])
+
+        # marker last, so only a finished install is ever skipped
+        marker = {'url':       db['url'],
+                  'md5':       tgz_md5,
+                  'size':      tgz_size,
+                  'files':     extracted,
+                  'installed': time.time()
+              }
+        with open(marker_file+'.tmp', 'w') as marker_handle:
+            json.dump(marker, marker_handle, indent=1)
+        os.rename(marker_file+'.tmp', marker_file)
+        return db_dir
+
+    raise ValueError ('failed to install kaiju db '+db_type+': '+str(last_error))
+
+
+def install_kaiju_dbs(data_dir, dbs=None, workers=4, ready_file=None, attempts=3, retry_wait=10, prepare=True):
+    '''
+    Install dbs concurrently.  ready_file is only touched if all succeed.
+    Returns the list of failures.
+    '''
+    if dbs is None:
+        dbs = KAIJU_DBS
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    def install(db):
+        try:
+            install_kaiju_db(db, data_dir, attempts=attempts, retry_wait=retry_wait, prepare=prepare)
+            return None
+        except Exception as e:
+            return db['db_type']+': '+str(e)
+
+    pool = ThreadPool(max(1, min(int(workers), len(dbs))))
+    try:
+        failed = [failure for failure in pool.map(install, dbs) if failure is not None]
+    finally:
+        pool.close()
+        pool.join()
+
+    if len(failed) > 0:
+        log('Init failed:\n'+"\n".join(failed))
+        return failed
+    log('DATA DOWNLOADED SUCCESSFULLY')
+    if ready_file is not None:
+        open(ready_file, 'w').close()
+    return failed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [3, 4]:
+        print('usage: KaijuDBInstaller.py <kaiju db data dir> <ready file> [<download workers>]')
+        sys.exit(1)
+    workers = 4
+    if len(sys.argv) == 4:
+        workers = int(sys.argv[3])
+    failed = install_kaiju_dbs(sys.argv[1], workers=workers, ready_file=sys.argv[2])
+    sys.exit(1 if len(failed) > 0 else 0)
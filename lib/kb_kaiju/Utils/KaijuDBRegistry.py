@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import threading
+
+from kb_kaiju.Utils.KaijuTaxonomy import KaijuTaxonomy, find_fmi_file, read_index_manifest
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+KAIJU_DB_ROOT = os.path.join(os.path.sep, 'data', 'kaijudb')
+
+# kaiju reads the whole .fmi into memory and builds a parent map from
+# nodes.dmp, plus some fixed overhead for buffers and the output writer
+FMI_RAM_FACTOR   = 1.1
+NODES_RAM_FACTOR = 3.0
+BASE_RAM_BYTES   = 512*1024*1024
+
+
+class KaijuDB(object):
+    '''
+    One installed kaiju database: its files, sizes, checksums (from the
+    taxonomy index manifest, when it has been prepared) and an estimate of
+    the RAM a kaiju process needs to run against it.
+    '''
+
+    def __init__(self, db_type, db_dir):
+        self.db_type = db_type
+        self.db_dir = db_dir
+        self.fmi_file = find_fmi_file(db_dir)
+        self.nodes_file = os.path.join(db_dir, 'nodes.dmp')
+        self.names_file = os.path.join(db_dir, 'names.dmp')
+
+        self.sizes = dict()
+        for (file_key, file_path) in [('fmi', self.fmi_file),
+                                      ('nodes.dmp', self.nodes_file),
+                                      ('names.dmp', self.names_file)]:
+            self.sizes[file_key] = os.path.getsize(file_path)
+
+        # checksums are computed once when the taxonomy index is prepared
+        self.checksums = dict()
+        self.taxonomy_index = None
+        manifest = read_index_manifest(db_dir)
+        if manifest is not None:
+            self.taxonomy_index = KaijuTaxonomy.index_path(db_dir, 'json')
+            for (file_key, source) in manifest['sources'].items():
+                if 'md5' in source:
+                    self.checksums[file_key] = source['md5']
+
+        self.ram_estimate = int(FMI_RAM_FACTOR * self.sizes['fmi']) \
+                            + int(NODES_RAM_FACTOR * self.sizes['nodes.dmp']) \
+                            + BASE_RAM_BYTES
+        # kaiju2table only loads the taxonomy
+        self.table_ram_estimate = int(NODES_RAM_FACTOR * (self.sizes['nodes.dmp'] + self.sizes['names.dmp'])) \
+                                  + BASE_RAM_BYTES
+
+
+    def max_concurrent_jobs(self, available_ram):
+        '''
+        How many kaiju processes against this db fit in available_ram bytes
+        (at least 1, so a job is never refused outright)
+        '''
+        return max(1, int(available_ram) // self.ram_estimate)
+
+
+    def to_dict(self):
+        return {'db_type':        self.db_type,
+                'db_dir':         self.db_dir,
+                'fmi_file':       self.fmi_file,
+                'sizes':          self.sizes,
+                'checksums':      self.checksums,
+                'taxonomy_index': self.taxonomy_index,
+                'ram_estimate':   self.ram_estimate,
+                'table_ram_estimate': self.table_ram_estimate
+            }
+
+
+class KaijuDBRegistry(object):
+    '''
+    Databases found under db_root, one sub-directory per db_type holding a
+    .fmi, nodes.dmp and names.dmp.  Directories missing any of these (e.g.
+    a download still being extracted) are skipped.
+    '''
+
+    def __init__(self, db_root=KAIJU_DB_ROOT):
+        self.db_root = db_root
+        self.dbs = dict()
+        self.lock = threading.Lock()
+        self.refresh()
+
+
+    def refresh(self):
+        dbs = dict()
+        if os.path.isdir(self.db_root):
+            for db_type in sorted(os.listdir(self.db_root)):
+                db_dir = os.path.join(self.db_root, db_type)
+                if db_type.startswith('.') or not os.path.isdir(db_dir):
+                    continue
+                if find_fmi_file(db_dir) is None \
+                   or not os.path.isfile(os.path.join(db_dir, 'nodes.dmp')) \
+                   or not os.path.isfile(os.path.join(db_dir, 'names.dmp')):
+                    continue
+                dbs[db_type] = KaijuDB(db_type, db_dir)
+        with self.lock:
+            self.dbs = dbs
+        for db_type in sorted(dbs.keys()):
+            db = dbs[db_type]
+            log('kaiju db '+db_type+': '+db.fmi_file+' ('+str(db.sizes['fmi'])+' bytes, ~'
+                +str(db.ram_estimate // (1024*1024))+' MB RAM, taxonomy index '
+                +('prepared' if db.taxonomy_index else 'not prepared')+')')
+        return dbs
+
+
+    def get_db_types(self):
+        with self.lock:
+            return sorted(self.dbs.keys())
+
+
+    def get(self, db_type):
+        '''
+        The KaijuDB for db_type, looking again under db_root once if it
+        wasn't there at the last scan
+        '''
+        with self.lock:
+            db = self.dbs.get(db_type)
+        if db is None:
+            db = self.refresh().get(db_type)
+        if db is None and len(self.get_db_types()) == 0:
+            raise ValueError ('bad db_type: '+str(db_type)+' (no kaiju dbs are installed under '+self.db_root+')')
+        if db is None:
+            raise ValueError ('bad db_type: '+str(db_type)+' (must be one of "'+'", "'.join(self.get_db_types())+'")')
+        return db
+
+
+db_registry_by_root = dict()
+db_registry_lock = threading.Lock()
+
+
+def get_db_registry(db_root=KAIJU_DB_ROOT):
+    '''
+    Shared registry for db_root, so discovery happens once per process
+    '''
+    with db_registry_lock:
+        if db_root not in db_registry_by_root:
+            db_registry_by_root[db_root] = KaijuDBRegistry(db_root)
+        return db_registry_by_root[db_root]
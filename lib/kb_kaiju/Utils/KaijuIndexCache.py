@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from kb_kaiju.Utils.KaijuTaxonomy import INDEX_ARRAYS, KaijuTaxonomy
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+MB = 1024*1024
+
+PROT_READ      = 0x1
+MAP_SHARED     = 0x01
+MADV_WILLNEED  = 3
+MAP_FAILED     = ctypes.c_void_p(-1).value
+READ_CHUNK     = 8*MB
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+libc.mmap.restype = ctypes.c_void_p
+libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+libc.munlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+
+
+class ResidentFile(object):
+    '''
+    A file mapped read-only and locked into memory, so kaiju processes that
+    read it find it in the page cache.  Where mlock isn't permitted (e.g.
+    RLIMIT_MEMLOCK in a container without IPC_LOCK) the file is read through
+    once instead, which warms the page cache without pinning it.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.addr = None
+        self.locked = False
+
+
+    def load(self):
+        if self.size == 0:
+            return
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            addr = libc.mmap(None, self.size, PROT_READ, MAP_SHARED, fd, 0)
+        finally:
+            os.close(fd)
+        if addr is None or addr == MAP_FAILED:
+            raise OSError (ctypes.get_errno(), 'mmap failed for '+self.path)
+        self.addr = addr
+        libc.madvise(self.addr, self.size, MADV_WILLNEED)
+
+        if libc.mlock(self.addr, self.size) == 0:
+            self.locked = True
+            return
+        mlock_errno = ctypes.get_errno()
+        log('could not lock '+self.path+' in memory ('+os.strerror(mlock_errno)+'), reading it into page cache instead')
+        with open(self.path, 'rb') as warm_handle:
+            while len(warm_handle.read(READ_CHUNK)) > 0:
+                pass
+
+
+    def unload(self):
+        if self.addr is None:
+            return
+        if self.locked:
+            libc.munlock(self.addr, self.size)
+            self.locked = False
+        libc.munmap(self.addr, self.size)
+        self.addr = None
+
+
+class KaijuIndexCache(object):
+    '''
+    Keeps the indexes of recently used kaiju dbs (.fmi, dmp files and the
+    taxonomy index) resident between jobs of a long-running service, least
+    recently used db evicted first once mem_cap would be exceeded.  A db is
+    never evicted while a job holds it; one that can't fit even after
+    evicting everything idle is used cold.
+    '''
+
+    def __init__(self, mem_cap):
+        self.mem_cap = int(mem_cap)
+        self.entries = OrderedDict()  # db_type -> entry, least recently used first
+        self.resident_size = 0
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def _get_db_files(kaiju_db):
+        db_files = [kaiju_db.fmi_file, kaiju_db.nodes_file, kaiju_db.names_file]
+        if kaiju_db.taxonomy_index is not None:
+            for array_name in INDEX_ARRAYS:
+                db_files.append(KaijuTaxonomy.index_path(kaiju_db.db_dir, array_name+'.npy'))
+        return db_files
+
+
+    def _evict_for(self, size):
+        '''
+        Evict idle dbs, least recently used first, until size fits.  Called
+        with the lock held.  Returns whether it fits; nothing is evicted for
+        a size that wouldn't fit anyway.
+        '''
+        idle_size = sum([entry['size'] for entry in self.entries.values()
+                         if entry['users'] == 0 and entry['ready'].is_set()])
+        if self.resident_size - idle_size + size > self.mem_cap:
+            return False
+        for db_type in list(self.entries.keys()):
+            if self.resident_size + size <= self.mem_cap:
+                break
+            entry = self.entries[db_type]
+            if entry['users'] > 0 or not entry['ready'].is_set():
+                continue
+            log('evicting kaiju db '+db_type+' from memory ('+str(entry['size'] // MB)+' MB)')
+            for resident_file in entry['files']:
+                resident_file.unload()
+            self.resident_size -= entry['size']
+            del self.entries[db_type]
+        return self.resident_size + size <= self.mem_cap
+
+
+    def acquire(self, kaiju_db):
+        '''
+        Make kaiju_db resident (waiting if another job is already loading
+        it) and hold it until release()
+        '''
+        db_type = kaiju_db.db_type
+        with self.lock:
+            entry = self.entries.pop(db_type, None)
+            if entry is None:
+                resident_files = [ResidentFile(db_file) for db_file in self._get_db_files(kaiju_db)]
+                size = sum([resident_file.size for resident_file in resident_files])
+                if not self._evict_for(size):
+                    log('kaiju db '+db_type+' ('+str(size // MB)+' MB) does not fit in the '
+                        +str(self.mem_cap // MB)+' MB index cache, using it cold')
+                    return False
+                entry = {'files': resident_files, 'size': size, 'users': 0, 'ready': threading.Event()}
+                self.resident_size += size
+                loader = True
+            else:
+                loader = False
+            entry['users'] += 1
+            self.entries[db_type] = entry  # most recently used
+
+        if loader:
+            log('loading kaiju db '+db_type+' into memory ('+str(entry['size'] // MB)+' MB)')
+            try:
+                for resident_file in entry['files']:
+                    resident_file.load()
+            except Exception as e:
+                log('failed to load kaiju db '+db_type+' into memory: '+str(e))
+            entry['ready'].set()
+            if all([resident_file.locked for resident_file in entry['files']]):
+                log('kaiju db '+db_type+' locked in memory')
+            else:
+                log('kaiju db '+db_type+' in page cache (not locked)')
+        else:
+            entry['ready'].wait()
+        return True
+
+
+    def release(self, kaiju_db):
+        with self.lock:
+            entry = self.entries.get(kaiju_db.db_type)
+            if entry is not None:
+                entry['users'] -= 1
+
+
+    @contextmanager
+    def hold(self, kaiju_db):
+        held = self.acquire(kaiju_db)
+        try:
+            yield
+        finally:
+            if held:
+                self.release(kaiju_db)
+
+
+    def preload(self, db_registry, db_types):
+        '''
+        Load db_types in a background thread, so a service starts answering
+        before its dbs are resident
+        '''
+        def preload_dbs():
+            for db_type in db_types:
+                try:
+                    kaiju_db = db_registry.get(db_type.strip())
+                except ValueError as e:
+                    log('not preloading kaiju db: '+str(e))
+                    continue
+                if self.acquire(kaiju_db):
+                    self.release(kaiju_db)
+        preload_thread = threading.Thread(target=preload_dbs)
+        preload_thread.daemon = True
+        preload_thread.start()
+        return preload_thread
+
+
+    def get_status(self):
+        with self.lock:
+            return [{'db_type': db_type,
+                     'size':    entry['size'],
+                     'users':   entry['users'],
+                     'locked':  all([f.locked for f in entry['files']])
+                 } for (db_type, entry) in self.entries.items()]
+
+
+index_cache = None
+index_cache_lock = threading.Lock()
+
+
+def get_index_cache(config=None):
+    '''
+    The index cache of this process in warm standby mode, else None.
+    Warm standby is turned on by the 'standby' entrypoint (KAIJU_WARM_STANDBY=1).
+    '''
+    global index_cache
+    if os.environ.get('KAIJU_WARM_STANDBY') != '1':
+        return None
+    with index_cache_lock:
+        if index_cache is None:
+            mem_cap = int((config or dict()).get('warm-standby-memory-mb') or 0) * MB
+            index_cache = KaijuIndexCache(mem_cap)
+            log('warm standby: keeping up to '+str(mem_cap // MB)+' MB of kaiju db indexes resident')
+        return index_cache
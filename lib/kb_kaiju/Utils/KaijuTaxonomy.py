@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import json
+import hashlib
+import numpy as np
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+# ranks found in nodes.dmp.  Any rank not listed is appended when the db is prepared.
+ALL_TAX_LEVELS = ['class',
+                  'cohort',
+                  'family',
+                  'forma',
+                  'genus',
+                  'infraclass',
+                  'infraorder',
+                  'kingdom',
+                  'no rank',
+                  'order',
+                  'parvorder',
+                  'phylum',
+                  'species',
+                  'subclass',
+                  'subfamily',
+                  'subgenus',
+                  'subkingdom',
+                  'suborder',
+                  'subphylum',
+                  'subspecies',
+                  'subtribe',
+                  'superclass',
+                  'superfamily',
+                  'superkingdom',
+                  'superorder',
+                  'superphylum',
+                  'tribe',
+                  'varietas']
+
+# ranks with a precomputed ancestor-at-rank column
+ANCESTOR_TAX_LEVELS = ['superkingdom',
+                       'phylum',
+                       'class',
+                       'order',
+                       'family',
+                       'genus',
+                       'species']
+
+INDEX_PREFIX  = 'kaiju_taxonomy'
+INDEX_VERSION = 1
+INDEX_ARRAYS  = ['parent', 'rank', 'ancestors', 'name_offsets', 'names']
+LEVEL_LIMIT   = 100
+
+
+def _read_dmp_fields(dmp_file):
+    with open(dmp_file, 'rb') as dmp_handle:
+        for dmp_line in dmp_handle:
+            yield [field.strip() for field in dmp_line.rstrip(b"\r\n").split(b"\t|")]
+
+
+def _md5(path, block_size=4*1024*1024):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as handle:
+        while True:
+            block = handle.read(block_size)
+            if not block:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _file_stamp(path):
+    return {'size': os.path.getsize(path), 'mtime': int(os.path.getmtime(path))}
+
+
+def find_fmi_file(db_dir):
+    fmi_files = sorted([f for f in os.listdir(db_dir) if f.endswith('.fmi')])
+    if len(fmi_files) == 0:
+        return None
+    return os.path.join(db_dir, fmi_files[0])
+
+
+def validate_fmi_file(fmi_file, expected_size=None):
+    '''
+    A usable kaiju index exists and is non-empty.  Truncation (a cut short
+    download or extraction) is only caught when expected_size is given,
+    e.g. the size recorded for it in the tarball, so it fails here rather
+    than mid-job.
+    '''
+    if fmi_file is None or not os.path.isfile(fmi_file):
+        raise ValueError ('missing kaiju index (.fmi) file: '+str(fmi_file))
+    fmi_size = os.path.getsize(fmi_file)
+    if fmi_size == 0:
+        raise ValueError ('empty kaiju index file: '+fmi_file)
+    if expected_size is not None and fmi_size != expected_size:
+        raise ValueError ('truncated kaiju index file: '+fmi_file+' has '+str(fmi_size)+' of '+str(expected_size)+' bytes')
+    return fmi_size
+
+
+def read_index_manifest(db_dir):
+    '''
+    The kaiju_taxonomy.json manifest of db_dir, or None unless the index
+    exists and was built from the current dmp files.  Only sizes and mtimes
+    are compared here; checksums are for auditing.
+    '''
+    manifest_path = KaijuTaxonomy.index_path(db_dir, 'json')
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as manifest_handle:
+        manifest = json.load(manifest_handle)
+    if manifest.get('version') != INDEX_VERSION \
+       or manifest.get('ancestor_tax_levels') != ANCESTOR_TAX_LEVELS:
+        return None
+    for src_name in ['nodes.dmp', 'names.dmp']:
+        src_path = os.path.join(db_dir, src_name)
+        if not os.path.isfile(src_path):
+            return None
+        src_stamp = _file_stamp(src_path)
+        if src_stamp['size'] != manifest['sources'][src_name]['size'] \
+           or src_stamp['mtime'] != manifest['sources'][src_name]['mtime']:
+            log('taxonomy index in '+db_dir+' is stale ('+src_name+' changed)')
+            return None
+    return manifest
+
+
+def prepare_taxonomy_db(db_dir, fmi_checksum=True, fmi_size=None):
+    '''
+    Precompute the taxonomy index for one db_type directory (with nodes.dmp,
+    names.dmp and a .fmi of fmi_size bytes, if known), so runtime only has
+    to mmap it:
+
+        kaiju_taxonomy.parent.npy        parent id, by taxon id
+        kaiju_taxonomy.rank.npy          rank index, by taxon id
+        kaiju_taxonomy.ancestors.npy     ancestor id at each ANCESTOR_TAX_LEVELS rank, by taxon id
+        kaiju_taxonomy.name_offsets.npy  offsets into the names blob, by taxon id
+        kaiju_taxonomy.names.npy         utf-8 scientific names blob
+        kaiju_taxonomy.json              manifest: ranks, source file stamps, checksums
+    '''
+    log('preparing taxonomy index for '+db_dir)
+    fmi_file = find_fmi_file(db_dir)
+    fmi_size = validate_fmi_file(fmi_file, expected_size=fmi_size)
+
+    taxonomy = KaijuTaxonomy.from_dmp(db_dir)
+    arrays = taxonomy.get_arrays()
+
+    manifest = {'version':     INDEX_VERSION,
+                'created':     time.time(),
+                'tax_levels':  taxonomy.tax_levels,
+                'ancestor_tax_levels': ANCESTOR_TAX_LEVELS,
+                'sources':     {},
+                'arrays':      {}
+            }
+    for src_name in ['nodes.dmp', 'names.dmp']:
+        src_path = os.path.join(db_dir, src_name)
+        manifest['sources'][src_name] = _file_stamp(src_path)
+        manifest['sources'][src_name]['md5'] = _md5(src_path)
+    manifest['sources']['fmi'] = _file_stamp(fmi_file)
+    manifest['sources']['fmi']['path'] = os.path.basename(fmi_file)
+    if fmi_checksum:
+        manifest['sources']['fmi']['md5'] = _md5(fmi_file)
+
+    for array_name in INDEX_ARRAYS:
+        array_path = KaijuTaxonomy.index_path(db_dir, array_name+'.npy')
+        np.save(array_path+'.tmp.npy', arrays[array_name])
+        os.rename(array_path+'.tmp.npy', array_path)
+        manifest['arrays'][array_name] = {'md5': _md5(array_path)}
+
+    # manifest last, so a partial prepare is never picked up
+    manifest_path = KaijuTaxonomy.index_path(db_dir, 'json')
+    with open(manifest_path+'.tmp', 'w') as manifest_handle:
+        json.dump(manifest, manifest_handle, indent=1)
+    os.rename(manifest_path+'.tmp', manifest_path)
+    log('prepared taxonomy index for '+db_dir+' ('+str(len(arrays['parent']))+' taxon ids, '+str(fmi_size)+' byte .fmi)')
+    return manifest
+
+
+class KaijuTaxonomy(object):
+    '''
+    NCBI taxonomy of a kaiju db as flat arrays indexed by taxon id.  open()
+    mmaps the index made by prepare_taxonomy_db() when it is present and
+    current, otherwise it parses nodes.dmp and names.dmp (the slow path).
+    '''
+
+    def __init__(self, parent, rank, ancestors, name_offsets, names, tax_levels):
+        self.parent = parent
+        self.rank = rank
+        self.ancestors = ancestors
+        self.name_offsets = name_offsets
+        self.names = names
+        self.tax_levels = tax_levels
+        self.tax_level_ids = dict((tax_level, tax_level_i) for (tax_level_i, tax_level) in enumerate(tax_levels))
+        self.max_id = len(parent) - 1
+
+
+    @staticmethod
+    def index_path(db_dir, suffix):
+        return os.path.join(db_dir, INDEX_PREFIX+'.'+suffix)
+
+
+    @classmethod
+    def open(cls, db_dir):
+        taxonomy = cls.from_index(db_dir)
+        if taxonomy is None:
+            log('no current taxonomy index in '+db_dir+', parsing nodes.dmp and names.dmp')
+            taxonomy = cls.from_dmp(db_dir)
+        return taxonomy
+
+
+    @classmethod
+    def from_index(cls, db_dir):
+        '''
+        None unless the index exists and was built from the current dmp files
+        '''
+        manifest = read_index_manifest(db_dir)
+        if manifest is None:
+            return None
+
+        arrays = dict()
+        for array_name in INDEX_ARRAYS:
+            arrays[array_name] = np.load(cls.index_path(db_dir, array_name+'.npy'), mmap_mode='r')
+        return cls(arrays['parent'], arrays['rank'], arrays['ancestors'],
+                   arrays['name_offsets'], arrays['names'], manifest['tax_levels'])
+
+
+    @classmethod
+    def from_dmp(cls, db_dir):
+        nodes_file = os.path.join(db_dir, 'nodes.dmp')
+        names_file = os.path.join(db_dir, 'names.dmp')
+        NODE_ID_I = 0
+        PAR_ID_I  = 1
+        LEVEL_I   = 2
+        ID_I      = 0
+        NAME_I    = 1
+        CAT_I     = 3
+
+        # nodes
+        tax_levels = list(ALL_TAX_LEVELS)
+        tax_level_ids = dict((tax_level, tax_level_i) for (tax_level_i, tax_level) in enumerate(tax_levels))
+        node_ids = []
+        par_ids = []
+        level_ids = []
+        for nodes_line_info in _read_dmp_fields(nodes_file):
+            tax_level_str = nodes_line_info[LEVEL_I].decode('utf-8')
+            if tax_level_str == 'species group' or tax_level_str == 'species subgroup':
+                tax_level_str = 'species'
+            if tax_level_str not in tax_level_ids:
+                tax_level_ids[tax_level_str] = len(tax_levels)
+                tax_levels.append(tax_level_str)
+            node_ids.append(int(nodes_line_info[NODE_ID_I]))
+            par_ids.append(int(nodes_line_info[PAR_ID_I]))
+            level_ids.append(tax_level_ids[tax_level_str])
+
+        # names
+        name_by_id = dict()
+        for names_line_info in _read_dmp_fields(names_file):
+            if names_line_info[CAT_I] != b'scientific name':
+                continue
+            name_by_id[int(names_line_info[ID_I])] = names_line_info[NAME_I]
+
+        max_id = max(max(node_ids), max(name_by_id.keys()) if name_by_id else 0)
+        parent = np.zeros(max_id+1, dtype=np.int32)
+        rank = np.full(max_id+1, -1, dtype=np.int16)
+        parent[node_ids] = par_ids
+        rank[node_ids] = level_ids
+
+        name_lens = np.zeros(max_id+1, dtype=np.int64)
+        for (name_id, name) in name_by_id.items():
+            name_lens[name_id] = len(name)
+        name_offsets = np.zeros(max_id+2, dtype=np.int64)
+        np.cumsum(name_lens, out=name_offsets[1:])
+        names = np.frombuffer(b''.join([name_by_id.get(name_id, b'') for name_id in range(max_id+1)]), dtype=np.uint8)
+
+        ancestors = cls._build_ancestors(parent, rank, [tax_level_ids[tax_level] for tax_level in ANCESTOR_TAX_LEVELS])
+        return cls(parent, rank, ancestors, name_offsets, names, tax_levels)
+
+
+    @staticmethod
+    def _build_ancestors(parent, rank, ancestor_level_ids):
+        '''
+        Nearest ancestor (or self) at each rank, walking up the same way the
+        per-taxon roll-up does: a node whose parent is the root is only
+        considered as the starting node.  0 where there is none.
+        '''
+        ancestors = np.zeros((len(parent), len(ancestor_level_ids)), dtype=np.int32)
+        rows = np.flatnonzero(parent > 0).astype(np.int64)
+        cur = rows.copy()
+        for level_lim_i in range(LEVEL_LIMIT):
+            cur_rank = rank[cur]
+            for col_i,level_id in enumerate(ancestor_level_ids):
+                hit = (cur_rank == level_id)
+                hit_rows = rows[hit]
+                unset = (ancestors[hit_rows, col_i] == 0)
+                ancestors[hit_rows[unset], col_i] = cur[hit][unset]
+            nxt = parent[cur]
+            active = (nxt > 0) & (parent[nxt] != 1)
+            rows = rows[active]
+            cur = nxt[active].astype(np.int64)
+            if len(cur) == 0:
+                break
+        return ancestors
+
+
+    def get_arrays(self):
+        return {'parent':       self.parent,
+                'rank':         self.rank,
+                'ancestors':    self.ancestors,
+                'name_offsets': self.name_offsets,
+                'names':        self.names}
+
+
+    def has_node(self, node_id):
+        return 0 < node_id <= self.max_id and self.parent[node_id] > 0
+
+
+    def get_parent(self, node_id):
+        return int(self.parent[node_id])
+
+
+    def get_tax_level(self, node_id):
+        rank_i = self.rank[node_id]
+        if rank_i < 0:
+            return None
+        return self.tax_levels[rank_i]
+
+
+    def get_name(self, node_id):
+        '''
+        Scientific name, or None.  A native str on py2 and py3.
+        '''
+        (start, end) = (self.name_offsets[node_id], self.name_offsets[node_id+1])
+        if start == end:
+            return None
+        name = self.names[start:end].tobytes()
+        if str is bytes:
+            return name
+        return name.decode('utf-8')
+
+
+    def get_ancestors_at_level(self, node_ids, tax_level):
+        '''
+        Array of the ancestor at tax_level for each of node_ids (0 where none),
+        or None if tax_level has no precomputed column
+        '''
+        if tax_level not in ANCESTOR_TAX_LEVELS:
+            return None
+        return np.asarray(self.ancestors[node_ids, ANCESTOR_TAX_LEVELS.index(tax_level)])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: KaijuTaxonomy.py <kaiju db dir> [<kaiju db dir> ...]')
+        sys.exit(1)
+    for db_dir in sys.argv[1:]:
+        prepare_taxonomy_db(db_dir)
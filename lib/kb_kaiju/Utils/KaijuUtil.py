@@ -1,14 +1,27 @@
 # -*- coding: utf-8 -*-
 import time
 import os
+import shutil
 import uuid
-import subprocess
 import sys
+import json
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
 
 from KBaseReport.KBaseReportClient import KBaseReport
 
 from kb_kaiju.Utils.DataStagingUtils import DataStagingUtils
 from kb_kaiju.Utils.OutputBuilder import OutputBuilder
+from kb_kaiju.Utils.ImageOutputPolicy import ImageOutputPolicy
+from kb_kaiju.Utils.ArtifactManager import ArtifactManager
+from kb_kaiju.Utils.ClassificationBackend import get_classification_backend
+from kb_kaiju.Utils.StageCheckpoint import StageCheckpoint
+from kb_kaiju.Utils.KaijuDBRegistry import get_db_registry
+from kb_kaiju.Utils.ResourceGovernor import get_resource_governor
+from kb_kaiju.Utils.KaijuIndexCache import get_index_cache
+from kb_kaiju.Utils.ToolRunner import ToolRunner
+from kb_kaiju.Utils.TaskGraph import TaskGraph
 
 
 def log(message, prefix_newline=False):
@@ -17,6 +30,11 @@ def log(message, prefix_newline=False):
     sys.stdout.flush()
 
 
+# ktImportText (perl) holds the parsed krona text a few times over
+KRONA_BASE_RAM_BYTES = 256*1024*1024
+KRONA_RAM_FACTOR     = 20
+
+
 class KaijuUtil:
 
     def __init__(self, config, ctx):
@@ -30,6 +48,14 @@ class KaijuUtil:
         self.SE_flag = 'SE'
         self.PE_flag = 'PE'
         self.dsu_client = DataStagingUtils(self.config, self.ctx)
+        self.db_registry = get_db_registry()
+        self.governor = get_resource_governor(self.config)
+        self.index_cache = get_index_cache(self.config)
+        self.tool_runner = ToolRunner.from_config(self.config, cwd=self.scratch, governor=self.governor)
+        self.classification_backend = get_classification_backend(self.config, self.scratch, tool_runner=self.tool_runner)
+        self.report_plots = self.config.get('report-plots') or 'png'
+        if self.report_plots not in ['png', 'js']:
+            raise ValueError ('bad report-plots: '+self.report_plots+' (must be "png" or "js")')
 
         if not os.path.exists(self.scratch):
             os.makedirs(self.scratch)
@@ -41,17 +67,26 @@ class KaijuUtil:
         '''
 
         # 0) validate basic parameters and set defaults
+        #    (output folders are named for the run params, so any interrupted run can be resumed
+        #     by a rerun with resume set; pick the suffix before defaults like subsample_seed are
+        #     derived from it)
+        self.suffix = self._get_resume_suffix(params)
         params = self.validate_run_kaiju_with_krona_params(params)
+        resume = (int(params['resume']) == 1)
 
         # 1) expand input members that are sets
         expanded_input = self.dsu_client.expand_input(params['input_refs'])
 
 
-        # 2) establish output folders
+        # 2) establish output folders (a run that doesn't resume starts from empty ones)
         output_dir = os.path.join(self.scratch, 'output_' + str(self.suffix))
+        html_dir = os.path.join(self.scratch, 'html_' + str(self.suffix))
+        for run_dir in [output_dir, html_dir]:
+            if not resume and os.path.exists(run_dir):
+                log('removing output of an earlier run with the same params: '+run_dir)
+                shutil.rmtree(run_dir)
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
-        html_dir = os.path.join(self.scratch, 'html_' + str(self.suffix))
         if not os.path.exists(html_dir):
             os.makedirs(html_dir)
 
@@ -77,6 +112,13 @@ class KaijuUtil:
         if not os.path.exists(krona_output_folder):
             os.makedirs(krona_output_folder)
 
+        biom_output_folder = os.path.join(output_dir, 'biom')
+        if not os.path.exists(biom_output_folder):
+            os.makedirs(biom_output_folder)
+
+        # stage completion manifests, used to skip completed work on resume
+        self.checkpoint = StageCheckpoint(output_dir, resume=resume)
+
 
         # 3) instantiate OutputBuilder
         output_folders = [ { 'name': 'kaiju_classifications',
@@ -90,6 +132,10 @@ class KaijuUtil:
                            { 'name': 'krona_data',
                              'desc': 'Krona Data',
                              'path': krona_output_folder
+                         },
+                           { 'name': 'biom_tables',
+                             'desc': 'Abundance Tables (BIOM 2.1 HDF5)',
+                             'path': biom_output_folder
                          },
                            { 'name': 'stacked_bar_abundance_plots_PNG+PDF',
                              'desc': 'Stacked Bar Abundance Plots (PNG + PDF)',
@@ -100,6 +146,12 @@ class KaijuUtil:
                            #  'path': kaijuReport_PerSamplePlots_output_folder
                            #}
                       ]
+        if self.report_plots == 'js':
+            # the plots are drawn by the report page, only their data is written
+            output_folders[-1] = { 'name': 'stacked_abundance_plot_data_JSON',
+                                   'desc': 'Stacked Abundance Plot Data (JSON)',
+                                   'path': kaijuReport_StackedBarPlots_output_folder
+                               }
         build_area_plots_flag = False
         # DEBUG
         #if len(expanded_input) > 1:
@@ -108,10 +160,68 @@ class KaijuUtil:
         #                             'desc': 'Stacked Area Abundance Plots (PNG + PDF)',
         #                             'path': kaijuReport_StackedAreaPlots_output_folder
         #                           })
-        self.outputBuilder_client = OutputBuilder(output_folders, self.scratch, self.callback_url, self.workspace_url)
+        self.outputBuilder_client = OutputBuilder(output_folders, self.scratch, self.callback_url, self.workspace_url,
+                                                  image_policy=ImageOutputPolicy.from_config(self.config),
+                                                  artifact_manager=ArtifactManager.from_config(self.config))
+
+
+        # 4-9) run as a graph of tasks, each started as soon as its inputs are ready:
+        #      per sample, classify -> report per tax level, and classify -> krona,
+        #      joined across samples only for the stacked plots, combined krona and biom.
+        #      The first samples' reports and krona charts overlap later samples' classification.
+        pipeline = TaskGraph(workers=int(self.config.get('pipeline-workers') or 4),
+                             on_failure=self.tool_runner.cancel)
+        combined_krona = (int(params['combined_krona']) == 1)
+        sample_tasks = {'kaiju_report': [], 'krona': []}
 
+        kaijuReport_options = {'in_folder':                 kaiju_output_folder,
+                               'out_folder':                kaijuReport_output_folder,
+                               'tax_levels':                params['tax_levels'],
+                               'db_type':                   params['db_type'],
+                               'filter_percent':            params['filter_percent'],
+                               'filter_unclassified':       params['filter_unclassified'],
+                               'full_tax_path':             params['full_tax_path']
+                           }
+        kaijuReport_inputs = {'tax_levels': params['tax_levels'],
+                              'filter_percent': params['filter_percent'],
+                              'filter_unclassified': params['filter_unclassified'],
+                              'full_tax_path': params['full_tax_path']}
+        krona_options = {'in_folder':                 kaiju_output_folder,
+                         'out_folder':                krona_output_folder,
+                         'html_folder':               html_dir,
+                         'combined_krona':            combined_krona,
+                         'db_type':                   params['db_type']
+                     }
 
-        # 4) run Kaiju in batch (download happens one-by-one and then deleted to save space)
+        def run_sample_report(input_reads_item):
+            report_files = [os.path.join(kaijuReport_output_folder, input_reads_item['name']+'-'+tax_level+'.kaijuReport')
+                            for tax_level in params['tax_levels']]
+            return self.checkpoint.run_stage('kaiju_report-'+input_reads_item['name'],
+                                             kaijuReport_inputs,
+                                             lambda: self.run_kaijuReport_batch (dict(kaijuReport_options, input_reads=[input_reads_item])),
+                                             outputs=report_files)
+
+        def run_sample_krona(input_reads_item):
+            # a combined chart is imported once every sample's krona text is
+            # written, and the top nav is added once every krona page is known
+            if combined_krona:
+                krona_func = self.run_kronaText_batch
+            else:
+                krona_func = self.run_krona_batch
+            return self.checkpoint.run_stage('krona-'+input_reads_item['name'],
+                                             {'combined_krona': combined_krona},
+                                             lambda: krona_func (dict(krona_options, input_reads=[input_reads_item])),
+                                             outputs=[os.path.join(krona_output_folder, input_reads_item['name']+'.krona')])
+
+        def add_sample_tasks(replicate_input):
+            # called as each library is classified
+            for input_reads_item in replicate_input:
+                sample_tasks['kaiju_report'].append(pipeline.add('kaiju_report-'+input_reads_item['name'],
+                                                                 lambda item=input_reads_item: run_sample_report(item)))
+                sample_tasks['krona'].append(pipeline.add('krona-'+input_reads_item['name'],
+                                                          lambda item=input_reads_item: run_sample_krona(item)))
+
+        # classification (download happens one-by-one and then deleted to save space)
         kaiju_options = {'input_reads':               expanded_input,
                          'out_folder':                kaiju_output_folder,
                          'subsample_percent':         params['subsample_percent'],
@@ -124,109 +234,194 @@ class KaijuUtil:
                          'greedy_run_mode':           params['greedy_run_mode'],
                          'greedy_allowed_mismatches': params['greedy_allowed_mismatches'],
                          'greedy_min_match_score':    params['greedy_min_match_score'],
-                         'threads':                   self.threads
+                         'threads':                   self.threads,
+                         'on_library_classified':     add_sample_tasks
                         }
-        expanded_input = self.run_kaiju_batch (kaiju_options)  # revise expanded input with subsamples
 
+        def classify():
+            # in warm standby mode the db index stays resident for the next job
+            if self.index_cache is not None:
+                with self.index_cache.hold(self.db_registry.get(params['db_type'])):
+                    return self.run_kaiju_batch (kaiju_options)
+            return self.run_kaiju_batch (kaiju_options)
+        pipeline.add('classify', classify)
 
-        # 5) create Summary Reports in batch
-        kaijuReport_options = {'input_reads':               expanded_input,
-                               'in_folder':                 kaiju_output_folder,
-                               'out_folder':                kaijuReport_output_folder,
-                               'tax_levels':                params['tax_levels'],
-                               'db_type':                   params['db_type'],
-                               'filter_percent':            params['filter_percent'],
-                               'filter_unclassified':       params['filter_unclassified'],
-                               'full_tax_path':             params['full_tax_path']
-                           }
-        self.run_kaijuReport_batch (kaijuReport_options)
+        # every library is classified (and its sample tasks added) once this returns
+        [expanded_input] = pipeline.wait(['classify'])  # revised with subsamples
+        replicate_names = [input_reads_item['name'] for input_reads_item in expanded_input]
 
 
-        # 6) create Summary Report plots in batch
+        # stacked plots, of every sample's reports
         kaijuReportPlots_options = {'input_reads':                   expanded_input,
                                     'in_folder':                     kaijuReport_output_folder,
                                     'stacked_bar_plots_out_folder':  kaijuReport_StackedBarPlots_output_folder,
                                     #'per_sample_plots_out_folder':   kaijuReport_PerSamplePlots_output_folder,
                                     'tax_levels':                    params['tax_levels'],
-                                    'sort_taxa_by':                  params['sort_taxa_by']
+                                    'sort_taxa_by':                  params['sort_taxa_by'],
+                                    'plot_top_taxa':                 self.config.get('plot-top-taxa'),
+                                    'plot_top_taxa_by':              self.config.get('plot-top-taxa-by')
                                     #'filter_percent':            params['filter_percent'],
                                     #'filter_unclassified':       params['filter_unclassified'],
                                     #'full_tax_path':             params['full_tax_path']
                                 }
         if build_area_plots_flag:
             kaijuReportPlots_options['stacked_area_plots_out_folder'] = kaijuReport_StackedAreaPlots_output_folder
-        kaijuReport_plot_files = self.run_kaijuReportPlots_batch (kaijuReportPlots_options)
-
-
-        # 7) create HTML Summary Reports in batch
+        if self.report_plots == 'js':
+            kaijuReportPlots_options['out_folder'] = kaijuReport_StackedBarPlots_output_folder
+            pipeline.add('report_plots',
+                         lambda: self.checkpoint.run_stage('report_plot_data',
+                                                           {'input_reads': replicate_names,
+                                                            'tax_levels': params['tax_levels'],
+                                                            'sort_taxa_by': params['sort_taxa_by'],
+                                                            'plot_top_taxa': self.config.get('plot-top-taxa'),
+                                                            'plot_top_taxa_by': self.config.get('plot-top-taxa-by')},
+                                                           lambda: self.outputBuilder_client.generate_kaijuReport_PlotData (kaijuReportPlots_options),
+                                                           outputs=[kaijuReport_StackedBarPlots_output_folder]),
+                         deps=sample_tasks['kaiju_report'])
+        else:
+            pipeline.add('report_plots',
+                         lambda: self.checkpoint.run_stage('report_plots',
+                                                           {'input_reads': replicate_names,
+                                                            'tax_levels': params['tax_levels'],
+                                                            'sort_taxa_by': params['sort_taxa_by'],
+                                                            'plot_top_taxa': self.config.get('plot-top-taxa'),
+                                                            'plot_top_taxa_by': self.config.get('plot-top-taxa-by'),
+                                                            'report_image_format': self.config.get('report-image-format'),
+                                                            'report_image_colors': self.config.get('report-image-colors')},
+                                                           lambda: self.run_kaijuReportPlots_batch (kaijuReportPlots_options),
+                                                           outputs=[kaijuReport_StackedBarPlots_output_folder,
+                                                                    kaijuReport_StackedAreaPlots_output_folder]),
+                         deps=sample_tasks['kaiju_report'])
+
+
+        # HTML pages of the stacked plots
+        #    the page list is known up front, so each page gets its top nav as it's written
+        html_pages = self._plan_html_pages(html_dir, build_area_plots_flag, expanded_input, combined_krona)
         kaijuReportPlotsHTML_options = {'input_reads':             expanded_input,
                                         'summary_folder':          kaijuReport_output_folder,
-                                        'stacked_bar_plot_files':  kaijuReport_plot_files['stacked_bar_plot_files'],
                                         #'per_sample_plot_files':   kaijuReport_plot_files['per_sample_plot_files'],
                                         'out_folder':              html_dir,
-                                        'tax_levels':              params['tax_levels']
+                                        'tax_levels':              params['tax_levels'],
+                                        'html_pages':              html_pages
         }
-        if build_area_plots_flag:
-            kaijuReportPlotsHTML_options['stacked_area_plot_files'] = kaijuReport_plot_files['stacked_area_plot_files']
-        html_plot_pages = self.run_kaijuReportPlotsHTML_batch (kaijuReportPlotsHTML_options)
-
-
-        # 8) create Krona plots
-        krona_options = {'input_reads':               expanded_input,
-                         'in_folder':                 kaiju_output_folder,
-                         'out_folder':                krona_output_folder,
-                         'html_folder':               html_dir,
-                         'db_type':                   params['db_type']
-                     }
-        html_krona_pages = self.run_krona_batch (krona_options)
-
-
-        # 9) Package results
-        output_packages = self._build_output_packages(params, self.outputBuilder_client)
-
-
-        # 10) add top nav to html pages and build the HTML report
-        html_pages = []
-        html_pages.extend(html_plot_pages['bar'])
-        if build_area_plots_flag:
-            html_pages.extend(html_plot_pages['area'])
-        #html_pages.extend(html_plot_pages['per_sample'])
-        html_pages.extend(html_krona_pages)
-        self.outputBuilder_client.add_top_nav(html_pages)
-        #report_html_file = 'kaiju_html_plots.zip'  # fails
-        #report_html_file = 'kaiju_plots.html'  # fails
-        report_html_file = html_pages[0]['local_path']  # works
-        report_html_desc = 'Kaiju abundance and Krona plots'
-        html_zipped = self.outputBuilder_client.package_folder(html_dir, report_html_file, report_html_desc)
-
-
-        """
-        # 11) save biom output for each tax level
-        generated_biom_objs = []
-        timestamp_epoch = time.time()
+        def build_plot_pages():
+            if self.report_plots == 'js':
+                kaijuReportPlotsHTML_options['plot_data_file'] = pipeline.get_result('report_plots')
+                kaijuReportPlotsHTML_options['plot_types'] = ['bar']
+                if build_area_plots_flag:
+                    kaijuReportPlotsHTML_options['plot_types'].append('area')
+            else:
+                kaijuReport_plot_files = pipeline.get_result('report_plots')
+                kaijuReportPlotsHTML_options['stacked_bar_plot_files'] = kaijuReport_plot_files['stacked_bar_plot_files']
+                kaijuReportPlotsHTML_options['stacked_plot_key_lengths'] = kaijuReport_plot_files.get('stacked_plot_key_lengths')
+                if build_area_plots_flag:
+                    kaijuReportPlotsHTML_options['stacked_area_plot_files'] = kaijuReport_plot_files['stacked_area_plot_files']
+            return self.checkpoint.run_stage('report_plots_html',
+                                             {'input_reads': replicate_names,
+                                              'tax_levels': params['tax_levels'],
+                                              'combined_krona': combined_krona,
+                                              'report_plots': self.report_plots},
+                                             lambda: self.run_kaijuReportPlotsHTML_batch (kaijuReportPlotsHTML_options),
+                                             outputs=lambda out_html_files: [html_page['abs_path'] for plot_type in sorted(out_html_files.keys())
+                                                                             for html_page in out_html_files[plot_type]]
+                                                                            + [os.path.join(html_dir, asset_dir) for asset_dir in ['img', 'js', 'data']
+                                                                               if os.path.isdir(os.path.join(html_dir, asset_dir))])
+        pipeline.add('report_plots_html', build_plot_pages, deps=['report_plots'])
+
+
+        # Krona: the combined chart of every sample, and the top nav of every krona page
+        def finish_krona():
+            if combined_krona:
+                html_krona_pages = self.checkpoint.run_stage('krona',
+                                                             {'input_reads': replicate_names,
+                                                              'combined_krona': combined_krona},
+                                                             lambda: self.run_kronaImport_batch (dict(krona_options, input_reads=expanded_input)),
+                                                             outputs=[krona_output_folder])
+            else:
+                html_krona_pages = []
+                for krona_task in sample_tasks['krona']:
+                    html_krona_pages.extend(pipeline.get_result(krona_task))
+            for html_page in html_krona_pages:
+                self.outputBuilder_client.insert_top_nav(html_page, html_pages)
+            return html_krona_pages
+        pipeline.add('krona', finish_krona, deps=sample_tasks['krona'])
+
+
+        # biom output for all tax levels (one classification scan per sample)
+        biom_obj_names = dict()
         for tax_level in params['tax_levels']:
             obj_name = params['output_biom_name']
             if len(params['tax_levels']) != 1:
                 obj_name += '-'+tax_level
-
-            generate_biom_options = {'tax_level':       tax_level,
-                                     'db_type':         params['db_type'],
-                                     'input_reads':     expanded_input,
-                                     'in_folder':       kaiju_output_folder,
-                                     'workspace_name':  params['workspace_name'],
-                                     'output_obj_name': obj_name,
-                                     'timestamp_epoch': timestamp_epoch
-                                 }
-            biom_obj_ref = self.outputBuilder_client.generate_sparse_biom1_0_matrix(self.ctx, generate_biom_options)
-            generated_biom_objs.append({'ref': biom_obj_ref,
-                                        'description': 'Kaiju Taxonomic Classification at '+tax_level+' Level.  BIOM format'})
-        """
-
-
-        # 12) save report
+            biom_obj_names[tax_level] = obj_name
+
+        generate_biom_options = {'tax_levels':       params['tax_levels'],
+                                 'db_type':          params['db_type'],
+                                 'input_reads':      expanded_input,
+                                 'in_folder':        kaiju_output_folder,
+                                 'biom2_out_folder': biom_output_folder,
+                                 'output_obj_names': biom_obj_names,
+                                 'timestamp_epoch':  time.time()
+                             }
+        commit_inputs = {'input_reads': replicate_names,
+                         'tax_levels': params['tax_levels'],
+                         'output_biom_name': params['output_biom_name']}
+        save_objs = []
+        save_obj_descs = []
+        if not self.checkpoint.is_complete('commit_objects', commit_inputs):
+            pipeline.add('biom', lambda: save_objs.extend(self.outputBuilder_client.generate_sparse_biom1_0_matrices(generate_biom_options)))
+            for tax_level in params['tax_levels']:
+                save_obj_descs.append('Kaiju Taxonomic Classification at '+tax_level+' Level.  BIOM format')
+
+        pipeline.wait()
+
+
+        # 10) commit outputs: one batched workspace save, concurrent with packaging and upload of the zips
+        input_refs = params['input_refs']
+        if not isinstance(input_refs, list):
+            input_refs = [input_refs]
+        input_refs = list(input_refs)  # sets, and their member libraries
+        for input_reads_item in expanded_input:
+            input_refs.append(input_reads_item['ref'])
+
+        def commit_objects():
+            obj_refs = self.outputBuilder_client.save_workspace_objects(self.ctx, params['workspace_name'], save_objs, input_refs)
+            objects_created = []
+            for obj_ref,obj_desc in zip(obj_refs, save_obj_descs):
+                objects_created.append({'ref': obj_ref,
+                                        'description': obj_desc})
+            return objects_created
+
+        commit_pool = ThreadPool(1)
+        try:
+            commit_result = commit_pool.apply_async(self.checkpoint.run_stage,
+                                                    ('commit_objects', commit_inputs, commit_objects))
+
+            # package results (plots in both the outputs and the report are stored once)
+            self.outputBuilder_client.artifacts.log_usage([output_dir, html_dir])
+            output_packages = self.checkpoint.run_stage('package',
+                                                        {'input_reads': replicate_names},
+                                                        lambda: self._build_output_packages(params, self.outputBuilder_client))
+
+            # build the HTML report
+            #report_html_file = 'kaiju_html_plots.zip'  # fails
+            #report_html_file = 'kaiju_plots.html'  # fails
+            report_html_file = html_pages[0]['local_path']  # works
+            report_html_desc = 'Kaiju abundance and Krona plots'
+
+            html_zipped = self.checkpoint.run_stage('html_report',
+                                                    {'input_reads': replicate_names},
+                                                    lambda: self.outputBuilder_client.package_folder(html_dir, report_html_file, report_html_desc))
+
+            objects_created = commit_result.get()
+        finally:
+            commit_pool.close()
+            commit_pool.join()
+
+
+        # 11) save report
         report_params = {'message': '',
-                         #'objects_created': generated_biom_objs,
-                         'objects_created': [],
+                         'objects_created': objects_created,
                          'direct_html_link_index': 0,
                          'html_links': [html_zipped],
                          'file_links': output_packages,
@@ -242,28 +437,6 @@ class KaijuUtil:
         return returnVal
 
 
-    def run_proc(self, command, log_output_file=None):
-        log('Running: ' + ' '.join(command))
-
-        if log_output_file:  # if output is too chatty for STDOUT
-            open (log_output_file, 'w')
-            p = subprocess.Popen(command, cwd=self.scratch, shell=False, stdout=log_output_file, stderr=subprocess.STDOUT)
-        else:
-            p = subprocess.Popen(command, cwd=self.scratch, shell=False)
-        exitCode = p.wait()
-
-        if log_output_file:
-            log_output_file.close()
-
-        if (exitCode == 0):
-            log('Executed command: ' + ' '.join(command) + '\n' +
-                'Exit Code: ' + str(exitCode))
-        else:
-            raise ValueError('Error running command: ' + ' '.join(command) + '\n' +
-                             'Exit Code: ' + str(exitCode))
-        return exitCode
-
-
     def validate_run_kaiju_with_krona_params(self, params):
         method = 'run_kaiju_with_krona'
 
@@ -298,7 +471,10 @@ class KaijuUtil:
                               'subsample_replicates': 1,
                               'subsample_seed': int(self.suffix),
                               'filter_unclassified': 1,
-                              'full_tax_path': 0
+                              'full_tax_path': 0,
+                              'combined_krona': 0,
+                              'output_biom_name': 'kaiju_abundance.BIOM',
+                              'resume': 0
                           }
         for arg in default_param_vals.keys():
             if arg not in params or params[arg] == None or params[arg] == '':
@@ -344,8 +520,36 @@ class KaijuUtil:
     def run_kaiju_batch(self, options, dropOutput=False):
         new_expanded_input = []
 
+        # classification of a library is checkpointed once all of its replicates are classified
+        classify_inputs = dict((opt, options.get(opt)) for opt in ['subsample_percent',
+                                                                     'subsample_replicates',
+                                                                     'subsample_seed',
+                                                                     'db_type',
+                                                                     'seg_filter',
+                                                                     'min_match_length',
+                                                                     'greedy_run_mode',
+                                                                     'greedy_allowed_mismatches',
+                                                                     'greedy_min_match_score'])
+
+        # what each kaiju process needs, for admission by the resource governor
+        kaiju_ram = self.db_registry.get(options['db_type']).ram_estimate
+        kaiju_cpus = int(self.threads or 1)
+        kaiju_timeout = int(self.config.get('classification-timeout-secs') or 0)
+
         input_reads = options['input_reads']
         for input_reads_item in input_reads:
+            # a failed task elsewhere in the run cancels it: don't stage libraries that won't be classified
+            if self.tool_runner.cancelled:
+                log('run cancelled, not staging '+input_reads_item['name'])
+                break
+
+            classify_stage = 'classify-'+input_reads_item['name']
+            if self.checkpoint.is_complete(classify_stage, classify_inputs):
+                log('RESUMING: skipping already classified library '+input_reads_item['name'])
+                new_expanded_input.extend(self.checkpoint.get_result(classify_stage))
+                if options.get('on_library_classified') is not None:
+                    options['on_library_classified'](self.checkpoint.get_result(classify_stage))
+                continue
 
             # download and subsample reads
             staged_input = self.dsu_client.stage_input(input_item =           input_reads_item,
@@ -357,7 +561,13 @@ class KaijuUtil:
             replicate_input = staged_input['replicate_input']
             new_expanded_input.extend(replicate_input)  # revise expanded input to replicates
 
-            # run for each replicate
+            on_classified = self._get_classify_checkpoint_callback(classify_stage,
+                                                                   classify_inputs,
+                                                                   replicate_input,
+                                                                   options['out_folder'],
+                                                                   options.get('on_library_classified'))
+
+            # queue each replicate on the classification backend
             for input_reads_item_replicate in replicate_input:
                 single_kaiju_run_options = options
                 single_kaiju_run_options['input_item'] = input_reads_item_replicate
@@ -366,21 +576,68 @@ class KaijuUtil:
 
                 log_output_file = None
                 if dropOutput:  # if output is too chatty for STDOUT
-                    log_output_file = os.path.join(self.scratch, input_reads_item['name'] + '.kaiju' + '.stdout')
-
-                command = self._build_kaiju_command(single_kaiju_run_options)
-                self.run_proc (command, log_output_file)
+                    log_output_file = os.path.join(self.scratch, input_reads_item_replicate['name'] + '.kaiju' + '.stdout')
 
-                # remove input file to free up disk
-                os.remove(input_reads_item_replicate['fwd_file'])
+                # remove input file to free up disk once classified
+                cleanup_files = [input_reads_item_replicate['fwd_file']]
                 if input_reads_item_replicate['type'] == self.PE_flag:
-                    os.remove(input_reads_item_replicate['rev_file'])
+                    cleanup_files.append(input_reads_item_replicate['rev_file'])
+
+                command = self._build_kaiju_command(single_kaiju_run_options)
+                self.classification_backend.submit({'name':          input_reads_item_replicate['name'],
+                                                    'command':       command,
+                                                    'log_file':      log_output_file,
+                                                    'cleanup_files': cleanup_files,
+                                                    'ram':           kaiju_ram,
+                                                    'cpus':          kaiju_cpus,
+                                                    'timeout':       kaiju_timeout
+                                                },
+                                                   callback=on_classified)
+
+        # wait for all classifications to finish
+        self.classification_backend.wait()
+        if self.tool_runner.cancelled:
+            raise ValueError ('Cancelled classification of '+', '.join([input_reads_item['name'] for input_reads_item in input_reads]))
 
         return new_expanded_input
 
 
+    def _get_classify_checkpoint_callback(self, classify_stage, classify_inputs, replicate_input, out_folder,
+                                          on_library_classified=None):
+        '''
+        Returns a backend callback that records the library's classify stage
+        once the last of its replicates has been classified, then passes its
+        replicates to on_library_classified
+        '''
+        lock = threading.Lock()
+        unfinished = set([replicate['name'] for replicate in replicate_input])
+
+        def on_classified(task):
+            with lock:
+                unfinished.discard(task['name'])
+                if len(unfinished) > 0:
+                    return
+            kaiju_files = [os.path.join(out_folder, replicate['name']+'.kaiju') for replicate in replicate_input]
+            self.checkpoint.mark_complete(classify_stage, classify_inputs, kaiju_files, replicate_input)
+            if on_library_classified is not None:
+                on_library_classified(replicate_input)
+
+        return on_classified
+
+
+    def _get_resume_suffix(self, params):
+        '''
+        Stable folder suffix for a set of run params, so a rerun of an interrupted job finds its output
+        '''
+        run_params = dict((k, v) for (k, v) in params.items() if k != 'resume')
+        run_key = hashlib.md5(json.dumps(run_params, sort_keys=True).encode('utf-8')).hexdigest()
+        return str(int(run_key[:12], 16))
+
+
     def run_kaijuReport_batch(self, options, dropOutput=False):
         input_reads = options['input_reads']
+        kaijuReport_ram = self.db_registry.get(options['db_type']).table_ram_estimate
+        tasks = []
         for input_reads_item in input_reads:
             for tax_level in options['tax_levels']:
                 single_kaijuReport_run_options = options
@@ -389,10 +646,14 @@ class KaijuUtil:
 
                 log_output_file = None
                 if dropOutput:  # if output is too chatty for STDOUT
-                    log_output_file = os.path.join(self.scratch, input_reads_item['name'] + '.kaijuReport' + '.stdout')
+                    log_output_file = os.path.join(self.scratch, input_reads_item['name'] + '-' + tax_level + '.kaijuReport' + '.stdout')
 
+                # all at once, as many as the governor admits
                 command = self._build_kaijuReport_command(single_kaijuReport_run_options)
-                self.run_proc (command, log_output_file)
+                tasks.append(self.tool_runner.start(command, log_file=log_output_file, ram=kaijuReport_ram,
+                                                    name='kaiju2table '+input_reads_item['name']+' '+tax_level,
+                                                    light=True))
+        self.tool_runner.wait(tasks)
 
 
     def run_kaijuReportPlots_batch(self, options):
@@ -400,6 +661,7 @@ class KaijuUtil:
         per_sample_plot_files   = dict()
         stacked_bar_plot_files  = dict()
         stacked_area_plot_files = dict()
+        stacked_plot_key_lengths = dict()
 
         for tax_level in options['tax_levels']:
 
@@ -429,9 +691,14 @@ class KaijuUtil:
                 kaijuReportPlots_options['plot_type'] = 'area'
                 stacked_area_plot_files[tax_level] = self.outputBuilder_client.generate_kaijuReport_StackedPlots(kaijuReportPlots_options)
 
+            # key length, for sizing the plot images in the report
+            if 'stacked_bar_plots_out_folder' in options or 'stacked_area_plots_out_folder' in options:
+                stacked_plot_key_lengths[tax_level] = self.outputBuilder_client.get_kaijuReport_StackedPlots_key_length(kaijuReportPlots_options)
+
         return {'per_sample_plot_files': per_sample_plot_files,
                 'stacked_bar_plot_files': stacked_bar_plot_files,
-                'stacked_area_plot_files': stacked_area_plot_files
+                'stacked_area_plot_files': stacked_area_plot_files,
+                'stacked_plot_key_lengths': stacked_plot_key_lengths
             }
 
 
@@ -439,24 +706,34 @@ class KaijuUtil:
         out_html_folder = options['out_folder']
         out_html_files = dict()
 
+        # plots drawn in the browser from the plot data
+        if 'plot_data_file' in options:
+            for plot_type in options['plot_types']:
+                out_html_files[plot_type] = self.outputBuilder_client.build_html_for_kaijuReport_StackedPlotsViewer(
+                    out_html_folder,
+                    plot_type,
+                    options['plot_data_file'],
+                    html_pages=options.get('html_pages')
+                )
+
         if 'stacked_bar_plot_files' in options:
             out_html_files['bar'] = self.outputBuilder_client.build_html_for_kaijuReport_StackedPlots(
-                options['input_reads'],
-                options['summary_folder'],
                 out_html_folder,
                 'bar',
                 options['tax_levels'],
-                options['stacked_bar_plot_files']
+                options['stacked_bar_plot_files'],
+                key_lengths=options.get('stacked_plot_key_lengths'),
+                html_pages=options.get('html_pages')
             )
 
         if 'stacked_area_plot_files' in options:
             out_html_files['area'] = self.outputBuilder_client.build_html_for_kaijuReport_StackedPlots(
-                options['input_reads'],
-                options['summary_folder'],
                 out_html_folder,
                 'area',
                 options['tax_levels'],
-                options['stacked_area_plot_files']
+                options['stacked_area_plot_files'],
+                key_lengths=options.get('stacked_plot_key_lengths'),
+                html_pages=options.get('html_pages')
             )
 
         if 'per_sample_plot_files' in options:
@@ -472,44 +749,104 @@ class KaijuUtil:
 
 
     def run_krona_batch(self, options, dropOutput=False):
-        out_html_files = []
+        self.run_kronaText_batch(options)
+        return self.run_kronaImport_batch(options, dropOutput)
+
+
+    def run_kronaText_batch(self, options):
         input_reads = options['input_reads']
         for input_reads_item in input_reads:
 
-            # kaiju2krona
+            # krona text export (in process, replaces kaiju2krona)
             single_kaiju2krona_run_options = options
             single_kaiju2krona_run_options['input_item'] = input_reads_item
+            self._validate_kaiju2krona_options(single_kaiju2krona_run_options)
 
-            log_output_file = None
-            if dropOutput:  # if output is too chatty for STDOUT
-                log_output_file = os.path.join(self.scratch, input_reads_item['name'] + '.kaiju2krona' + '.stdout')
+            in_path = os.path.join(options['in_folder'], input_reads_item['name']+'.kaiju')
+            out_path = os.path.join(options['out_folder'], input_reads_item['name']+'.krona')
+            log('Exporting krona text: '+out_path)
+            self.outputBuilder_client.write_krona_text(in_path, options['db_type'], out_path)
 
-            command = self._build_kaiju2krona_command(single_kaiju2krona_run_options)
-            self.run_proc (command, log_output_file)
 
-            # kronaImport
-            single_kronaImport_run_options = options
-            single_kronaImport_run_options['input_item'] = input_reads_item
+    def run_kronaImport_batch(self, options, dropOutput=False):
+        out_html_files = []
+        input_reads = options['input_reads']
+
+        # kronaImport, either one chart per sample or one chart with every sample as a dataset
+        if options.get('combined_krona'):
+            kronaImport_batches = [input_reads]
+        else:
+            kronaImport_batches = [[input_reads_item] for input_reads_item in input_reads]
+
+        tasks = []
+        for kronaImport_batch in kronaImport_batches:
+            kronaImport_run_options = options
+            kronaImport_run_options['input_items'] = kronaImport_batch
+
+            html_page = self._get_krona_html_page(options['html_folder'], kronaImport_batch, options.get('combined_krona'))
 
             log_output_file = None
             if dropOutput:  # if output is too chatty for STDOUT
-                log_output_file = os.path.join(self.scratch, input_reads_item['name'] + '.kronaImport' + '.stdout')
+                log_output_file = os.path.join(self.scratch, html_page['local_path'] + '.kronaImport' + '.stdout')
 
-            command = self._build_kronaImport_command(single_kronaImport_run_options)
-            self.run_proc (command, log_output_file)
+            # all at once, as many as the governor admits
+            command = self._build_kronaImport_command(kronaImport_run_options)
+            krona_text_size = sum([os.path.getsize(os.path.join(options['out_folder'], input_item['name']+'.krona')) for input_item in kronaImport_batch])
+            tasks.append(self.tool_runner.start(command, log_file=log_output_file,
+                                                ram=KRONA_BASE_RAM_BYTES + KRONA_RAM_FACTOR*krona_text_size,
+                                                name='ktImportText '+html_page['local_path'],
+                                                light=True))
 
             # return file info
-            local_html_path = input_reads_item['name']+'.krona.html'
-            html_path = os.path.join (options['html_folder'], local_html_path)
-            out_html_files.append({'type': 'krona',
-                                   'name': input_reads_item['name']+' Krona',
-                                   'local_path': local_html_path,
-                                   'abs_path': html_path
-                               })
+            out_html_files.append(html_page)
+
+        self.tool_runner.wait(tasks)
+
+        # add top nav by patching just the header of the krona pages
+        if options.get('html_pages') is not None:
+            for html_page in out_html_files:
+                self.outputBuilder_client.insert_top_nav(html_page, options['html_pages'])
 
         return out_html_files
 
 
+    def _plan_html_pages(self, html_folder, build_area_plots_flag, input_reads, combined_krona=False):
+        '''
+        The html pages of the report, in top nav order.  Must match what the
+        page builders write.
+        '''
+        html_pages = []
+        plot_types = ['bar']
+        if build_area_plots_flag:
+            plot_types.append('area')
+        for plot_type in plot_types:
+            html_pages.append({'type': plot_type,
+                               'name': plot_type.title(),
+                               'local_path': plot_type+'.html',
+                               'abs_path': os.path.join (html_folder, plot_type+'.html')
+                           })
+        if combined_krona:
+            html_pages.append(self._get_krona_html_page(html_folder, input_reads, combined_krona))
+        else:
+            for input_reads_item in input_reads:
+                html_pages.append(self._get_krona_html_page(html_folder, [input_reads_item]))
+        return html_pages
+
+
+    def _get_krona_html_page(self, html_folder, input_items, combined_krona=False):
+        if combined_krona:
+            local_html_path = 'krona.html'
+            name = 'Krona'
+        else:
+            local_html_path = input_items[0]['name']+'.krona.html'
+            name = input_items[0]['name']+' Krona'
+        return {'type': 'krona',
+                'name': name,
+                'local_path': local_html_path,
+                'abs_path': os.path.join (html_folder, local_html_path)
+            }
+
+
     def _validate_kaiju_options(self, options):
         # 1st order required
         func_name = 'kaiju'
@@ -588,33 +925,13 @@ class KaijuUtil:
     def _build_kaiju_command(self, options, verbose=True):
         KAIJU_BIN_DIR  = os.path.join(os.path.sep, 'kb', 'module', 'kaiju', 'bin')
         KAIJU_BIN      = os.path.join(KAIJU_BIN_DIR, 'kaiju')
-        KAIJU_DB_DIR   = os.path.join(os.path.sep, 'data', 'kaijudb', options['db_type'])
+        kaiju_db       = self.db_registry.get(options['db_type'])
 
         options['verbose'] = verbose
         if self.threads and self.threads > 1:
             options['threads'] = self.threads
-        options['KAIJU_DB_NODES'] = os.path.join(KAIJU_DB_DIR, 'nodes.dmp')
-        #options['KAIJU_DB_NAMES'] = os.path.join(KAIJU_DB_DIR, 'names.dmp')  # don't need for kaiju cmd
-        print('db_type')
-        if options['db_type'] == 'refseq':
-            options['KAIJU_DB_PATH'] = os.path.join(KAIJU_DB_DIR, 'kaiju_db_refseq.fmi')
-        elif options['db_type'] == 'progenomes':
-            options['KAIJU_DB_PATH'] = os.path.join(KAIJU_DB_DIR, 'kaiju_db_progenomes.fmi')
-        elif options['db_type'] == 'nr':
-            options['KAIJU_DB_PATH'] = os.path.join(KAIJU_DB_DIR, 'kaiju_db_nr.fmi')
-        elif options['db_type'] == 'nr_euk':
-            options['KAIJU_DB_PATH'] = os.path.join(KAIJU_DB_DIR, 'kaiju_db_nr_euk.fmi')
-        elif options['db_type'] == 'viruses':
-            options['KAIJU_DB_PATH'] = os.path.join(KAIJU_DB_DIR, 'kaiju_db_viruses.fmi')
-        elif options['db_type'] == 'plasmids':
-            options['KAIJU_DB_PATH'] = os.path.join(KAIJU_DB_DIR, 'kaiju_db_plasmids.fmi')
-        elif options['db_type'] == 'rvdb':
-            options['KAIJU_DB_PATH'] = os.path.join(KAIJU_DB_DIR, 'kaiju_db_rvdb.fmi')
-        elif options['db_type'] == 'fungi':
-            options['KAIJU_DB_PATH'] = os.path.join(KAIJU_DB_DIR, 'kaiju_db_fungi.fmi')
-
-        else:
-            raise ValueError ('bad db_type: '+options['db_type']+' (must be one of "refseq", "progenomes", "nr", "nr_euk", "viruses", "plasmids", "rvdb", "fungi")')
+        options['KAIJU_DB_NODES'] = kaiju_db.nodes_file
+        options['KAIJU_DB_PATH']  = kaiju_db.fmi_file
 
         self._validate_kaiju_options(options)
         command = [KAIJU_BIN]
@@ -679,10 +996,10 @@ class KaijuUtil:
     def _build_kaijuReport_command(self, options):
         KAIJU_BIN_DIR    = os.path.join(os.path.sep, 'kb', 'module', 'kaiju', 'bin')
         KAIJU_REPORT_BIN = os.path.join(KAIJU_BIN_DIR, 'kaiju2table')
-        KAIJU_DB_DIR     = os.path.join(os.path.sep, 'data', 'kaijudb', options['db_type'])
+        kaiju_db         = self.db_registry.get(options['db_type'])
 
-        options['KAIJU_DB_NODES'] = os.path.join(KAIJU_DB_DIR, 'nodes.dmp')
-        options['KAIJU_DB_NAMES'] = os.path.join(KAIJU_DB_DIR, 'names.dmp')
+        options['KAIJU_DB_NODES'] = kaiju_db.nodes_file
+        options['KAIJU_DB_NAMES'] = kaiju_db.names_file
 
         self._validate_kaijuReport_options(options)
         command = [KAIJU_REPORT_BIN]
@@ -708,52 +1025,17 @@ class KaijuUtil:
             raise ValueError ('missing or empty kaiju classification file: '+in_file)
 
         # db validation
-        DB = 'KAIJU_DB_NODES'
-        if not os.path.getsize(options[DB]) > 0:
-            raise ValueError ('missing or empty '+DB+' file: '+options[DB])
-        DB = 'KAIJU_DB_NAMES'
-        if not os.path.getsize(options[DB]) > 0:
-            raise ValueError ('missing or empty '+DB+' file: '+options[DB])
-
-
-    def _process_kaiju2krona_options(self, command_list, options):
-        if options.get('KAIJU_DB_NODES'):
-            command_list.append('-t')
-            command_list.append(str(options.get('KAIJU_DB_NODES')))
-        if options.get('KAIJU_DB_NAMES'):
-            command_list.append('-n')
-            command_list.append(str(options.get('KAIJU_DB_NAMES')))
-        if options.get('in_folder'):
-            in_file = options['input_item']['name']+'.kaiju'
-            in_path = os.path.join(options['in_folder'], in_file)
-            command_list.append('-i')
-            command_list.append(in_path)
-        if options.get('out_folder'):
-            out_file = options['input_item']['name']+'.krona'
-            out_path = os.path.join (str(options.get('out_folder')), out_file)
-            command_list.append('-o')
-            command_list.append(out_path)
-
-
-    def _build_kaiju2krona_command(self, options):
-        KAIJU_BIN_DIR     = os.path.join(os.path.sep, 'kb', 'module', 'kaiju', 'bin')
-        KAIJU_2_KRONA_BIN = os.path.join(KAIJU_BIN_DIR, 'kaiju2krona')
-        KAIJU_DB_DIR      = os.path.join(os.path.sep, 'data', 'kaijudb', options['db_type'])
-
-        options['KAIJU_DB_NODES'] = os.path.join(KAIJU_DB_DIR, 'nodes.dmp')
-        options['KAIJU_DB_NAMES'] = os.path.join(KAIJU_DB_DIR, 'names.dmp')
-
-        self._validate_kaiju2krona_options(options)
-        command = [KAIJU_2_KRONA_BIN]
-        self._process_kaiju2krona_options(command, options)
-        return command
+        kaiju_db = self.db_registry.get(options['db_type'])
+        for db_file in [kaiju_db.nodes_file, kaiju_db.names_file]:
+            if not os.path.getsize(db_file) > 0:
+                raise ValueError ('missing or empty taxonomy file: '+db_file)
 
 
     def _validate_kronaImport_options(self, options):
         # 1st order required
         func_name = 'kronaImport'
         required_opts = [ 'html_folder',
-                          'input_item',
+                          'input_items',
                           'out_folder',
                           'db_type'
                       ]
@@ -762,21 +1044,25 @@ class KaijuUtil:
                 raise ValueError ("Must define required opt: '"+opt+"' for func: '"+str(func_name)+"()'")
 
         # input file validation
-        in_file = os.path.join(options['out_folder'], options['input_item']['name']+'.krona')
-        if not os.path.getsize(in_file) > 0:
-            raise ValueError ('missing or empty krona input file (your filters may be too strict): {}'.format(in_file))
+        for input_item in options['input_items']:
+            in_file = os.path.join(options['out_folder'], input_item['name']+'.krona')
+            if not os.path.getsize(in_file) > 0:
+                raise ValueError ('missing or empty krona input file (your filters may be too strict): {}'.format(in_file))
 
 
     def _process_kronaImport_options(self, command_list, options):
         if options.get('html_folder'):
-            html_file = options['input_item']['name']+'.krona.html'
-            html_path = os.path.join (str(options.get('html_folder')), html_file)
+            html_page = self._get_krona_html_page(options['html_folder'], options['input_items'], options.get('combined_krona'))
             command_list.append('-o')
-            command_list.append(html_path)
+            command_list.append(html_page['abs_path'])
         if options.get('out_folder'):
-            in_file = options['input_item']['name']+'.krona'
-            in_path = os.path.join(options['out_folder'], in_file)
-            command_list.append(in_path)
+            for input_item in options['input_items']:
+                in_file = input_item['name']+'.krona'
+                in_path = os.path.join(options['out_folder'], in_file)
+                if options.get('combined_krona'):
+                    # ktImportText takes <file>,<dataset name>, so no commas in the name
+                    in_path += ','+input_item['name'].replace(',', '_')
+                command_list.append(in_path)
 
 
     def _build_kronaImport_command(self, options):
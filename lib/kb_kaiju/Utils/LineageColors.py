@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import hashlib
+
+import matplotlib.colors as mcolors
+
+
+# named colors, leaving out light ones
+NO_LIGHT_COLOR_NAMES = [
+    #'aliceblue',
+    'aqua',
+    'aquamarine',
+    #'azure',
+    #'beige',
+    #'bisque',
+    #'blanchedalmond',
+    'blue',
+    'blueviolet',
+    'brown',
+    'burlywood',
+    'cadetblue',
+    'chartreuse',
+    'chocolate',
+    'coral',
+    'cornflowerblue',
+    #'cornsilk',
+    'crimson',
+    #'cyan',     # same as aqua
+    'darkblue',
+    'darkcyan',
+    'darkgoldenrod',
+    'darkgreen',
+    'darkkhaki',
+    'darkmagenta',
+    'darkolivegreen',
+    'darkorange',
+    'darkorchid',
+    'darkred',
+    'darksalmon',
+    'darkseagreen',
+    'darkslateblue',
+    #'darkslategray',
+    'darkturquoise',
+    'darkviolet',
+    'deeppink',
+    'deepskyblue',
+    'dodgerblue',
+    'firebrick',
+    'forestgreen',
+    'fuchsia',
+    #'gainsboro',
+    'gold',
+    'goldenrod',
+    'green',
+    'greenyellow',
+    #'honeydew',
+    'hotpink',
+    'indianred',
+    'indigo',
+    'khaki',
+    #'lavender',
+    #'lavenderblush',
+    'lawngreen',
+    #'lemonchiffon',
+    'lightblue',
+    #'lightcoral',
+    #'lightcyan'
+    #'lightgoldenrodyellow',
+    'lightgreen',
+    'lightpink',
+    'lightsalmon',
+    'lightseagreen',
+    'lightskyblue',
+    #'lightslategray',
+    #'lightsteelblue',
+    #'lightyellow',
+    'lime',
+    'limegreen',
+    #'magenta',   # magenta reserved for viruses
+    'maroon',
+    'mediumaquamarine',
+    'mediumblue',
+    'mediumorchid',
+    'mediumpurple',
+    'mediumseagreen',
+    'mediumslateblue',
+    'mediumspringgreen',
+    'mediumturquoise',
+    'mediumvioletred',
+    'midnightblue',
+    #'mintcream',
+    #'mistyrose',
+    #'moccasin',
+    'navy',
+    #'oldlace',
+    'olive',
+    'olivedrab',
+    'orange',
+    'orangered',
+    'orchid',
+    #'palegoldenrod',
+    'palegreen',
+    'paleturquoise',
+    'palevioletred',
+    #'papayawhip',
+    'peachpuff',
+    #'peru',
+    'pink',
+    'plum',
+    'powderblue',
+    'purple',
+    'red',
+    'rosybrown',
+    'royalblue',
+    'saddlebrown',
+    'salmon',
+    'sandybrown',
+    'seagreen',
+    #'seashell',
+    'sienna',
+    'skyblue',
+    'slateblue',
+    'springgreen',
+    'steelblue',
+    #'tan',
+    'teal',
+    #'thistle',
+    'tomato',
+    'turquoise',
+    'violet',
+    #'wheat',
+    #'yellow',
+    #'yellowgreen'
+]
+
+# the tail, viruses and unassigned buckets always get these
+SPECIAL_BUCKET_COLORS = [('tail (<',        'lightslategray'),
+                         ('viruses',        'magenta'),
+                         ('unassigned at',  'darkslategray')
+                     ]
+
+
+class LineageColors(object):
+    '''
+    Maps lineage names to colors from a fixed palette.  Each name starts at
+    the palette slot of a stable hash (md5, not hash(), which is salted per
+    process), and the names of one figure are placed in sorted order, each
+    moving on to the next slot no other name in the figure has taken.  So a
+    figure never shows two taxa in one color until the palette runs out, and
+    a taxon keeps its color across samples, plot types and runs unless it
+    collides.  Holds no state beyond the palette, so it can be shared by
+    concurrent renderers.
+    '''
+
+    def __init__(self, color_names=NO_LIGHT_COLOR_NAMES):
+        self.palette_names = list(color_names)
+        self.palette_rgba = mcolors.colorConverter.to_rgba_array(self.palette_names)
+        self.special_rgba = [(prefix, mcolors.colorConverter.to_rgba(color_name))
+                             for (prefix, color_name) in SPECIAL_BUCKET_COLORS]
+
+
+    def _get_special_rgba(self, label):
+        for (prefix, rgba) in self.special_rgba:
+            if label.startswith(prefix):
+                return rgba
+        return None
+
+
+    def _get_hash_slot(self, label):
+        if not isinstance(label, bytes):
+            label = label.encode('utf-8')
+        digest = hashlib.md5(label).hexdigest()
+        return int(digest[:8], 16) % len(self.palette_rgba)
+
+
+    def _get_rgba_by_label(self, labels):
+        '''
+        Color of each of the labels of one figure, by label
+        '''
+        rgba_by_label = dict()
+        palette_size = len(self.palette_rgba)
+        used_slots = set()
+        for label in sorted(set(labels)):
+            special_rgba = self._get_special_rgba(label)
+            if special_rgba is not None:
+                rgba_by_label[label] = special_rgba
+                continue
+            # more labels than colors: start over, repeats are unavoidable
+            if len(used_slots) == palette_size:
+                used_slots = set()
+            slot = self._get_hash_slot(label)
+            while slot in used_slots:
+                slot = (slot + 1) % palette_size
+            used_slots.add(slot)
+            rgba_by_label[label] = tuple(self.palette_rgba[slot])
+        return rgba_by_label
+
+
+    def get_colors(self, labels):
+        '''
+        RGBA array, one row per label, for the labels of one figure
+        '''
+        rgba_by_label = self._get_rgba_by_label(labels)
+        return mcolors.colorConverter.to_rgba_array([rgba_by_label[label] for label in labels])
+
+
+    def get_hex_colors(self, labels):
+        rgba_by_label = self._get_rgba_by_label(labels)
+        return [mcolors.rgb2hex(rgba_by_label[label][:3]) for label in labels]
+
+
+lineage_colors = LineageColors()
+
+
+def get_lineage_colors():
+    '''
+    The shared color map
+    '''
+    return lineage_colors
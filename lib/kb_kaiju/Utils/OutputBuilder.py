@@ -1,21 +1,29 @@
 import os
 import shutil
 import ast
+import copy
 import sys
 import time
 import re
+import json
+import threading
 
 from datetime import datetime as dt
 import pytz
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
-import random
-from random import shuffle
+from matplotlib.collections import PolyCollection
 
 from biokbase.workspace.client import Workspace as workspaceService
 #from Workspace.WorkspaceClient import Workspace as workspaceService
 from DataFileUtil.DataFileUtilClient import DataFileUtil
+from kb_kaiju.Utils.BiomTable import BiomTable
+from kb_kaiju.Utils.KaijuTaxonomy import KaijuTaxonomy
+from kb_kaiju.Utils.KaijuDBRegistry import get_db_registry
+from kb_kaiju.Utils.LineageColors import get_lineage_colors
+from kb_kaiju.Utils.ImageOutputPolicy import ImageOutputPolicy
+from kb_kaiju.Utils.ArtifactManager import ArtifactManager
 
 
 def log(message, prefix_newline=False):
@@ -31,16 +39,27 @@ class OutputBuilder(object):
     modifying the Krona HTML to offer tabbed href links between html pages
     '''
 
-    def __init__(self, output_folders, scratch_dir, callback_url, workspace_url):
+    # lets a resumed run replace rather than repeat the nav
+    TOP_NAV_MARKER = '<!-- kb_kaiju top nav -->'
+
+    # stacked plot keys list this many of the most abundant taxa (plus the tail,
+    # viruses and unassigned buckets), as thousands of species won't fit anyway
+    KEY_TOP_K = 50
+
+    # report-plots = js: plot data and the viewer that draws it
+    PLOT_DATA_FILE = 'stacked_plot_data.json'
+    PLOT_VIEWER_JS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'html', 'stacked_plots.js')
+
+    def __init__(self, output_folders, scratch_dir, callback_url, workspace_url, image_policy=None, artifact_manager=None):
         self.output_folders = output_folders
         self.scratch = scratch_dir
         self.callback_url = callback_url
         self.workspace_url = workspace_url
         self.wsClient = None
 
-        # store Kaiju DBs
-        self.NODES_DB = None
-        self.NAMES_DB = None
+        # store Kaiju DB taxonomies
+        self.taxonomy_by_db = dict()
+        self.taxonomy_lock = threading.Lock()
 
         # store species counts by sample
         self.species_abundance_by_sample = dict()
@@ -48,133 +67,21 @@ class OutputBuilder(object):
         # store parsed info
         self.parsed_summary = dict()
 
-        # leave out light colors
-        self.no_light_color_names = [
-            #'aliceblue',
-            'aqua',
-            'aquamarine',
-            #'azure',
-            #'beige',
-            #'bisque',
-            #'blanchedalmond',
-            'blue',
-            'blueviolet',
-            'brown',
-            'burlywood',
-            'cadetblue',
-            'chartreuse',
-            'chocolate',
-            'coral',
-            'cornflowerblue',
-            #'cornsilk',
-            'crimson',
-            'cyan',
-            'darkblue',
-            'darkcyan',
-            'darkgoldenrod',
-            'darkgreen',
-            'darkkhaki',
-            'darkmagenta',
-            'darkolivegreen',
-            'darkorange',
-            'darkorchid',
-            'darkred',
-            'darksalmon',
-            'darkseagreen',
-            'darkslateblue',
-            #'darkslategray',
-            'darkturquoise',
-            'darkviolet',
-            'deeppink',
-            'deepskyblue',
-            'dodgerblue',
-            'firebrick',
-            'forestgreen',
-            'fuchsia',
-            #'gainsboro',
-            'gold',
-            'goldenrod',
-            'green',
-            'greenyellow',
-            #'honeydew',
-            'hotpink',
-            'indianred',
-            'indigo',
-            'khaki',
-            #'lavender',
-            #'lavenderblush',
-            'lawngreen',
-            #'lemonchiffon',
-            'lightblue',
-            #'lightcoral',
-            #'lightcyan'
-            #'lightgoldenrodyellow',
-            'lightgreen',
-            'lightpink',
-            'lightsalmon',
-            'lightseagreen',
-            'lightskyblue',
-            #'lightslategray',
-            #'lightsteelblue',
-            #'lightyellow',
-            'lime',
-            'limegreen',
-            #'magenta',   # magenta reserved for viruses
-            'maroon',
-            'mediumaquamarine',
-            'mediumblue',
-            'mediumorchid',
-            'mediumpurple',
-            'mediumseagreen',
-            'mediumslateblue',
-            'mediumspringgreen',
-            'mediumturquoise',
-            'mediumvioletred',
-            'midnightblue',
-            #'mintcream',
-            #'mistyrose',
-            #'moccasin',
-            'navy',
-            #'oldlace',
-            'olive',
-            'olivedrab',
-            'orange',
-            'orangered',
-            'orchid',
-            #'palegoldenrod',
-            'palegreen',
-            'paleturquoise',
-            'palevioletred',
-            #'papayawhip',
-            'peachpuff',
-            #'peru',
-            'pink',
-            'plum',
-            'powderblue',
-            'purple',
-            'red',
-            'rosybrown',
-            'royalblue',
-            'saddlebrown',
-            'salmon',
-            'sandybrown',
-            'seagreen',
-            #'seashell',
-            'sienna',
-            'skyblue',
-            'slateblue',
-            'springgreen',
-            'steelblue',
-            #'tan',
-            'teal',
-            #'thistle',
-            'tomato',
-            'turquoise',
-            'violet',
-            #'wheat',
-            #'yellow',
-            #'yellowgreen'
-        ]
+        # store stacked plots prepared for rendering, by tax level
+        self.prepared_figures = dict()
+
+        # lineage colors, the same in every plot
+        self.lineage_colors = get_lineage_colors()
+
+        # format and compression of report plot images
+        self.image_policy = image_policy
+        if self.image_policy is None:
+            self.image_policy = ImageOutputPolicy()
+
+        # plots and page assets shared between the output folders and the report
+        self.artifacts = artifact_manager
+        if self.artifacts is None:
+            self.artifacts = ArtifactManager()
 
 
     def package_folder(self, folder_path, zip_file_name, zip_file_description):
@@ -194,63 +101,107 @@ class OutputBuilder(object):
                 'label': zip_file_description}
 
 
-    def generate_sparse_biom1_0_matrix(self, ctx, options):
-        tax_level       = options['tax_level']
-        db_type         = options['db_type']
-        input_reads     = options['input_reads']
-        in_folder       = options['in_folder']
-        workspace_name  = options['workspace_name']
-        output_obj_name = options['output_obj_name']
-        timestamp_epoch = options['timestamp_epoch']
+    def generate_sparse_biom1_0_matrices(self, options):
+        '''
+        Build a biom-1.0 Communities.Biom object for every tax level, from one
+        scan of each sample's classification file.  Returns the workspace
+        object specs, in tax_levels order, for save_workspace_objects().
+        '''
+        tax_levels       = options['tax_levels']
+        db_type          = options['db_type']
+        input_reads      = options['input_reads']
+        in_folder        = options['in_folder']
+        output_obj_names = options['output_obj_names']
+        timestamp_epoch  = options['timestamp_epoch']
+
+        biom_tables = dict()
+        for tax_level in tax_levels:
+            biom_tables[tax_level] = BiomTable()
 
-        abundance_matrix = []
-        abundance_by_sample = []
-        lineage_seen = dict()
-        lineage_order = []
-        #extra_bucket_order = []
-        sample_order = []
-        #classified_frac = []
-        biom_obj = dict()
+        # parse kaiju classification files once and roll up raw count abundance to every tax level, as COO arrays
+        for input_reads_item in input_reads:
+            this_classification_file = os.path.join (in_folder, input_reads_item['name']+'.kaiju')
+            abundance_by_level = self._rollup_kaiju_classification_file (this_classification_file, tax_levels, db_type)
+            for tax_level in tax_levels:
+                biom_tables[tax_level].add_sample(input_reads_item['name'], abundance_by_level[tax_level])
 
+        # build biom objs
+        timestamp_iso = dt.fromtimestamp(timestamp_epoch,pytz.utc).strftime('%Y-%m-%d'+'T'+'%H:%M:%S')
+        save_objs = []
+        for tax_level in tax_levels:
+            biom_table = biom_tables[tax_level]
+            output_obj_name = output_obj_names[tax_level]
+            biom_obj = self._build_biom1_0_obj(biom_table, output_obj_name, timestamp_iso)
+
+            # also keep a local BIOM 2.1 (HDF5) copy if requested
+            if options.get('biom2_out_folder'):
+                biom_table.write_biom2_hdf5(os.path.join(options['biom2_out_folder'], output_obj_name+'.biom'),
+                                            output_obj_name,
+                                            table_type=biom_obj['type'],
+                                            generated_by=biom_obj['generated_by'],
+                                            timestamp_iso=timestamp_iso)
+
+            save_objs.append({ 'type': 'Communities.Biom',
+                               'data': biom_obj,
+                               'name': output_obj_name,
+                               'meta': {}
+                           })
+
+        return save_objs
+
+
+    def save_workspace_objects(self, ctx, workspace_name, save_objs, input_refs):
+        '''
+        Save all of a run's output objects in one save_objects call, sharing
+        one provenance that lists every input object.  Returns the saved
+        object refs, in save_objs order.
+        '''
+        if len(save_objs) == 0:
+            return []
 
-        # parse kaiju classification files and tally raw count abundance
-        for input_reads_item in input_reads:
-            sample_order.append(input_reads_item['name'])
+        provenance = [{}]
+        if 'provenance' in ctx:
+            provenance = copy.deepcopy(ctx['provenance'])
+        # add additional info to provenance here, in this case the input data object references
+        provenance[0]['input_ws_objects'] = []
+        for input_ref in input_refs:
+            if input_ref not in provenance[0]['input_ws_objects']:
+                provenance[0]['input_ws_objects'].append(input_ref)
+        provenance[0]['service'] = 'kb_kaiju'
+        provenance[0]['method'] = 'run_kaiju'
+        for save_obj in save_objs:
+            save_obj['provenance'] = provenance
 
-            this_classification_file = os.path.join (in_folder, input_reads_item['name']+'.kaiju')
-            (this_abundance_cnts, this_lineage_order) = self._parse_kaiju_classification_file (this_classification_file, tax_level, db_type)
-            for lineage_name in this_lineage_order:
-                if lineage_name not in lineage_seen:
-                    lineage_seen[lineage_name] = True
-                    #if lineage_name.startswith('tail (<') \
-                    #   or lineage_name.startswith('viruses') \
-                    #   or lineage_name.startswith('unassigned at'):
-                    #    #extra_bucket_order.append(lineage_name)
-                    #    continue
-                    #else:
-                    #    lineage_order.append(lineage_name)
-                    lineage_order.append(lineage_name)
-            abundance_by_sample.append(this_abundance_cnts)
-            #classified_frac.append(this_classified_frac)
+        if self.wsClient == None:
+            try:
+                self.wsClient = workspaceService(self.workspace_url, token=ctx['token'])
+            except:
+                raise ValueError ("Unable to connect to workspace service at workspace_url: "+self.workspace_url)
+        print ("SAVING "+str(len(save_objs))+" OBJECTS")
 
+        new_obj_infos = self.wsClient.save_objects({'workspace':workspace_name,
+                                                    'objects':save_objs
+                                                })
+        [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I, WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
+        obj_refs = []
+        for new_obj_info in new_obj_infos:
+            obj_refs.append(str(new_obj_info[WSID_I])+'/'+str(new_obj_info[OBJID_I])+'/'+str(new_obj_info[VERSION_I]))
+
+        return obj_refs
 
+
+    def _build_biom1_0_obj(self, biom_table, output_obj_name, timestamp_iso):
         # create sparse matrix (note: vals in each sample do not sum to 100% because we're dumping buckets)
-        biom_data = []
-        for lineage_i,lineage_name in enumerate(lineage_order):
-            for sample_i,sample_name in enumerate(sample_order):
-                if lineage_name in abundance_by_sample[sample_i]:
-                    biom_data.append([lineage_i, sample_i, abundance_by_sample[sample_i][lineage_name]])
+        biom_data = biom_table.to_biom1_0_data()
 
-        # build biom obj
-        shape = [len(lineage_order), len(sample_order)]
+        shape = biom_table.shape
         rows_struct = []
         cols_struct = []
-        timestamp_iso = dt.fromtimestamp(timestamp_epoch,pytz.utc).strftime('%Y-%m-%d'+'T'+'%H:%M:%S')
-        for lineage_name in lineage_order:
+        for lineage_name in biom_table.row_ids:
             # KBase BIOM typedef only supports string, not dict.  This is wrong (see format_url below)
             #rows_struct.append({'id': lineage_name, 'metadata': None})  # could add metadata full tax path if parsed from kaiju2table
             rows_struct.append(lineage_name)
-        for sample_name in sample_order:
+        for sample_name in biom_table.col_ids:
             # KBase BIOM typedef only supports string, not dict.  This is wrong (see format_url below)
             #cols_struct.append({'id': sample_name, 'metadata': None})  # sample metadata not provided to App
             cols_struct.append(sample_name)
@@ -273,40 +224,7 @@ class OutputBuilder(object):
         biom_obj['url'] = None
         biom_obj['matrix_element_value'] = None
 
-
-        # save the biom obj to workspace
-        provenance = [{}]
-        if 'provenance' in ctx:
-            provenance = ctx['provenance']
-        # add additional info to provenance here, in this case the input data object reference
-        provenance[0]['input_ws_objects'] = []
-        for input_reads_item in input_reads:
-            if input_reads_item['ref'] not in provenance[0]['input_ws_objects']:
-                provenance[0]['input_ws_objects'].append(input_reads_item['ref'])
-        provenance[0]['service'] = 'kb_kaiju'
-        provenance[0]['method'] = 'run_kaiju'
-
-        if self.wsClient == None:
-            try:
-                self.wsClient = workspaceService(self.workspace_url, token=ctx['token'])
-            except:
-                raise ValueError ("Unable to connect to workspace service at workspace_url: "+self.workspace_url)
-        print ("SAVING BIOM OBJECT")
-        #print (biom_obj)  # DEBUG
-
-        new_obj_info = self.wsClient.save_objects({'workspace':workspace_name,
-                                                   'objects':[
-                                                       { 'type': 'Communities.Biom',
-                                                         'data': biom_obj,
-                                                         'name': output_obj_name,
-                                                         'meta': {},
-                                                         'provenance': provenance
-                                                     }]
-                                               })[0]
-        [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I, WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
-        biom_obj_ref = str(new_obj_info[WSID_I])+'/'+str(new_obj_info[OBJID_I])+'/'+str(new_obj_info[VERSION_I])
-
-        return biom_obj_ref
+        return biom_obj
 
 
     def generate_kaijuReport_PerSamplePlots(self, options):
@@ -314,6 +232,59 @@ class OutputBuilder(object):
 
     def generate_kaijuReport_StackedPlots(self, options):
         tax_level = options['tax_level']
+        figure_spec = self._get_stacked_figure_spec(options)
+
+        # make plots
+        if options['plot_type'] == 'bar':
+            basename_ext = '-stacked_bar_plot'
+            return self._create_bar_plots (out_folder = options['stacked_plots_out_folder'],
+                                           out_file_basename = tax_level+basename_ext,
+                                           figure_spec = figure_spec)
+        elif options['plot_type'] == 'area':
+            basename_ext = '-stacked_area_plot'
+            return self._create_area_plots (out_folder = options['stacked_plots_out_folder'],
+                                            out_file_basename = tax_level+basename_ext,
+                                            figure_spec = figure_spec)
+        else:
+            raise ValueError ("Unknown plot type "+options['plot_type'])
+
+
+    def get_kaijuReport_StackedPlots_key_length(self, options):
+        '''
+        Number of lines in the key of options' stacked plots (the canvas is
+        sized for it), so the report page can scale the image to fit
+        '''
+        return len(self._get_stacked_figure_spec(options)['key_labels'])
+
+
+    def _get_stacked_figure_spec(self, options):
+        tax_level = options['tax_level']
+
+        # prepare once per tax level, whichever plot types are drawn from it
+        figure_key = (options['in_folder'],
+                      tuple([input_reads_item['name'] for input_reads_item in options['input_reads']]),
+                      tax_level,
+                      options.get('sort_taxa_by'),
+                      options.get('plot_top_taxa'),
+                      options.get('plot_top_taxa_by'))
+        if figure_key not in self.prepared_figures:
+            (abundance_matrix, lineage_order, sample_order, classified_frac) = self._build_abundance_matrix(options, tax_level)
+            self.prepared_figures[figure_key] = self._prepare_stacked_figure (vals = abundance_matrix,
+                                                                              frac_vals = classified_frac,
+                                                                              title = tax_level.title(),
+                                                                              frac_y_label = 'fraction classified',
+                                                                              y_label = 'percent of classified reads',
+                                                                              sample_labels = sample_order,
+                                                                              element_labels = lineage_order,
+                                                                              sort_by = options['sort_taxa_by'])
+        return self.prepared_figures[figure_key]
+
+
+    def _build_abundance_matrix(self, options, tax_level):
+        '''
+        Lineage by sample abundance (percent) at tax_level, from the
+        kaijuReport summaries, with the special buckets last
+        '''
         abundance_matrix = []
         abundance_by_sample = []
         lineage_seen = dict()
@@ -351,42 +322,106 @@ class OutputBuilder(object):
                 else:
                     abundance_matrix[lineage_i].append(0.0)
 
-        # make plots
-        if options['plot_type'] == 'bar':
-            basename_ext = '-stacked_bar_plot'
-            return self._create_bar_plots (out_folder = options['stacked_plots_out_folder'],
-                                           out_file_basename = tax_level+basename_ext,
-                                           vals = abundance_matrix,
-                                           frac_vals = classified_frac,
-                                           #title = tax_level.title()+' Level',
-                                           title = tax_level.title(),
-                                           frac_y_label = 'fraction classified',
-                                           y_label = 'percent of classified reads',
-                                           sample_labels = sample_order,
-                                           element_labels = lineage_order,
-                                           sort_by = options['sort_taxa_by'])
-        elif options['plot_type'] == 'area':
-            basename_ext = '-stacked_area_plot'
-            return self._create_area_plots (out_folder = options['stacked_plots_out_folder'],
-                                           out_file_basename = tax_level+basename_ext,
-                                           vals = abundance_matrix,
-                                           frac_vals = classified_frac,
-                                           #title = tax_level.title()+' Level',
-                                           title = tax_level.title(),
-                                           frac_y_label = 'fraction classified',
-                                           y_label = 'percent of classified reads',
-                                           sample_labels = sample_order,
-                                           element_labels = lineage_order,
-                                           sort_by = options['sort_taxa_by'])
-        else:
-            raise ValueError ("Unknown plot type "+options['plot_type'])
+        # bound the number of taxa drawn, however rich the sample is at this level
+        if options.get('plot_top_taxa'):
+            (abundance_matrix, lineage_order) = self._fold_into_tail (abundance_matrix,
+                                                                      lineage_order,
+                                                                      int(options['plot_top_taxa']),
+                                                                      options.get('plot_top_taxa_by') or 'total')
+
+        return (abundance_matrix, lineage_order, sample_order, classified_frac)
+
+
+    def generate_kaijuReport_PlotData(self, options):
+        '''
+        Abundance matrices of all tax levels in one JSON file, for the report
+        viewer (stacked_plots.js) to draw in the browser instead of matplotlib.
+        Values are percent, row major (lineage by sample), 4 decimals.
+        '''
+        plot_data = {'sort_by': options.get('sort_taxa_by'),
+                     'key_top_k': self.KEY_TOP_K,
+                     'tax_levels': options['tax_levels'],
+                     'plots': dict()
+                 }
+        for tax_level in options['tax_levels']:
+            (abundance_matrix, lineage_order, sample_order, classified_frac) = self._build_abundance_matrix(options, tax_level)
+            np_vals = np.array(abundance_matrix, dtype=float).reshape(len(lineage_order), len(sample_order))
+            plot_data['plots'][tax_level] = {'samples':         sample_order,
+                                             'classified_frac': np.round(np.array(classified_frac, dtype=float), 4).tolist(),
+                                             'lineages':        lineage_order,
+                                             'colors':          self.lineage_colors.get_hex_colors(lineage_order),
+                                             'values':          np.round(np_vals, 4).ravel().tolist()
+                                         }
+
+        plot_data_file = os.path.join(options['out_folder'], self.PLOT_DATA_FILE)
+        with open(plot_data_file, 'w') as plot_data_handle:
+            json.dump(plot_data, plot_data_handle, separators=(',', ':'))
+        return plot_data_file
 
 
     def generate_kaijuReport_StackedAreaPlots(self, options):
         pass
 
 
-    def build_html_for_kaijuReport_StackedPlots(self, input_reads, summary_folder, out_html_folder, plot_type, tax_levels, img_files):
+    def _fold_into_tail (self, abundance_matrix, lineage_order, top_k, rank_by='total'):
+        '''
+        Keep the top_k lineages ranked by 'total' or 'max' abundance across
+        samples, and add the rest into the tail bucket.  The tail label's
+        cutoff is raised to cover the largest folded taxon.  Special buckets
+        stay at the end in their usual order.
+        '''
+        if rank_by not in ['total', 'max']:
+            raise ValueError ('bad plot_top_taxa_by: '+str(rank_by)+' (must be "total" or "max")')
+
+        np_vals = np.array(abundance_matrix, dtype=float).reshape(len(lineage_order), -1)
+        is_taxon = np.array([not (lineage_name.startswith('tail (<')
+                                  or lineage_name.startswith('viruses')
+                                  or lineage_name.startswith('unassigned at')) for lineage_name in lineage_order], dtype=bool)
+        taxon_i = np.flatnonzero(is_taxon)
+        if len(taxon_i) <= top_k:
+            return (abundance_matrix, lineage_order)
+
+        if rank_by == 'max':
+            score = np_vals[taxon_i].max(axis=1)
+        else:
+            score = np_vals[taxon_i].sum(axis=1)
+        keep = np.zeros(len(lineage_order), dtype=bool)
+        keep[taxon_i[np.argsort(-score, kind='mergesort')[:top_k]]] = True
+        fold = is_taxon & ~keep
+        folded_vals = np_vals[fold].sum(axis=0)
+        folded_max = np_vals[fold].max()
+
+        # strictly above the largest folded taxon, to two decimals
+        tail_cutoff = np.ceil(folded_max*100.0 + 1e-9) / 100.0
+        tail_vals = folded_vals
+        extra_i = []
+        for lineage_i in np.flatnonzero(~is_taxon):
+            if lineage_order[lineage_i].startswith('tail (<'):
+                tail_vals = tail_vals + np_vals[lineage_i]
+                old_cutoff = re.sub(r'tail \(< (\S+)% each taxon\)', r'\1', lineage_order[lineage_i])
+                try:
+                    tail_cutoff = max(tail_cutoff, float(old_cutoff))
+                except ValueError:
+                    pass
+            else:
+                extra_i.append(lineage_i)
+        log('folding '+str(int(fold.sum()))+' of '+str(len(taxon_i))+' taxa into the plot tail')
+
+        kept_i = np.flatnonzero(keep)
+        new_lineage_order = [lineage_order[lineage_i] for lineage_i in kept_i] \
+                            + ['tail (< '+'{0:g}'.format(tail_cutoff)+'% each taxon)'] \
+                            + [lineage_order[lineage_i] for lineage_i in extra_i]
+        new_abundance_matrix = np.vstack([np_vals[kept_i],
+                                          tail_vals.reshape(1, -1),
+                                          np_vals[extra_i]]).tolist()
+        return (new_abundance_matrix, new_lineage_order)
+
+
+    def build_html_for_kaijuReport_StackedPlots(self, out_html_folder, plot_type, tax_levels, img_files, key_lengths=None, html_pages=None):
+        '''
+        key_lengths is the number of key lines of each tax level's plot, as
+        drawn (see get_kaijuReport_StackedPlots_key_length())
+        '''
         img_height = 750  # in pixels
         #key_scale = 25
         key_scale = img_height / 36
@@ -394,29 +429,32 @@ class OutputBuilder(object):
         out_html_img_path = os.path.join (out_html_folder, img_local_path)
         if not os.path.exists(out_html_img_path):
             os.makedirs(out_html_img_path)
-        out_html_file = None
+        out_local_path = plot_type+'.html'
+        out_html_path = os.path.join (out_html_folder, out_local_path)
+        out_html_file = {'type': plot_type,
+                         'name': plot_type.title(),
+                         'local_path': out_local_path,
+                         'abs_path': out_html_path
+                     }
         out_html_buf = []
 
-        # add header
+        # add header (and top nav, if the full page list is known)
+        top_nav = None
+        if html_pages is not None:
+            top_nav = self._build_top_nav(out_html_file, html_pages)
         plot_type_disp = plot_type.title()
-        out_html_buf.extend (self._build_plot_html_header('KBase Kaiju Stacked '+plot_type_disp+' Abundance Plots'))
+        out_html_buf.extend (self._build_plot_html_header('KBase Kaiju Stacked '+plot_type_disp+' Abundance Plots', top_nav))
 
-        # copy plot imgs to html folder and add img to html page
+        # link plot imgs into html folder and add img to html page
         for tax_level in tax_levels:
             src_plot_file = img_files[tax_level]
-            dst_local_path = os.path.join (img_local_path, plot_type+'-'+tax_level+'.PNG')
+            img_ext = os.path.splitext(src_plot_file)[1]
+            dst_local_path = os.path.join (img_local_path, plot_type+'-'+tax_level+img_ext)
             dst_plot_file = os.path.join (out_html_folder, dst_local_path)
-            shutil.copy2 (src_plot_file, dst_plot_file)
+            self.artifacts.expose (src_plot_file, dst_plot_file)
 
             # increase height if key is long
-            lineage_seen = dict()
-            for input_reads_item in input_reads:
-                this_summary_file = os.path.join (summary_folder, input_reads_item['name']+'-'+tax_level+'.kaijuReport')
-                (this_abundance, this_lineage_order, this_classified_frac) = self._parse_kaiju_summary_file (this_summary_file, tax_level)
-                for lineage_name in this_lineage_order:
-                    lineage_seen[lineage_name] = True
-
-            len_key = len(lineage_seen.keys())
+            len_key = (key_lengths or dict()).get(tax_level, 0)
             if key_scale * len_key > img_height:
                 this_img_height = key_scale * len_key
             else:
@@ -429,15 +467,45 @@ class OutputBuilder(object):
         out_html_buf.extend (self._build_plot_html_footer())
 
         # write file
-        out_local_path = plot_type+'.html'
-        out_html_path = os.path.join (out_html_folder, out_local_path)
         self._write_buf_to_file(out_html_path, out_html_buf)
 
+        return [out_html_file]
+
+
+    def build_html_for_kaijuReport_StackedPlotsViewer(self, out_html_folder, plot_type, plot_data_file, html_pages=None):
+        '''
+        Stacked plot page drawn in the browser by stacked_plots.js, from the
+        plot data written by generate_kaijuReport_PlotData().  The data is
+        wrapped in a script, so the page also works when opened from file://
+        '''
+        for local_dir in ['js', 'data']:
+            if not os.path.exists(os.path.join(out_html_folder, local_dir)):
+                os.makedirs(os.path.join(out_html_folder, local_dir))
+        viewer_local_path = os.path.join('js', 'stacked_plots.js')
+        data_local_path = os.path.join('data', 'stacked_plot_data.js')
+        self.artifacts.expose (self.PLOT_VIEWER_JS, os.path.join(out_html_folder, viewer_local_path))
+        with open (plot_data_file, 'r') as data_handle, \
+             open (os.path.join(out_html_folder, data_local_path), 'w') as js_handle:
+            # a lineage name can't close the script tag
+            js_handle.write('var KAIJU_PLOT_DATA = '+data_handle.read().replace('</', '<\\/')+';\n')
+
+        out_local_path = plot_type+'.html'
+        out_html_path = os.path.join (out_html_folder, out_local_path)
         out_html_file = {'type': plot_type,
                          'name': plot_type.title(),
                          'local_path': out_local_path,
                          'abs_path': out_html_path
                      }
+        top_nav = None
+        if html_pages is not None:
+            top_nav = self._build_top_nav(out_html_file, html_pages)
+        out_html_buf = []
+        out_html_buf.extend (self._build_plot_html_header('KBase Kaiju Stacked '+plot_type.title()+' Abundance Plots', top_nav))
+        out_html_buf.append('<div id="kaiju-stacked-plots" data-plot-type="'+plot_type+'"></div>')
+        out_html_buf.append('<script src="'+data_local_path+'"></script>')
+        out_html_buf.append('<script src="'+viewer_local_path+'"></script>')
+        out_html_buf.extend (self._build_plot_html_footer())
+        self._write_buf_to_file(out_html_path, out_html_buf)
 
         return [out_html_file]
 
@@ -456,13 +524,14 @@ class OutputBuilder(object):
             # add header
             out_html_buf.extend (self._build_plot_html_header('KBase Kaiju Per-Sample Abundance Plots'))
 
-            # copy plot imgs to html folder and add img to html page
+            # link plot imgs into html folder and add img to html page
             for input_reads_item in options['input_reads']:
                 sample_name = input_reads_item['name']
                 src_plot_file = img_files[tax_level][sample_name]
-                dst_local_path = os.path.join (img_local_path, 'per_sample_abundance-'+tax_level+'-'+sample_name+'.PNG')
+                img_ext = os.path.splitext(src_plot_file)[1]
+                dst_local_path = os.path.join (img_local_path, 'per_sample_abundance-'+tax_level+'-'+sample_name+img_ext)
                 dst_plot_file = os.path.join (out_html_folder, dst_local_path)
-                shutil.copy2 (src_plot_file, dst_plot_file)
+                self.artifacts.expose (src_plot_file, dst_plot_file)
 
                 out_html_buf.append('<img src="'+dst_local_path+'">')
 
@@ -483,64 +552,85 @@ class OutputBuilder(object):
 
 
     def add_top_nav(self, html_pages):
-        min_downshift = 25
-
+        '''
+        Add the top nav to pages that were written without it.  Pages built
+        here get the nav at generation time, so this is only needed for
+        pages written by other tools.
+        '''
         for html_page in html_pages:
-            html_type = html_page['type']
-            name = html_page['name']
-            local_path = html_page['local_path']
-            abs_path = html_page['abs_path']
-
-            # build top nav
-            sp = '&nbsp;'
-            sp_cnt = 2
-            top_nav_buf = []
-            for page_i,this_html_page in enumerate(html_pages):
-                this_name = this_html_page['name']
-                no_link = False
-                if this_name == name:
-                    no_link = True
-                if this_name == 'Bar' or this_name == 'Area':
-                    this_name = 'Stacked '+this_name+' Plots'
-                this_local_path = this_html_page['local_path']
-                if no_link:
-                    disp_name = this_name.upper()
-                    top_nav_item = '<b>'+disp_name+'</b>'
-                else:
-                    top_nav_item = '<a href="'+this_local_path+'">'+this_name+'</a>'
-                if page_i == 0:
-                    top_nav_item = (sp * sp_cnt) + top_nav_item
-                top_nav_buf.append(top_nav_item)
-            top_nav_str = ' | '.join(top_nav_buf)
-            top_nav_str += '<p>'
-
-            # add top nav to file
-            new_buf = []
-            with open (abs_path, 'r') as html_handle:
-                for line in html_handle.readlines():
-                    line_copy = line.lstrip()
-
-                    # pad top of krona plot
-                    if html_type == 'krona' and line_copy.startswith('options.style.top ='):
-                        #downshift = '50px'
-                        #downshift = '25px'
-                        downshift_scale_per_char = 0.15
-                        downshift = int(downshift_scale_per_char*len(top_nav_str))
-                        if downshift < min_downshift:
-                            downshift = min_downshift
-                        new_buf.append("\t options.style.top = '"+str(downshift)+"px';")
-                        continue
+            self.insert_top_nav(html_page, html_pages)
 
-                    # capture original html
-                    new_buf.append(line)
 
-                    # add top nav str
-                    if line_copy.startswith('<body'):
-                        new_buf.append(top_nav_str+"\n")
+    def insert_top_nav(self, html_page, html_pages):
+        '''
+        Streaming rewrite of a single page (e.g. from ktImportText).  Only the
+        header region, up to and including the <body> line, is parsed and
+        patched.  The rest of the file is block copied as is, so multi-MB
+        Krona pages are never read into memory.
+        '''
+        min_downshift = 25
+        downshift_scale_per_char = 0.15
+        top_nav_marker = self.TOP_NAV_MARKER.encode('utf-8')
+        top_nav_str = self._build_top_nav(html_page, html_pages)
+        abs_path = html_page['abs_path']
+        tmp_path = abs_path+'.tmp'
+
+        with open (abs_path, 'rb') as in_handle, open (tmp_path, 'wb') as out_handle:
+            # header region
+            for line in iter(in_handle.readline, b''):
+                line_copy = line.lstrip()
+
+                # pad top of krona plot
+                if html_page['type'] == 'krona' and line_copy.startswith(b'options.style.top ='):
+                    downshift = int(downshift_scale_per_char*(len(top_nav_str)-len(self.TOP_NAV_MARKER)))
+                    if downshift < min_downshift:
+                        downshift = min_downshift
+                    line = line[:len(line)-len(line_copy)] + b"options.style.top = '"+str(downshift).encode('utf-8')+b"px';\n"
+
+                # drop top nav from an earlier pass
+                if line_copy.startswith(top_nav_marker):
+                    continue
 
-            with open (abs_path, 'w') as html_handle:
-                for line_buf in new_buf:
-                    html_handle.write(line_buf)
+                out_handle.write(line)
+                if line_copy.startswith(b'<body'):
+                    out_handle.write(top_nav_str.encode('utf-8')+b"\n")
+                    break
+
+            # an earlier pass leaves its top nav right after <body>
+            rest_pos = in_handle.tell()
+            if not in_handle.readline().lstrip().startswith(top_nav_marker):
+                in_handle.seek(rest_pos)
+
+            # rest of page
+            shutil.copyfileobj(in_handle, out_handle, 1024*1024)
+
+        os.rename(tmp_path, abs_path)
+
+
+    def _build_top_nav(self, html_page, html_pages):
+        name = html_page['name']
+        sp = '&nbsp;'
+        sp_cnt = 2
+        top_nav_buf = []
+        for page_i,this_html_page in enumerate(html_pages):
+            this_name = this_html_page['name']
+            no_link = False
+            if this_name == name:
+                no_link = True
+            if this_name == 'Bar' or this_name == 'Area':
+                this_name = 'Stacked '+this_name+' Plots'
+            this_local_path = this_html_page['local_path']
+            if no_link:
+                disp_name = this_name.upper()
+                top_nav_item = '<b>'+disp_name+'</b>'
+            else:
+                top_nav_item = '<a href="'+this_local_path+'">'+this_name+'</a>'
+            if page_i == 0:
+                top_nav_item = (sp * sp_cnt) + top_nav_item
+            top_nav_buf.append(top_nav_item)
+        top_nav_str = self.TOP_NAV_MARKER + ' | '.join(top_nav_buf)
+        top_nav_str += '<p>'
+        return top_nav_str
 
 
     def _parse_kaiju_summary_file (self, summary_file, tax_level):
@@ -599,275 +689,252 @@ class OutputBuilder(object):
 
         # store to avoid repeat parse
         classified_frac = 1.0 - unclassified_perc/100.0
-        self.parsed_summary[summary_file] = dict()
-        self.parsed_summary[summary_file]['abundance']       = abundance
-        self.parsed_summary[summary_file]['lineage_order']   = lineage_order
-        self.parsed_summary[summary_file]['classified_frac'] = classified_frac
+        self.parsed_summary[summary_file] = {'abundance':       abundance,
+                                             'lineage_order':   lineage_order,
+                                             'classified_frac': classified_frac}
 
         return (abundance, lineage_order, classified_frac)
 
 
-    def _parse_kaiju_classification_file (self, classification_file, tax_level, db_type):
-        KAIJU_DB_DIR   = os.path.join(os.path.sep, 'data', 'kaijudb', db_type)
-        KAIJU_DB_NODES = os.path.join(KAIJU_DB_DIR, 'nodes.dmp')
-        KAIJU_DB_NAMES = os.path.join(KAIJU_DB_DIR, 'names.dmp')
-
-        abundance_cnts = dict()
-        lineage_order = []
-        classified_cnt = 0
-        unclassified_cnt = 0
+    def _load_kaiju_taxonomy (self, db_type):
+        '''
+        Taxonomy arrays indexed by taxon id, loaded once per run.  These are
+        mmapped from the index made at init (see KaijuTaxonomy.py), or parsed
+        from names.dmp and nodes.dmp if the db hasn't been prepared.
+        '''
+        with self.taxonomy_lock:  # krona and biom tasks may ask at once
+            if db_type not in self.taxonomy_by_db:
+                self.taxonomy_by_db[db_type] = KaijuTaxonomy.open(get_db_registry().get(db_type).db_dir)
+            return self.taxonomy_by_db[db_type]
 
-        # store names db
-        if self.NAMES_DB != None:
-            largest_id = len(self.NAMES_DB)
-        else:
-            ID_I   = 0
-            NAME_I = 1
-            CAT_I  = 3
-            largest_id = 0
-            with open (KAIJU_DB_NAMES, 'r') as names_handle:
-                for names_line in names_handle.readlines():
-                    names_line = names_line.rstrip()
-                    names_line_info = names_line.split("\t|")
-                    name_category = names_line_info[CAT_I].strip()
-                    if name_category != 'scientific name':
-                        continue
-                    name_id = int(names_line_info[ID_I].strip())
-                    if name_id > largest_id:
-                        largest_id = name_id
-            self.NAMES_DB = []
-            for name_i in range(largest_id+1):
-                self.NAMES_DB.append(None)
-            with open (KAIJU_DB_NAMES, 'r') as names_handle:
-                for names_line in names_handle.readlines():
-                    names_line = names_line.rstrip()
-                    names_line_info = names_line.split("\t|")
-                    name_category = names_line_info[CAT_I].strip()
-                    if name_category != 'scientific name':
-                        continue
-                    name_id = int(names_line_info[ID_I].strip())
-                    self.NAMES_DB[name_id] = names_line_info[NAME_I].strip()
-
-        # store nodes db
-        all_tax_levels = ['class',
-                          'cohort',
-                          'family',
-                          'forma',
-                          'genus',
-                          'infraclass',
-                          'infraorder',
-                          'kingdom',
-                          'no rank',
-                          'order',
-                          'parvorder',
-                          'phylum',
-                          'species',
-                          'subclass',
-                          'subfamily',
-                          'subgenus',
-                          'subkingdom',
-                          'suborder',
-                          'subphylum',
-                          'subspecies',
-                          'subtribe',
-                          'superclass',
-                          'superfamily',
-                          'superkingdom',
-                          'superorder',
-                          'superphylum',
-                          'tribe',
-                          'varietas']
-        tax_level_id2str = []
-        tax_level_str2id = dict()
-        for tax_level_id,tax_level_str in enumerate(all_tax_levels):
-            tax_level_id2str.append(tax_level_str)
-            tax_level_str2id[tax_level_str] = tax_level_id
-
-        # store [PAR_ID, TAX_LEVEL_I]
-        if self.NODES_DB == None:
-            NODE_ID_I = 0
-            PAR_ID_I  = 1
-            LEVEL_I   = 2
-            self.NODES_DB = []
-            for node_i in range(largest_id+1):
-                self.NODES_DB.append(None)
-            with open (KAIJU_DB_NODES, 'r') as nodes_handle:
-                for nodes_line in nodes_handle.readlines():
-                    nodes_line = nodes_line.rstrip()
-                    nodes_line_info = nodes_line.split("\t|")
-                    node_id = int(nodes_line_info[NODE_ID_I].strip())
-                    par_id = int(nodes_line_info[PAR_ID_I].strip())
-                    tax_level_str = nodes_line_info[LEVEL_I].strip()
-                    if tax_level_str == 'species group' or tax_level_str == 'species subgroup':
-                        tax_level_str = 'species'
-                    tax_level_id = tax_level_str2id[tax_level_str]
-
-                    self.NODES_DB[node_id] = [par_id, tax_level_id]
 
+    def _get_taxon_counts (self, classification_file, taxonomy):
+        '''
+        Count of classified reads per taxon id for a kaiju classification
+        file.  The file is only scanned once per run.
+        '''
         # parse species from kaiju read classification
         if classification_file not in self.species_abundance_by_sample:
-            species_abundance_cnts = []
-            for node_i in range(largest_id+1):
-                species_abundance_cnts.append(0)
+            species_abundance_cnts = np.zeros(taxonomy.max_id+1, dtype=np.int64)
             CLASS_FLAG_I = 0
             READ_ID_I    = 1
             NODE_ID_I    = 2
+            chunk_size   = 1000000
+            node_ids = []
             with open (classification_file, 'r') as class_handle:
-                for class_line in class_handle.readlines():
-                    class_line.rstrip()
-                    class_info = class_line.split("\t")
+                for class_line in class_handle:
+                    class_info = class_line.split("\t", 3)
                     if class_info[CLASS_FLAG_I] == 'U':
                         continue
-                    node_id = int(class_info[NODE_ID_I])
-                    species_abundance_cnts[node_id] += 1
+                    node_ids.append(int(class_info[NODE_ID_I]))
+                    if len(node_ids) >= chunk_size:
+                        self._add_taxon_counts(species_abundance_cnts, node_ids, classification_file)
+                        node_ids = []
+            if len(node_ids) > 0:
+                self._add_taxon_counts(species_abundance_cnts, node_ids, classification_file)
             self.species_abundance_by_sample[classification_file] = species_abundance_cnts
+        return self.species_abundance_by_sample[classification_file]
+
+
+    def _add_taxon_counts (self, taxon_cnts, node_ids, classification_file):
+        node_id_cnts = np.bincount(node_ids, minlength=len(taxon_cnts))
+        if len(node_id_cnts) > len(taxon_cnts):
+            raise ValueError ("taxon id "+str(len(node_id_cnts)-1)+" in "+classification_file+" is not in the kaiju db taxonomy")
+        taxon_cnts += node_id_cnts
+
+
+    def write_krona_text (self, classification_file, db_type, out_file):
+        '''
+        In-process replacement for kaiju2krona.  Writes the Krona text input
+        (read count, then the names on the lineage path below root, tab
+        delimited) from the cached per-taxon counts and taxonomy, so the
+        classification file isn't scanned again.  Like kaiju2krona without
+        -u, unclassified reads are left out.
+        '''
+        taxonomy = self._load_kaiju_taxonomy(db_type)
+        taxon_cnts = self._get_taxon_counts(classification_file, taxonomy)
+
+        lineage_paths = dict()  # shared parents are only walked once
+        lineage_paths[1] = []   # root
+
+        def get_lineage_path(node_id):
+            path_ids = []
+            while node_id not in lineage_paths:
+                if not taxonomy.has_node(node_id):
+                    raise ValueError ("taxon id "+str(node_id)+" not found in nodes.dmp for db_type "+db_type)
+                path_ids.append(node_id)
+                par_id = taxonomy.get_parent(node_id)
+                if par_id == node_id:
+                    lineage_paths[node_id] = []
+                    path_ids.pop()
+                    break
+                node_id = par_id
+            path = lineage_paths[node_id]
+            for path_id in reversed(path_ids):
+                name = taxonomy.get_name(path_id)
+                if name is None:
+                    name = 'taxon '+str(path_id)
+                path = path + [name]
+                lineage_paths[path_id] = path
+            return path
+
+        with open (out_file, 'w') as out_handle:
+            for node_id in np.flatnonzero(taxon_cnts).tolist():
+                out_handle.write("\t".join([str(taxon_cnts[node_id])] + get_lineage_path(node_id))+"\n")
 
 
-        # navigate up tax hierarchy until reach desired level and store abundance by name
-        abundance_cnts = dict()
-        PAR_ID_I       = 0
-        TAX_LEVEL_ID_I = 1
-        level_limit = 100
-        for node_id,species_cnt in enumerate(self.species_abundance_by_sample[classification_file]):
-            if species_cnt > 0:
-                this_par_id       = self.NODES_DB[node_id][PAR_ID_I]
-                this_tax_level_id = self.NODES_DB[node_id][TAX_LEVEL_ID_I]
-                level_lim_i = 0
-                while level_lim_i < level_limit:
-                    level_lim_i += 1
-                    if tax_level_id2str[this_tax_level_id] == tax_level:
-                        node_name = self.NAMES_DB[node_id]
-                        if node_name not in abundance_cnts:
-                            abundance_cnts[node_name] = 0
-                        abundance_cnts[node_name] += species_cnt
-                        break
-                    else:
-                        node_id = this_par_id
-                        this_par_id       = self.NODES_DB[node_id][PAR_ID_I]
-                        this_tax_level_id = self.NODES_DB[node_id][TAX_LEVEL_ID_I]
-                        if this_par_id == 1:
-                            break
-
+    def _parse_kaiju_classification_file (self, classification_file, tax_level, db_type):
+        abundance_cnts = self._rollup_kaiju_classification_file (classification_file, [tax_level], db_type)[tax_level]
         lineage_order = abundance_cnts.keys()
         return (abundance_cnts, lineage_order)
 
 
-    def _create_bar_plots (self, out_folder=None,
-                           out_file_basename=None,
-                           vals=None,
-                           frac_vals=None,
-                           title=None,
-                           frac_y_label=None,
-                           y_label=None,
-                           sample_labels=None,
-                           element_labels=None,
-                           sort_by=None):
-
-        # DEBUG
-        #N = len(sample_labels)
-        #N_force = 40
-        #for sample_i in range(N_force):
-        #    if sample_i >= N:
-        #        sample_labels.append(sample_labels[0]+'.'+str(sample_i))
-        #        frac_vals.append(frac_vals[0])
-        #        for element_i,element_label in enumerate(element_labels):
-        #            vals[element_i].append(vals[element_i][0])
-        #for sample_i,label in enumerate(sample_labels):
-        #    sample_labels[sample_i] = 'foobar.'+str(sample_i)
-        # END DEBUG
-
-
+    def _rollup_kaiju_classification_file (self, classification_file, tax_levels, db_type):
+        '''
+        Roll the per-taxon read counts up to each of tax_levels.  Ranks with a
+        precomputed ancestor column are a single array lookup, others take one
+        walk up the tax hierarchy per observed taxon.
+        Returns {tax_level: {name: count}}
+        '''
+        taxonomy = self._load_kaiju_taxonomy(db_type)
+        taxon_cnts = self._get_taxon_counts(classification_file, taxonomy)
+        node_ids = np.flatnonzero(taxon_cnts)
+        node_cnts = taxon_cnts[node_ids]
+
+        abundance_by_level = dict()
+        walk_levels = []
+        for tax_level in tax_levels:
+            ancestor_ids = taxonomy.get_ancestors_at_level(node_ids, tax_level)
+            if ancestor_ids is None:
+                walk_levels.append(tax_level)
+                continue
+            found = (ancestor_ids > 0)
+            (level_ids, level_idx) = np.unique(ancestor_ids[found], return_inverse=True)
+            level_cnts = np.bincount(level_idx, weights=node_cnts[found], minlength=len(level_ids))
+            abundance_cnts = dict()
+            for (level_id, level_cnt) in zip(level_ids.tolist(), level_cnts.tolist()):
+                node_name = taxonomy.get_name(level_id)
+                abundance_cnts[node_name] = abundance_cnts.get(node_name, 0) + int(level_cnt)
+            abundance_by_level[tax_level] = abundance_cnts
+
+        if len(walk_levels) > 0:
+            abundance_by_level.update(self._rollup_by_walk(taxonomy, node_ids, node_cnts, walk_levels))
+        return abundance_by_level
+
+
+    def _rollup_by_walk (self, taxonomy, node_ids, node_cnts, tax_levels):
+        # navigate up tax hierarchy until reach each desired level and store abundance by name
+        abundance_by_level = dict()
+        for tax_level in tax_levels:
+            abundance_by_level[tax_level] = dict()
+        level_limit = 100
+        for node_id,species_cnt in zip(node_ids.tolist(), node_cnts.tolist()):
+            levels_left = len(tax_levels)
+            levels_found = dict()
+            this_par_id    = taxonomy.get_parent(node_id)
+            this_tax_level = taxonomy.get_tax_level(node_id)
+            level_lim_i = 0
+            while level_lim_i < level_limit:
+                level_lim_i += 1
+                if this_tax_level in abundance_by_level and this_tax_level not in levels_found:
+                    levels_found[this_tax_level] = True
+                    abundance_cnts = abundance_by_level[this_tax_level]
+                    node_name = taxonomy.get_name(node_id)
+                    if node_name not in abundance_cnts:
+                        abundance_cnts[node_name] = 0
+                    abundance_cnts[node_name] += species_cnt
+                    levels_left -= 1
+                    if levels_left == 0:
+                        break
+                node_id = this_par_id
+                this_par_id    = taxonomy.get_parent(node_id)
+                this_tax_level = taxonomy.get_tax_level(node_id)
+                if this_par_id == 1:
+                    break
+
+        return abundance_by_level
+
+
+    def _order_elements (self, element_labels, np_vals, sort_by=None):
+        '''
+        Stacking order (bottom first) of the rows of np_vals: taxa in reverse
+        of the sort_by order ('totals' descending, 'alpha' descending, or as
+        given), so the most important sit at the top, then the tail, viruses
+        and unassigned buckets as given.  Ties keep their given order.
+        '''
+        is_special = np.array([label.startswith('tail (<')
+                               or label.startswith('viruses')
+                               or label.startswith('unassigned at') for label in element_labels], dtype=bool)
+        taxon_i = np.flatnonzero(~is_special)
+        if sort_by == 'totals':
+            log("SORTING ELEMENTS by "+str(sort_by))
+            taxon_i = taxon_i[np.argsort(-np_vals[taxon_i].sum(axis=1), kind='mergesort')]
+        elif sort_by == 'alpha':
+            log("SORTING ELEMENTS by "+str(sort_by))
+            taxon_labels = np.array([element_labels[element_i] for element_i in taxon_i])
+            taxon_i = taxon_i[np.argsort(taxon_labels, kind='mergesort')[::-1]]
+        return np.concatenate([taxon_i[::-1], np.flatnonzero(is_special)]).astype(int)
+
+
+    def _get_key_elements (self, element_labels, np_vals):
+        '''
+        Indices of the elements to show in a stacked plot key: the KEY_TOP_K
+        largest by summed abundance, and the special buckets
+        '''
+        key_elements = set()
+        ranked_elements = []
+        for element_i in np.argsort(-np_vals.sum(axis=1), kind='mergesort'):
+            label = element_labels[element_i]
+            if label.startswith('tail (<') or label.startswith('viruses') or label.startswith('unassigned at'):
+                key_elements.add(int(element_i))
+            else:
+                ranked_elements.append(int(element_i))
+        key_elements.update(ranked_elements[:self.KEY_TOP_K])
+        return key_elements
+
+
+    def _prepare_stacked_figure (self, vals=None,
+                                 frac_vals=None,
+                                 title=None,
+                                 frac_y_label=None,
+                                 y_label=None,
+                                 sample_labels=None,
+                                 element_labels=None,
+                                 sort_by=None):
+        '''
+        What the stacked bar and area renderers share: colors, stacking
+        order, key and canvas layout.  Prepared once per tax level and
+        rendered as any plot type by _create_bar_plots / _create_area_plots.
+        '''
         # number of samples
         N = len(sample_labels)
 
 
+        # stacking order, bottom first
+        np_vals = np.array(vals, dtype=float).reshape(len(element_labels), N)
+        element_order = self._order_elements(element_labels, np_vals, sort_by)
+        np_vals = np_vals[element_order]
+        element_labels = [element_labels[element_i] for element_i in element_order]
+
+
         # colors
-        color_names = self.no_light_color_names
-        len_color_names = len(color_names)
-        random.seed(a=len(element_labels))
-        r = random.random()
-        shuffle(color_names, lambda: r)
-        for label_i,label in enumerate(element_labels):
-            if label_i >= len_color_names:
-                color_names.append(color_names[label_i % len_color_names])
-            if label.startswith('tail (<'):
-                color_names[label_i] = 'lightslategray'
-            elif label.startswith('viruses'):
-                color_names[label_i] = 'magenta'
-            elif label.startswith('unassigned at'):
-                color_names[label_i] = 'darkslategray'
-
-
-        # Sort vals
-        if sort_by != None:
-            print ("SORTING ELEMENTS by "+str(sort_by))
-            old_index = dict()
-            new_index = dict()
-            for label_i,label in enumerate(element_labels):
-                old_index[label] = label_i
-                #print ("LABEL: "+str(label)+" OLD_INDEX: "+str(label_i))  # DEBUG
-
-            # alphabet sort
-            if sort_by == 'alpha':
-                new_label_i = 0
-                for label in sorted(element_labels, reverse=True):
-                    if label.startswith('tail (<') or label.startswith('viruses') or label.startswith('unassigned at'):
-                        new_index[label] = old_index[label]
-                    else:
-                        new_index[label] = new_label_i
-                        new_label_i += 1
-                    #print ("LABEL: "+str(label)+" NEW_INDEX: "+str(new_index[label]))  # DEBUG
-
-            # summed total sort
-            elif sort_by == 'totals':
-                totals = dict()
-                for label_i,label in enumerate(element_labels):
-                    totals[label] = 0
-                    for sample_i,sample in enumerate(sample_labels):
-                        totals[label] += vals[label_i][sample_i]
-                totals_vals = []
-                labels_by_totals = dict()
-                for label in totals.keys():
-                    if totals[label] not in totals_vals:
-                        totals_vals.append(totals[label])
-                        labels_by_totals[totals[label]] = []
-                    labels_by_totals[totals[label]].append(label)
-                new_label_i = 0
-                for totals_val in sorted(totals_vals, reverse=True):
-                    for label in labels_by_totals[totals_val]:
-                        if label.startswith('tail (<') or label.startswith('viruses') or label.startswith('unassigned at'):
-                            new_index[label] = old_index[label]
-                        else:
-                            new_index[label] = new_label_i
-                            new_label_i += 1
-                        #print ("LABEL: "+str(label)+" NEW_INDEX: "+str(new_index[label]))  # DEBUG
-
-            # store new order
-            new_vals = []
-            new_element_labels = []
-            for label_i,label in enumerate(element_labels):
-                new_vals.append([])
-                new_element_labels.append(None)
-            for label_i,label in enumerate(element_labels):
-                new_element_i = new_index[label]
-                #print ("NEW_ELEMENT_I: "+str(new_element_i))  # DEBUG
-                new_vals[new_element_i] = vals[label_i]
-                new_element_labels[new_element_i] = label
-                # DEBUG
-                #print ("NEW LABEL: "+str(label)+" NEW_INDEX: "+str(new_element_i)+" OLD_INDEX: "+str(label_i))  # DEBUG
-                #for sample_i,val in enumerate(new_vals[new_element_i]):
-                #    print ("\t"+"SAMPLE_I: "+str(sample_i)+" NEW_VAL: "+str(new_vals[new_element_i][sample_i]))
-            vals = new_vals
-            element_labels = new_element_labels
-
-
-        # reverse so that most important plots near top (below special 3 categories)
-        element_labels = element_labels[-4::-1] + element_labels[-3:]
-        vals = vals[-4::-1] + vals[-3:]
+        colors = self.lineage_colors.get_colors(element_labels)
+
+
+        # key entries, top of the stack first (None color for a note)
+        key_labels = []
+        key_colors = []
+        key_elements = self._get_key_elements(element_labels, np_vals)
+        for element_i in reversed(range(len(element_labels))):
+            if element_i in key_elements:
+                key_labels.append(element_labels[element_i])
+                key_colors.append(tuple(colors[element_i]))
+        if len(key_labels) < len(element_labels):
+            key_labels.append('(+ '+str(len(element_labels)-len(key_labels))+' less abundant taxa not in key)')
+            key_colors.append(None)
 
 
         # plot dimensions
-        #per_unit_to_inch_scale = 0.25
         per_unit_to_inch_scale = 0.5
         bar_width_unit = 0.5
         plot_x_pad_unit = bar_width_unit / 2.0
@@ -882,15 +949,13 @@ class OutputBuilder(object):
         # label dimensions
         longest_sample_label_len = 0
         longest_element_label_len = 0
-        len_elements_list = len(element_labels)
+        len_elements_list = len(key_labels)
         for label in sample_labels:
             if len(label) > longest_sample_label_len:
                 longest_sample_label_len = len(label)
-        for label in element_labels:
+        for label in key_labels:
             if len(label) > longest_element_label_len:
                 longest_element_label_len = len(label)
-        #x_label_scale_unit = 0.015
-        #y_label_scale_unit = 0.015
         x_label_scale_unit = 0.175
         y_label_scale_unit = 0.16
         key_label_scale = y_label_scale_unit * 50 / 30.0
@@ -898,591 +963,175 @@ class OutputBuilder(object):
         y_label_pad_unit = y_label_scale_unit * longest_sample_label_len
         if key_label_scale * len_elements_list > y_label_pad_unit:
             y_label_pad_unit = key_label_scale * len_elements_list
-        x_label_pad_inch = per_unit_to_inch_scale * x_label_pad_unit
-        y_label_pad_inch = per_unit_to_inch_scale * y_label_pad_unit
 
 
         # build canvas dimensions
         x_pad_unit = 1.0
         y_pad_unit = 0.25
-        #x_pad_unit = 0.10
-        #y_pad_unit = 0.10
-        x_pad_inch = per_unit_to_inch_scale * x_pad_unit
-        y_pad_inch = per_unit_to_inch_scale * y_pad_unit
         canvas_width_unit = 2*x_pad_unit + plot_width_unit + x_label_pad_unit
         canvas_height_unit = 2*y_pad_unit + plot_height_unit + y_label_pad_unit
         canvas_width_inch = per_unit_to_inch_scale * canvas_width_unit
         canvas_height_inch = per_unit_to_inch_scale * canvas_height_unit
 
 
-        # instantiate fig
-        #
-        # lose axes with below grid, and so sharex property. instead match xlim, bar_width, hide ticks.
-        #fig, (ax_top, ax_bot) = plt.subplots(2, 1, sharex=True)
-
-        # gridspec_kw not in KBase docker notebook agg image (old python?)
-        #fig, (ax_top, ax_bot) = plt.subplots(2, 1, sharex=True, gridspec_kw = {'height_ratios':[1, 3]})
-
-        # subplot2grid(shape, loc, rowspan=1, colspan=1)
-        FIG_rows = 1000
-        FIG_cols = 1
+        # axes positions, as fractions of the canvas.  don't shrink plots to
+        # fit the labels, place them explicitly since we built canvas for them
         top_frac = 0.22
-        top_rows = int(top_frac*FIG_rows)
-        bot_rows = FIG_rows-top_rows
-        fig = plt.figure()
-        ax_top = plt.subplot2grid((FIG_rows,FIG_cols), (0,0), rowspan=top_rows, colspan=1)
-        ax_bot = plt.subplot2grid((FIG_rows,FIG_cols), (top_rows,0), rowspan=bot_rows, colspan=1)
-        fig.set_size_inches(canvas_width_inch, canvas_height_inch)
-        fig.tight_layout()
-
-
-        #for ax in fig.axes:
-        #    ax.xaxis.set_visible(False)  # remove axis labels and ticks
-        #    ax.yaxis.set_visible(False)
-        #    for t in ax.get_xticklabels()+ax.get_yticklabels():  # remove tick labels
-        #        t.set_visible(False)
-        #for ax in fig.axes:
-        #    ax.spines['top'].set_visible(False) # Get rid of top axis line
-        #    ax.spines['bottom'].set_visible(False) #  bottom axis line
-        #    ax.spines['left'].set_visible(False) #  Get rid of bottom axis line
-        #    ax.spines['right'].set_visible(False) #  Get rid of bottom axis line
-
-
-        # indices
-        ind = np.arange(N)    # the x locations for the groups
-        label_ind = []
-        for ind_i,this_ind in enumerate(ind):
-            ind[ind_i] = this_ind+bar_width_unit/2
-            label_ind.append(this_ind + bar_width_unit/2)
-        np_vals = []
-        for vec_i,val_vec in enumerate(vals):
-            np_vals.append(np.array(val_vec))
-
-
-        # plot fraction measured
-        frac = ax_top.bar(ind, frac_vals, bar_width_unit, color='black', alpha=0.5, ec='none')
-        ax_top.set_title(title, fontsize=11)
-        ax_top.grid(b=True, axis='y')
-        ax_top.set_ylabel(frac_y_label, fontsize=10)
-        ax_top.tick_params(axis='y', labelsize=9, labelcolor='black')
-        ax_top.set_yticks(np.arange(0.0, 1.01, .20))
-        ax_top.set_ylim([0,1])
-        ax_top.xaxis.set_visible(False)  # remove axis labels and ticks
-        ax_top.set_xlim([-plot_x_pad_unit,N-plot_x_pad_unit])
-
-        # plot stacked
-        last_bottom = None
-        p = []
-        for vec_i,val_vec in enumerate(np_vals):
-            if vec_i == 0:
-                this_bottom = 0
-                last_bottom = val_vec
-            else:
-                this_bottom = last_bottom
-                last_bottom = this_bottom + val_vec
-            p.append (ax_bot.bar (ind, val_vec, bar_width_unit, bottom=this_bottom, color=color_names[vec_i], alpha=0.5, ec='none'))
-
-        ax_bot.set_ylabel(y_label, fontsize=10)
-        ax_bot.tick_params(axis='y', direction='in', length=4, width=0.5, colors='black', labelsize=9, labelcolor='black')
-        #plt.title(title)
-        #plt.xticks(label_ind, sample_labels, ha='right', rotation=45)
-        #ax_bot.set_xticks(label_ind, sample_labels, ha='center', rotation=90)
-        ax_bot.tick_params(axis='x', direction='out', length=0, width=0, colors='black', labelsize=9, labelcolor='black')
-        ax_bot.set_xticks(label_ind)
-        ax_bot.set_xticklabels(sample_labels, ha='center', rotation=90)
-        ax_bot.tick_params(axis='y', labelsize=9, labelcolor='black')
-        ax_bot.set_yticks(np.arange(0, 101, 20))
-        ax_bot.set_ylim([0,100])
-        ax_bot.set_xlim([-plot_x_pad_unit,N-plot_x_pad_unit])
-
-
-        # are positions now in units (btw. 0-1) or inches?  seems to depend on the backend Agg
         x_pad = x_pad_unit / canvas_width_unit
         y_pad = y_pad_unit / canvas_height_unit
         plot_width = plot_width_unit / canvas_width_unit
         plot_height = plot_height_unit / canvas_height_unit
-        x_label_pad = x_label_pad_unit / canvas_width_unit
         y_label_pad = y_label_pad_unit / canvas_height_unit
+        top_pos = [0 + x_pad,
+                   (1.0 - top_frac)*plot_height + y_label_pad,
+                   plot_width,
+                   top_frac*plot_height - 2*y_pad
+               ]
+        bot_pos = [0 + x_pad,
+                   0 + y_label_pad + y_pad,
+                   plot_width,
+                   (1.0 - top_frac)*plot_height - 2*y_pad
+               ]
+
+        return {'vals':            np_vals,
+                'frac_vals':       frac_vals,
+                'title':           title,
+                'frac_y_label':    frac_y_label,
+                'y_label':         y_label,
+                'sample_labels':   sample_labels,
+                'element_labels':  element_labels,
+                'colors':          colors,
+                'key_labels':      key_labels,
+                'key_colors':      key_colors,
+                'bar_width_unit':  bar_width_unit,
+                'plot_x_pad_unit': plot_x_pad_unit,
+                'top_frac':        top_frac,
+                'canvas_size':     (canvas_width_inch, canvas_height_inch),
+                'top_pos':         top_pos,
+                'bot_pos':         bot_pos
+            }
 
 
-        # Frac Plot sizing
-        # don't shrink frac plot.  instead place it explictly since we built canvas for it
-        #
-        box = ax_top.get_position()
-#        ax_top.set_position([box.x0 + x_pad_inch,
-#                             box.y0 + y_pad_inch,
-#                             box.width - x_label_pad_inch - 2*x_pad_inch,
-#                             #box.height - y_pad_inch
-#                             box.height
-#                         ])
-        top_pos = [x_0, y_0, w, h] = [0 + x_pad,
-                                      (1.0 - top_frac)*plot_height + y_label_pad,
-                                      plot_width,
-                                      top_frac*plot_height - 2*y_pad
-                                  ]
-        ax_top.set_position(top_pos)
-
-        # DEBUG
-        #print ("AX_TOP: BOX:")
-        #print ([box.x0, box.y0, box.width, box.height])
-        #print ("AX_TOP: TOP_POS:")
-        #print (top_pos)
-
-
-        # Stacked Plot sizing
-        #   don't shrink plot.  instead place it explictly since we built canvas for it
-        #
-        box = ax_bot.get_position()
-        #ax_bot.set_position([box.x0 + x_pad_inch,
-        #                     #box.y0 + y_pad_inch + y_label_pad_inch,
-        #                     box.y0,
-        #                     box.width - x_label_pad_inch - 2*x_pad_inch,
-        #                     #box.height - y_label_pad_inch - y_pad_inch
-        #                     box.height
-        #                 ])
-        bot_pos = [x_0, y_0, w, h] = [0 + x_pad,
-                                      0 + y_label_pad + y_pad,
-                                      plot_width,
-                                      (1.0 - top_frac)*plot_height - 2*y_pad
-                                  ]
-        ax_bot.set_position(bot_pos)
-
-        # DEBUG
-        #print ("AX_BOT: BOX:")
-        #print ([box.x0, box.y0, box.width, box.height])
-        #print ("AX_BOT: BOT_POS:")
-        #print (bot_pos)
-
-
-        # add key
-        key_colors = []
-        for each_p in reversed(p):
-            key_colors.append(each_p[0])
-        ax_bot.legend(key_colors, reversed(element_labels), loc='upper left', bbox_to_anchor=(1,1), fontsize=9)
-
-
-        # save
-        img_dpi = 200
-        #plt.show()
-        log("SAVING STACKED BAR PLOT")
-        png_file = out_file_basename+'.png'
-        pdf_file = out_file_basename+'.pdf'
-        output_png_file_path = os.path.join(out_folder, png_file);
-        output_pdf_file_path = os.path.join(out_folder, pdf_file);
-        fig.savefig(output_png_file_path, dpi=img_dpi)
-        fig.savefig(output_pdf_file_path, format='pdf')
-
-        return output_png_file_path
-
-
-    def _create_area_plots (self, out_folder=None,
-                           out_file_basename=None,
-                           vals=None,
-                           frac_vals=None,
-                           title=None,
-                           frac_y_label=None,
-                           y_label=None,
-                           sample_labels=None,
-                           element_labels=None,
-                           sort_by=None):
-
-        # number of samples
-        N = len(sample_labels)
-
-
-        # colors
-        color_names = self.no_light_color_names
-        len_color_names = len(color_names)
-        random.seed(a=len(element_labels))
-        r = random.random()
-        shuffle(color_names, lambda: r)
-        for label_i,label in enumerate(element_labels):
-            if label_i >= len_color_names:
-                color_names.append(color_names[label_i % len_color_names])
-            if label.startswith('tail (<'):
-                color_names[label_i] = 'lightslategray'
-            elif label.startswith('viruses'):
-                color_names[label_i] = 'magenta'
-            elif label.startswith('unassigned at'):
-                color_names[label_i] = 'darkslategray'
-
-
-        # Sort vals
-        if sort_by != None:
-            print ("SORTING ELEMENTS by "+str(sort_by))
-            old_index = dict()
-            new_index = dict()
-            for label_i,label in enumerate(element_labels):
-                old_index[label] = label_i
-                #print ("LABEL: "+str(label)+" OLD_INDEX: "+str(label_i))  # DEBUG
-
-            # alphabet sort
-            if sort_by == 'alpha':
-                new_label_i = 0
-                for label in sorted(element_labels, reverse=True):
-                    if label.startswith('tail (<') or label.startswith('viruses') or label.startswith('unassigned at'):
-                        new_index[label] = old_index[label]
-                    else:
-                        new_index[label] = new_label_i
-                        new_label_i += 1
-                    #print ("LABEL: "+str(label)+" NEW_INDEX: "+str(new_index[label]))  # DEBUG
-
-            # summed total sort
-            elif sort_by == 'totals':
-                totals = dict()
-                for label_i,label in enumerate(element_labels):
-                    totals[label] = 0
-                    for sample_i,sample in enumerate(sample_labels):
-                        totals[label] += vals[label_i][sample_i]
-                totals_vals = []
-                labels_by_totals = dict()
-                for label in totals.keys():
-                    if totals[label] not in totals_vals:
-                        totals_vals.append(totals[label])
-                        labels_by_totals[totals[label]] = []
-                    labels_by_totals[totals[label]].append(label)
-                new_label_i = 0
-                for totals_val in sorted(totals_vals, reverse=True):
-                    for label in labels_by_totals[totals_val]:
-                        if label.startswith('tail (<') or label.startswith('viruses') or label.startswith('unassigned at'):
-                            new_index[label] = old_index[label]
-                        else:
-                            new_index[label] = new_label_i
-                            new_label_i += 1
-                        #print ("LABEL: "+str(label)+" NEW_INDEX: "+str(new_index[label]))  # DEBUG
-
-            # store new order
-            new_vals = []
-            new_element_labels = []
-            for label_i,label in enumerate(element_labels):
-                new_vals.append([])
-                new_element_labels.append(None)
-            for label_i,label in enumerate(element_labels):
-                new_element_i = new_index[label]
-                #print ("NEW_ELEMENT_I: "+str(new_element_i))  # DEBUG
-                new_vals[new_element_i] = vals[label_i]
-                new_element_labels[new_element_i] = label
-                # DEBUG
-                #print ("NEW LABEL: "+str(label)+" NEW_INDEX: "+str(new_element_i)+" OLD_INDEX: "+str(label_i))  # DEBUG
-                #for sample_i,val in enumerate(new_vals[new_element_i]):
-                #    print ("\t"+"SAMPLE_I: "+str(sample_i)+" NEW_VAL: "+str(new_vals[new_element_i][sample_i]))
-            vals = new_vals
-            element_labels = new_element_labels
-
-
-        # reverse so that most important plots near top (below special 3 categories)
-        element_labels = element_labels[-4::-1] + element_labels[-3:]
-        vals = vals[-4::-1] + vals[-3:]
-
-
-        # plot dimensions
-        #per_unit_to_inch_scale = 0.25
-        per_unit_to_inch_scale = 0.5
-        bar_width_unit = 0.5
-        plot_x_pad_unit = bar_width_unit / 2.0
-        plot_width_unit = 2*plot_x_pad_unit + N
-        downscale_above_N = 20
-        extra_sample_scale = 0.5
-        if N > downscale_above_N:
-            plot_width_unit = 2*plot_x_pad_unit + downscale_above_N + extra_sample_scale*(N-downscale_above_N)
-        plot_height_unit = 8
-
-
-        # label dimensions
-        longest_sample_label_len = 0
-        longest_element_label_len = 0
-        len_elements_list = len(element_labels)
-        for label in sample_labels:
-            if len(label) > longest_sample_label_len:
-                longest_sample_label_len = len(label)
-        for label in element_labels:
-            if len(label) > longest_element_label_len:
-                longest_element_label_len = len(label)
-        #x_label_scale_unit = 0.015
-        #y_label_scale_unit = 0.015
-        x_label_scale_unit = 0.175
-        y_label_scale_unit = 0.16
-        key_label_scale = y_label_scale_unit * 50 / 30.0
-        x_label_pad_unit = x_label_scale_unit * longest_element_label_len
-        y_label_pad_unit = y_label_scale_unit * longest_sample_label_len
-        if key_label_scale * len_elements_list > y_label_pad_unit:
-            y_label_pad_unit = key_label_scale * len_elements_list
-        x_label_pad_inch = per_unit_to_inch_scale * x_label_pad_unit
-        y_label_pad_inch = per_unit_to_inch_scale * y_label_pad_unit
-
-
-        # build canvas dimensions
-        x_pad_unit = 1.0
-        y_pad_unit = 0.25
-        #x_pad_unit = 0.10
-        #y_pad_unit = 0.10
-        x_pad_inch = per_unit_to_inch_scale * x_pad_unit
-        y_pad_inch = per_unit_to_inch_scale * y_pad_unit
-        canvas_width_unit = 2*x_pad_unit + plot_width_unit + x_label_pad_unit
-        canvas_height_unit = 2*y_pad_unit + plot_height_unit + y_label_pad_unit
-        canvas_width_inch = per_unit_to_inch_scale * canvas_width_unit
-        canvas_height_inch = per_unit_to_inch_scale * canvas_height_unit
-
+    def _create_stacked_figure (self, figure_spec):
+        '''
+        Canvas, fraction classified bars and abundance axes of a prepared
+        figure, ready for a renderer to draw the stack on ax_bot
+        '''
+        N = len(figure_spec['sample_labels'])
+        bar_width_unit = figure_spec['bar_width_unit']
+        plot_x_pad_unit = figure_spec['plot_x_pad_unit']
 
         # instantiate fig
         #
         # lose axes with below grid, and so sharex property. instead match xlim, bar_width, hide ticks.
-        #fig, (ax_top, ax_bot) = plt.subplots(2, 1, sharex=True)
-
-        # gridspec_kw not in KBase docker notebook agg image (old python?)
-        #fig, (ax_top, ax_bot) = plt.subplots(2, 1, sharex=True, gridspec_kw = {'height_ratios':[1, 3]})
-
-        # subplot2grid(shape, loc, rowspan=1, colspan=1)
+        # gridspec_kw not in KBase docker notebook agg image (old python?), so subplot2grid(shape, loc, rowspan=1, colspan=1)
         FIG_rows = 1000
         FIG_cols = 1
-        top_frac = 0.22
-        top_rows = int(top_frac*FIG_rows)
+        top_rows = int(figure_spec['top_frac']*FIG_rows)
         bot_rows = FIG_rows-top_rows
         fig = plt.figure()
         ax_top = plt.subplot2grid((FIG_rows,FIG_cols), (0,0), rowspan=top_rows, colspan=1)
         ax_bot = plt.subplot2grid((FIG_rows,FIG_cols), (top_rows,0), rowspan=bot_rows, colspan=1)
-        fig.set_size_inches(canvas_width_inch, canvas_height_inch)
+        fig.set_size_inches(*figure_spec['canvas_size'])
         fig.tight_layout()
 
-
-        #for ax in fig.axes:
-        #    ax.xaxis.set_visible(False)  # remove axis labels and ticks
-        #    ax.yaxis.set_visible(False)
-        #    for t in ax.get_xticklabels()+ax.get_yticklabels():  # remove tick labels
-        #        t.set_visible(False)
-        #for ax in fig.axes:
-        #    ax.spines['top'].set_visible(False) # Get rid of top axis line
-        #    ax.spines['bottom'].set_visible(False) #  bottom axis line
-        #    ax.spines['left'].set_visible(False) #  Get rid of bottom axis line
-        #    ax.spines['right'].set_visible(False) #  Get rid of bottom axis line
-
-
         # indices
         ind = np.arange(N)    # the x locations for the groups
-        label_ind = []
-        for ind_i,this_ind in enumerate(ind):
-            ind[ind_i] = this_ind+bar_width_unit/2
-            label_ind.append(this_ind + bar_width_unit/2)
-        np_vals = []
-        for vec_i,val_vec in enumerate(vals):
-            np_vals.append(np.array(val_vec))
-
+        label_ind = ind + bar_width_unit/2
 
         # plot fraction measured
-        frac = ax_top.bar(ind, frac_vals, bar_width_unit, color='black', alpha=0.5, ec='none')
-        ax_top.set_title(title, fontsize=11)
+        ax_top.bar(ind, figure_spec['frac_vals'], bar_width_unit, color='black', alpha=0.5, ec='none', align='edge')
+        ax_top.set_title(figure_spec['title'], fontsize=11)
         ax_top.grid(b=True, axis='y')
-        ax_top.set_ylabel(frac_y_label, fontsize=10)
+        ax_top.set_ylabel(figure_spec['frac_y_label'], fontsize=10)
         ax_top.tick_params(axis='y', labelsize=9, labelcolor='black')
         ax_top.set_yticks(np.arange(0.0, 1.01, .20))
         ax_top.set_ylim([0,1])
         ax_top.xaxis.set_visible(False)  # remove axis labels and ticks
         ax_top.set_xlim([-plot_x_pad_unit,N-plot_x_pad_unit])
+        ax_top.set_position(figure_spec['top_pos'])
 
-        """
-        ax.stackplot (ind, np_vals, colors=color_names, alpha=0.5, edgecolor='none')
-
-        plt.ylabel(y_label)
-        plt.title(title)
-        plt.xticks(label_ind, sample_labels, ha='right', rotation=45)
-        plt.yticks(np.arange(0, 101, 10))
-
-        # creating the legend manually
-        key_colors = []
-        for color_i in reversed(np.arange(N-1)):
-            key_colors.append(mpatches.Patch(color=color_names[color_i], alpha=0.5, ec='black'))
-        box = ax.get_position()
-        ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-        plt.legend(key_colors, reversed(element_labels), loc='upper left', bbox_to_anchor=(1, 1))
-        """
-
-
-        # plot stacked
-        ax_bot.stackplot (ind, np_vals, colors=color_names, alpha=0.5, edgecolor='none')
-
-        ax_bot.set_ylabel(y_label, fontsize=10)
+        # abundance axes
+        ax_bot.set_ylabel(figure_spec['y_label'], fontsize=10)
         ax_bot.tick_params(axis='y', direction='in', length=4, width=0.5, colors='black', labelsize=9, labelcolor='black')
-        #plt.title(title)
-        #plt.xticks(label_ind, sample_labels, ha='right', rotation=45)
-        #ax_bot.set_xticks(label_ind, sample_labels, ha='center', rotation=90)
         ax_bot.tick_params(axis='x', direction='out', length=0, width=0, colors='black', labelsize=9, labelcolor='black')
         ax_bot.set_xticks(label_ind)
-        ax_bot.set_xticklabels(sample_labels, ha='center', rotation=90)
+        ax_bot.set_xticklabels(figure_spec['sample_labels'], ha='center', rotation=90)
         ax_bot.tick_params(axis='y', labelsize=9, labelcolor='black')
         ax_bot.set_yticks(np.arange(0, 101, 20))
         ax_bot.set_ylim([0,100])
         ax_bot.set_xlim([-plot_x_pad_unit,N-plot_x_pad_unit])
+        ax_bot.set_position(figure_spec['bot_pos'])
 
+        # add key
+        key_patches = []
+        for key_color in figure_spec['key_colors']:
+            if key_color is None:
+                key_patches.append(mpatches.Patch(facecolor='none', edgecolor='none'))
+            else:
+                key_patches.append(mpatches.Patch(facecolor=key_color, alpha=0.5, edgecolor='none'))
+        ax_bot.legend(key_patches, figure_spec['key_labels'], loc='upper left', bbox_to_anchor=(1,1), fontsize=9)
 
-        # are positions now in units (btw. 0-1) or inches?  seems to depend on the backend Agg
-        x_pad = x_pad_unit / canvas_width_unit
-        y_pad = y_pad_unit / canvas_height_unit
-        plot_width = plot_width_unit / canvas_width_unit
-        plot_height = plot_height_unit / canvas_height_unit
-        x_label_pad = x_label_pad_unit / canvas_width_unit
-        y_label_pad = y_label_pad_unit / canvas_height_unit
-
+        return (fig, ax_bot, ind)
 
-        # Frac Plot sizing
-        # don't shrink frac plot.  instead place it explictly since we built canvas for it
-        #
-        box = ax_top.get_position()
-#        ax_top.set_position([box.x0 + x_pad_inch,
-#                             box.y0 + y_pad_inch,
-#                             box.width - x_label_pad_inch - 2*x_pad_inch,
-#                             #box.height - y_pad_inch
-#                             box.height
-#                         ])
-        top_pos = [x_0, y_0, w, h] = [0 + x_pad,
-                                      (1.0 - top_frac)*plot_height + y_label_pad,
-                                      plot_width,
-                                      top_frac*plot_height - 2*y_pad
-                                  ]
-        ax_top.set_position(top_pos)
-
-        # DEBUG
-        #print ("AX_TOP: BOX:")
-        #print ([box.x0, box.y0, box.width, box.height])
-        #print ("AX_TOP: TOP_POS:")
-        #print (top_pos)
-
-
-        # Stacked Plot sizing
-        #   don't shrink plot.  instead place it explictly since we built canvas for it
-        #
-        box = ax_bot.get_position()
-        #ax_bot.set_position([box.x0 + x_pad_inch,
-        #                     #box.y0 + y_pad_inch + y_label_pad_inch,
-        #                     box.y0,
-        #                     box.width - x_label_pad_inch - 2*x_pad_inch,
-        #                     #box.height - y_label_pad_inch - y_pad_inch
-        #                     box.height
-        #                 ])
-        bot_pos = [x_0, y_0, w, h] = [0 + x_pad,
-                                      0 + y_label_pad + y_pad,
-                                      plot_width,
-                                      (1.0 - top_frac)*plot_height - 2*y_pad
-                                  ]
-        ax_bot.set_position(bot_pos)
-
-        # DEBUG
-        #print ("AX_BOT: BOX:")
-        #print ([box.x0, box.y0, box.width, box.height])
-        #print ("AX_BOT: BOT_POS:")
-        #print (bot_pos)
-
-
-        """
-        # add key
-        key_colors = []
-        for each_p in reversed(p):
-            key_colors.append(each_p[0])
-        ax_bot.legend(key_colors, reversed(element_labels), loc='upper left', bbox_to_anchor=(1,1), fontsize=9)
-        """
 
-        # create the legend manually
-        w_scale = 0.8
-        key_colors = []
-        for color_i in reversed(np.arange(N-1)):
-            key_colors.append(mpatches.Patch(color=color_names[color_i], alpha=0.5, ec='black'))
-        box = ax_top.get_position()
-        ax_top.set_position([box.x0, box.y0, box.width * w_scale, box.height])
-        box = ax_bot.get_position()
-        ax_bot.set_position([box.x0, box.y0, box.width * w_scale, box.height])
-        ax_bot.legend(key_colors, reversed(element_labels), loc='upper left', bbox_to_anchor=(1, 1))
-
-
-        # save
-        img_dpi = 200
-        #plt.show()
-        log("SAVING STACKED AREA PLOT")
-        png_file = out_file_basename+'.png'
+    def _save_stacked_figure (self, fig, out_folder, out_file_basename, num_elements):
+        '''
+        PDF for download, and the report image (format by image_policy).
+        Returns the path of the report image.
+        '''
         pdf_file = out_file_basename+'.pdf'
-        output_png_file_path = os.path.join(out_folder, png_file);
         output_pdf_file_path = os.path.join(out_folder, pdf_file);
-        fig.savefig(output_png_file_path, dpi=img_dpi)
+        # a redrawn plot mustn't write through to the report's link to the old one
+        self.artifacts.unshare(output_pdf_file_path)
+        self.artifacts.unshare(os.path.join(out_folder, out_file_basename+'.'+self.image_policy.get_format(num_elements)))
         fig.savefig(output_pdf_file_path, format='pdf')
+        output_img_file_path = self.image_policy.save_figure(fig, os.path.join(out_folder, out_file_basename), num_elements)
+        plt.close(fig)
+
+        return output_img_file_path
+
+
+    def _create_bar_plots (self, out_folder=None, out_file_basename=None, figure_spec=None):
+        (fig, ax_bot, ind) = self._create_stacked_figure(figure_spec)
+        np_vals = figure_spec['vals']
+        bar_width_unit = figure_spec['bar_width_unit']
+
+        # plot stacked, as a single collection of the non-empty cells (a bar call per
+        # element makes thousands of artists at species level, and savefig crawls)
+        stack_tops = np.cumsum(np_vals, axis=0)
+        (cell_element_i, cell_sample_i) = np.nonzero(np_vals)
+        cell_x0 = ind[cell_sample_i].astype(float)
+        cell_x1 = cell_x0 + bar_width_unit
+        cell_y1 = stack_tops[cell_element_i, cell_sample_i]
+        cell_y0 = cell_y1 - np_vals[cell_element_i, cell_sample_i]
+        cell_verts = np.empty((len(cell_element_i), 4, 2))
+        cell_verts[:,0,0] = cell_x0
+        cell_verts[:,0,1] = cell_y0
+        cell_verts[:,1,0] = cell_x0
+        cell_verts[:,1,1] = cell_y1
+        cell_verts[:,2,0] = cell_x1
+        cell_verts[:,2,1] = cell_y1
+        cell_verts[:,3,0] = cell_x1
+        cell_verts[:,3,1] = cell_y0
+        stacked = PolyCollection(cell_verts, facecolors=figure_spec['colors'][cell_element_i], edgecolors='none', alpha=0.5)
+        ax_bot.add_collection(stacked)
 
-        return output_png_file_path
-
-
-
-
-    def _create_area_plots_OLD (self, abundances):
-        color_names = self.no_light_color_names
-
-        import numpy as np
-        import matplotlib.pyplot as plt
-        import matplotlib.patches as mpatches
-        import random
-        from random import shuffle
-
-        y_label = 'percent'
-        title = 'Lineage Proportion'
-        sample_labels = ['sample1', 'sample2', 'sample3', 'sample4', 'sample5']
-        element_labels = ['OTU_1', 'OTU_2', 'OTU_3', 'OTU_4']
-
-        N = len(sample_labels)
-        random.seed(a=len(element_labels))
-
-        r = random.random()
-        shuffle(color_names, lambda: r)
+        log("SAVING STACKED BAR PLOT")
+        return self._save_stacked_figure(fig, out_folder, out_file_basename, len(cell_element_i))
 
-        vals = [[20, 35, 20, 35, 27],
-                [25, 22, 34, 20, 15],
-                [45, 33, 36, 35, 48],
-                [10, 10, 10, 10, 10]
-            ]
-        ind = np.arange(N)    # the x locations for the groups
-        label_ind = ind
 
-        np_vals = []
-        for vec_i,val_vec in enumerate(vals):
-            np_vals.append(np.array(val_vec))
+    def _create_area_plots (self, out_folder=None, out_file_basename=None, figure_spec=None):
+        (fig, ax_bot, ind) = self._create_stacked_figure(figure_spec)
 
-        # Build image
-        if N < 10:
-            img_in_width = 2*N
-        elif N < 20:
-            img_in_width = N
-        else:
-            img_in_width = 20
-        img_in_height = 5
-        fig = plt.figure()
-        fig.set_size_inches(img_in_width, img_in_height)
-        ax = plt.subplot(111)
-
-        # Let's turn off visibility of all tic labels and boxes here
-        #for ax in fig.axes:
-        #    ax.xaxis.set_visible(False)  # remove axis labels and tics
-        #    ax.yaxis.set_visible(False)
-        #    for t in ax.get_xticklabels()+ax.get_yticklabels():  # remove tics
-        #        t.set_visible(False)
-        #    ax.spines['top'].set_visible(False)     # Get rid of top axis line
-        #    ax.spines['bottom'].set_visible(False)  # bottom axis line
-        #    ax.spines['left'].set_visible(False)    # left axis line
-        #    ax.spines['right'].set_visible(False)   # right axis line
-
-        ax.stackplot (ind, np_vals, colors=color_names, alpha=0.5, edgecolor='none')
-
-        plt.ylabel(y_label)
-        plt.title(title)
-        plt.xticks(label_ind, sample_labels, ha='right', rotation=45)
-        plt.yticks(np.arange(0, 101, 10))
-
-        # creating the legend manually
-        key_colors = []
-        for color_i in reversed(np.arange(N-1)):
-            key_colors.append(mpatches.Patch(color=color_names[color_i], alpha=0.5, ec='black'))
-        box = ax.get_position()
-        ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-        plt.legend(key_colors, reversed(element_labels), loc='upper left', bbox_to_anchor=(1, 1))
+        # plot stacked
+        ax_bot.stackplot (ind, figure_spec['vals'], colors=[tuple(color) for color in figure_spec['colors']], alpha=0.5, edgecolor='none')
 
-        #plt.grid()
-        plt.show()
+        log("SAVING STACKED AREA PLOT")
+        return self._save_stacked_figure(fig, out_folder, out_file_basename, len(figure_spec['element_labels']))
 
 
-    def _build_plot_html_header(self, title):
+    def _build_plot_html_header(self, title, top_nav=None):
         buf = []
         buf.append('<html>')
         buf.append('<head>')
@@ -1521,6 +1170,8 @@ class OutputBuilder(object):
         buf.append(style)
         buf.append('</head>')
         buf.append('<body>')
+        if top_nav is not None:
+            buf.append(top_nav)
 
         return buf
 
@@ -0,0 +1,334 @@
+import os
+import re
+import mmap
+import threading
+import numpy as np
+
+
+# read id normalization, so fwd and rev mates compare equal
+#   e.g. @SRR5891520.1.1 (forward) & @SRR5891520.1.2 (reverse)
+READ_ID_DESC_RE   = re.compile(br"[ \t]+.*$")
+READ_ID_MATE_RE   = re.compile(br"[\/\.\_\-\:\;][012lrLRfrFR53]\'*$")
+
+
+def normalize_read_id(header_line):
+    read_id = header_line.rstrip(b'\r\n')
+    read_id = READ_ID_DESC_RE.sub(b"", read_id)
+    read_id = b''.join(read_id.rsplit(b'.', 1))  # replace last '.' with ''
+    read_id = READ_ID_MATE_RE.sub(b"", read_id)
+    return read_id
+
+
+class ReadsSubsampler(object):
+    '''
+    Splits a reads library into non-overlapping random replicate subsamples.
+
+    Replicate membership is held in a compact integer array indexed by read
+    ordinal (-1 = not sampled), so no read id strings are kept in memory.
+    The array is int8 unless there are more than 128 replicates.
+    For paired libraries whose fwd and rev mates are in the same order, the
+    fwd and rev replicates are written together in one synchronized pass.
+    subsample() returns None when the mates are not in the same order, and
+    the caller should fall back to id-based pairing.
+    '''
+
+    def __init__(self, subsample_percent=10, subsample_replicates=1, subsample_seed=1):
+        self.subsample_percent = subsample_percent
+        self.split_num = subsample_replicates
+        self.subsample_seed = subsample_seed
+        self.SE_flag = 'SE'
+        self.PE_flag = 'PE'
+
+
+    def subsample(self, input_item):
+        if input_item['type'] == self.PE_flag:
+            print ("SUBSAMPLING PE library "+input_item['name']+" (single pass)")
+            in_files = [input_item['fwd_file'], input_item['rev_file']]
+            out_bases = [self._strip_fastq_ext(input_item['fwd_file'])+"_fwd_paired",
+                         self._strip_fastq_ext(input_item['rev_file'])+"_rev_paired"]
+        elif input_item['type'] == self.SE_flag:
+            print ("SUBSAMPLING SE library "+input_item['name']+" (single pass)")
+            in_files = [input_item['fwd_file']]
+            out_bases = [self._strip_fastq_ext(input_item['fwd_file'])+"_fwd_paired"]
+        else:
+            raise ValueError ("unknown ReadLibrary type:"+str(input_item['type'])+" for readslibrary: "+input_item['name'])
+
+        # count records (and confirm mates line up)
+        total_reads = self._count_records(in_files)
+        if total_reads is None:
+            print ("MATES NOT IN SAME ORDER in "+input_item['name'])
+            return None
+        print ("TOTAL READS CNT: "+str(total_reads))
+
+        # assign replicates and write them
+        assignment = self.assign_replicates(total_reads)
+        out_paths = [[out_base+"-"+str(lib_i)+".fastq" for lib_i in range(self.split_num)] for out_base in out_bases]
+        reads_by_set = self._write_replicates(in_files, out_paths, assignment)
+
+        # summary
+        report = 'SUMMARY FOR SUBSAMPLE OF READ LIBRARY: '+input_item['name']+"\n"
+        report += "TOTAL READS: "+str(total_reads)+"\n"
+        for lib_i in range(self.split_num):
+            report += "READS IN SET "+str(lib_i)+": "+str(reads_by_set[lib_i])+"\n"
+        print (report)
+
+        # make replicate objects to return
+        replicate_files = []
+        for lib_i in range(self.split_num):
+            for file_paths in out_paths:
+                if not os.path.isfile (file_paths[lib_i]) or os.path.getsize (file_paths[lib_i]) == 0:
+                    raise ValueError ("failed to create subsample output "+file_paths[lib_i])
+            zero_pad = '0'*(len(str(self.split_num))-len(str(lib_i+1)))
+            replicate_file = {'fwd_file': out_paths[0][lib_i],
+                              'ref':  input_item['ref'],  # note: this is for the src, not the subsample which is not saved
+                              'type': input_item['type'],
+                              'name': input_item['name']+'-'+zero_pad+str(lib_i+1)
+                          }
+            if input_item['type'] == self.PE_flag:
+                replicate_file['rev_file'] = out_paths[1][lib_i]
+            replicate_files.append(replicate_file)
+
+        return replicate_files
+
+
+    def assign_replicates(self, total_reads):
+        '''
+        Returns an array over read ordinals holding the replicate index
+        each read belongs to, or -1 for reads not sampled.  Ordinals and
+        replicate indexes get dtypes wide enough for the read count and
+        number of replicates.
+        '''
+        reads_per_lib = int ((self.subsample_percent/100.0) * total_reads)
+        if reads_per_lib > total_reads // self.split_num:
+            raise ValueError ("must specify reads_perc <= 1 / split_num.  You have reads_perc:"+str(self.subsample_percent)+" > 1 / split_num:"+str(self.split_num)+".  Instead try reads_perc <= "+ str(int(100 * 1/self.split_num)))
+
+        # shuffle ordinals in place rather than holding a list of read ids
+        # (the permutation for a seed doesn't depend on the dtype)
+        ordinal_dtype = np.uint32 if total_reads <= np.iinfo(np.uint32).max + 1 else np.uint64
+        for replicate_dtype in [np.int8, np.int16, np.int32]:
+            if self.split_num - 1 <= np.iinfo(replicate_dtype).max:
+                break
+        # RandomState only takes seeds below 2**32, and the default seed (from the run suffix) is larger
+        rng = np.random.RandomState(int(self.subsample_seed) % 2**32)
+        ordinals = np.arange(total_reads, dtype=ordinal_dtype)
+        rng.shuffle(ordinals)
+        sampled = ordinals[:reads_per_lib * self.split_num]
+
+        assignment = np.full(total_reads, -1, dtype=replicate_dtype)
+        assignment[sampled] = np.arange(len(sampled)) % self.split_num
+        return assignment
+
+
+    def _count_records(self, in_files):
+        '''
+        Count FASTQ records.  With two files, also checks that each record's
+        mate is at the same ordinal.  Returns None if they aren't.
+        '''
+        mapped = [self._map_file(in_file) for in_file in in_files]
+        try:
+            if len(mapped) == 1:
+                return sum(len(ends) for (first_ordinal, starts, header_ends, ends) in self._iter_record_bounds(mapped[0]))
+
+            rec_cnt = 0
+            mate_headers = [self._iter_headers(data) for data in mapped[1:]]
+            for fwd_header in self._iter_headers(mapped[0]):
+                fwd_id = None
+                for mate_iter in mate_headers:
+                    mate_header = next(mate_iter, None)
+                    if mate_header is None:
+                        return None  # rev shorter than fwd
+                    # fast path: identical id token (e.g. Casava 1.8 '@id 1:N:...' / '@id 2:N:...')
+                    if mate_header.split(None, 1)[0] == fwd_header.split(None, 1)[0]:
+                        continue
+                    if fwd_id is None:
+                        fwd_id = normalize_read_id(fwd_header)
+                    if normalize_read_id(mate_header) != fwd_id:
+                        return None
+                rec_cnt += 1
+            for mate_iter in mate_headers:
+                if next(mate_iter, None) is not None:
+                    return None  # rev longer than fwd
+            return rec_cnt
+        finally:
+            for data in mapped:
+                self._unmap_file(data)
+
+
+    def _write_replicates(self, in_files, out_paths, assignment):
+        '''
+        Writes each sampled record to its replicate in every file.  All input
+        files are written in the same pass, one thread per file.
+        '''
+        results = [None] * len(in_files)
+        errors = []
+
+        def write_file(file_i):
+            try:
+                results[file_i] = self._write_file_replicates(in_files[file_i], out_paths[file_i], assignment)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write_file, args=(file_i,)) for file_i in range(len(in_files))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if len(errors) > 0:
+            raise errors[0]
+        return results[0]
+
+
+    def _write_file_replicates(self, in_file, out_paths, assignment):
+        '''
+        Operates on the raw bytes of the mmapped input.  Record boundaries are
+        found with vectorized newline search, and selected records go out as
+        slices of the input buffer (adjacent records for the same replicate
+        coalesced), batched into writev calls on unbuffered descriptors.
+        '''
+        reads_by_set = [0] * self.split_num
+        out_fds = [os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o664) for out_path in out_paths]
+        pending = [[] for lib_i in range(self.split_num)]
+        data = self._map_file(in_file)
+        view = None
+        try:
+            if data is None:
+                return reads_by_set
+            view = self._buffer_view(data)
+            run_lib = -1
+            run_start = run_end = 0
+            for (first_ordinal, starts, header_ends, ends) in self._iter_record_bounds(data):
+                if first_ordinal + len(ends) > len(assignment):
+                    raise ValueError ("more records in "+in_file+" than were counted")
+                libs = assignment[first_ordinal:first_ordinal+len(ends)]
+                selected = np.flatnonzero(libs >= 0)
+                for (lib_i, start, end) in zip(libs[selected].tolist(), starts[selected].tolist(), ends[selected].tolist()):
+                    reads_by_set[lib_i] += 1
+                    if lib_i == run_lib and start == run_end:
+                        run_end = end
+                        continue
+                    if run_lib >= 0:
+                        self._queue_write(out_fds[run_lib], pending[run_lib], view[run_start:run_end])
+                    (run_lib, run_start, run_end) = (lib_i, start, end)
+            if run_lib >= 0:
+                self._queue_write(out_fds[run_lib], pending[run_lib], view[run_start:run_end])
+                if data[len(data)-1:len(data)] != b'\n':
+                    if run_end == len(data):
+                        self._queue_write(out_fds[run_lib], pending[run_lib], b'\n')
+            for lib_i in range(self.split_num):
+                self._flush_writes(out_fds[lib_i], pending[lib_i])
+            print ("\t"+str(sum(reads_by_set))+" recs written from "+in_file)
+        finally:
+            for fd in out_fds:
+                os.close(fd)
+            if isinstance(view, memoryview):
+                view.release()
+            self._unmap_file(data)
+        return reads_by_set
+
+
+    def _iter_record_bounds(self, data, chunk_size=64*1024*1024):
+        '''
+        Yields (first_ordinal, starts, header_ends, ends) arrays of byte offsets
+        for the 4-line records in each chunk of the mmapped file.  Newlines are
+        located with numpy rather than line by line in python.
+        '''
+        if data is None:
+            return
+        buf = np.frombuffer(data, dtype=np.uint8)
+        total_len = len(buf)
+        lines_before = 0
+        records_before = 0
+        record_start = 0
+        header_end = None
+        for chunk_start in range(0, total_len, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, total_len)
+            newlines = np.flatnonzero(buf[chunk_start:chunk_end] == 10) + chunk_start
+            if chunk_end == total_len and buf[total_len-1] != 10:
+                newlines = np.append(newlines, total_len-1)  # last line without trailing newline
+            line_i = (np.arange(len(newlines)) + lines_before) % 4
+            lines_before += len(newlines)
+
+            header_ends = newlines[line_i == 0]
+            ends = newlines[line_i == 3] + 1
+            if len(ends) == 0:
+                if header_end is None and len(header_ends) > 0:
+                    header_end = header_ends[0]
+                continue
+            starts = np.concatenate(([record_start], ends[:-1]))
+            if header_end is not None:
+                header_ends = np.concatenate(([header_end], header_ends))
+            header_end = header_ends[len(ends)] if len(header_ends) > len(ends) else None
+            header_ends = header_ends[:len(ends)]
+            record_start = ends[-1]
+
+            bad = np.flatnonzero(buf[starts] != ord('@'))
+            if len(bad) > 0:
+                bad_start = starts[bad[0]]
+                raise ValueError ("badly formatted rec line: '"+bytes(data[bad_start:header_ends[bad[0]]]).decode('utf-8', 'replace')+"'")
+
+            yield (records_before, starts, header_ends, ends)
+            records_before += len(ends)
+
+
+    def _iter_headers(self, data):
+        for (first_ordinal, starts, header_ends, ends) in self._iter_record_bounds(data):
+            for (start, header_end) in zip(starts.tolist(), header_ends.tolist()):
+                yield data[start:header_end]
+
+
+    def _map_file(self, in_file):
+        if os.path.getsize(in_file) == 0:
+            return None
+        with open(in_file, 'rb') as in_handle:
+            return mmap.mmap(in_handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def _unmap_file(self, data):
+        if data is None:
+            return
+        try:
+            data.close()
+        except BufferError:
+            pass  # a numpy view is still alive (e.g. early return mid-scan), mapping is freed with it
+
+
+    def _buffer_view(self, data):
+        # py2 mmap doesn't support memoryview, in which case slices are copies
+        try:
+            return memoryview(data)
+        except TypeError:
+            return data
+
+
+    def _queue_write(self, fd, pending, record_slice, max_iov=512):
+        pending.append(record_slice)
+        if len(pending) >= max_iov:
+            self._flush_writes(fd, pending)
+
+
+    def _flush_writes(self, fd, pending):
+        if len(pending) == 0:
+            return
+        if hasattr(os, 'writev'):
+            written = os.writev(fd, pending)
+            # finish a short write
+            for record_slice in pending:
+                if written >= len(record_slice):
+                    written -= len(record_slice)
+                    continue
+                self._write_all(fd, memoryview(record_slice)[written:])
+                written = 0
+        else:
+            for record_slice in pending:
+                self._write_all(fd, record_slice)
+        del pending[:]
+
+
+    def _write_all(self, fd, record_slice):
+        while len(record_slice) > 0:
+            record_slice = record_slice[os.write(fd, record_slice):]
+
+
+    def _strip_fastq_ext(self, path):
+        path = re.sub (r"\.fastq$", "", path)
+        return re.sub (r"\.FASTQ$", "", path)
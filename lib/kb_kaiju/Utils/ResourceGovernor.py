@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+MB = 1024*1024
+
+# cgroup v2, then v1: the container's own limit, which /proc/meminfo doesn't show
+CGROUP_MEMORY_FILES = [(os.path.join(os.path.sep, 'sys', 'fs', 'cgroup', 'memory.max'),
+                        os.path.join(os.path.sep, 'sys', 'fs', 'cgroup', 'memory.current')),
+                       (os.path.join(os.path.sep, 'sys', 'fs', 'cgroup', 'memory', 'memory.limit_in_bytes'),
+                        os.path.join(os.path.sep, 'sys', 'fs', 'cgroup', 'memory', 'memory.usage_in_bytes'))
+                   ]
+
+
+def read_meminfo(meminfo_file=os.path.join(os.path.sep, 'proc', 'meminfo')):
+    '''
+    /proc/meminfo as a dict of bytes
+    '''
+    meminfo = dict()
+    with open(meminfo_file, 'r') as meminfo_handle:
+        for meminfo_line in meminfo_handle:
+            fields = meminfo_line.split()
+            if len(fields) < 2:
+                continue
+            val = int(fields[1])
+            if len(fields) > 2 and fields[2] == 'kB':
+                val *= 1024
+            meminfo[fields[0].rstrip(':')] = val
+    return meminfo
+
+
+def get_available_memory():
+    '''
+    Bytes that can be allocated without swapping: MemAvailable (or its
+    older approximation), capped by the cgroup limit if we're in one
+    '''
+    meminfo = read_meminfo()
+    if 'MemAvailable' in meminfo:
+        available = meminfo['MemAvailable']
+    else:
+        available = meminfo['MemFree'] + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+
+    for (limit_file, usage_file) in CGROUP_MEMORY_FILES:
+        try:
+            with open(limit_file, 'r') as limit_handle:
+                limit = limit_handle.read().strip()
+            with open(usage_file, 'r') as usage_handle:
+                usage = int(usage_handle.read().strip())
+        except (IOError, OSError, ValueError):
+            continue
+        if limit != 'max' and int(limit) < meminfo['MemTotal']:
+            available = min(available, max(0, int(limit) - usage))
+        break
+    return available
+
+
+class ResourceGovernor(object):
+    '''
+    Admits external processes (kaiju, kaiju2table, ktImportText) against a
+    memory and CPU budget.  Each caller states what its process needs;
+    admit() blocks until that fits alongside everything already running.
+    Waiters are admitted in arrival order, so a big nr job at the head of
+    the line isn't starved by a stream of small ones behind it.
+
+    Light tools (kaiju2table, ktImportText: one thread, short lived) queue
+    in a lane of their own, with light_cpus of the cpus set aside for them,
+    so a sample's reports run while kaiju classifies the next sample instead
+    of waiting behind it.  Both lanes share the memory budget.
+
+    A request larger than the whole budget runs once nothing else does,
+    rather than never.  Memory used outside the governor is respected by
+    also checking what the system reports free before admitting a task
+    next to running ones.
+    '''
+
+    def __init__(self, mem_budget, cpu_budget, poll_interval=5, light_cpus=0):
+        self.mem_budget = int(mem_budget)
+        self.light_cpu_budget = max(0, int(light_cpus))
+        self.cpu_budget = max(1, int(cpu_budget) - self.light_cpu_budget)
+        self.poll_interval = poll_interval
+        self.mem_in_use = 0
+        self.cpus_in_use = 0
+        self.light_cpus_in_use = 0
+        self.running = 0
+        self.waiting = []
+        self.light_waiting = []
+        self.cond = threading.Condition()
+
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        Budget from deploy.cfg resource-memory-mb and resource-cpus, where
+        blank means what the system has (less resource-memory-reserve-mb).
+        resource-light-cpus of the cpus (default 1) are set aside for light
+        tools.
+        '''
+        if config.get('resource-memory-mb'):
+            mem_budget = int(config['resource-memory-mb']) * MB
+        else:
+            mem_reserve = int(config.get('resource-memory-reserve-mb') or 1024) * MB
+            mem_budget = max(0, get_available_memory() - mem_reserve)
+        if config.get('resource-cpus'):
+            cpu_budget = int(config['resource-cpus'])
+        else:
+            cpu_budget = multiprocessing.cpu_count()
+        light_cpus = config.get('resource-light-cpus')
+        light_cpus = int(light_cpus) if light_cpus else 1
+        log('resource governor budget: '+str(mem_budget // MB)+' MB, '+str(cpu_budget)+' cpus ('
+            +str(light_cpus)+' for light tools)')
+        return cls(mem_budget, cpu_budget, light_cpus=light_cpus)
+
+
+    def _fits(self, mem, cpus, light):
+        if self.running == 0:
+            return True
+        if self.mem_in_use + mem > self.mem_budget:
+            return False
+        if light:
+            if self.light_cpus_in_use + cpus > self.light_cpu_budget:
+                return False
+        elif self.cpus_in_use + cpus > self.cpu_budget:
+            return False
+        return get_available_memory() >= mem
+
+
+    def acquire(self, name, mem, cpus=1, light=False):
+        '''
+        Block until mem and cpus fit, in light's lane.  Returns the
+        reservation to release().  Without a light lane (light_cpus 0),
+        light tools queue with the rest.
+        '''
+        light = light and self.light_cpu_budget > 0
+        mem = int(mem)
+        cpus = min(max(1, int(cpus)), self.light_cpu_budget if light else self.cpu_budget)
+        waiting = self.light_waiting if light else self.waiting
+        ticket = object()
+        with self.cond:
+            waiting.append(ticket)
+            logged = False
+            while waiting[0] is not ticket or not self._fits(mem, cpus, light):
+                if not logged:
+                    log('queued '+name+' (needs '+str(mem // MB)+' MB, '+str(cpus)+' cpus; in use '
+                        +str(self.mem_in_use // MB)+' of '+str(self.mem_budget // MB)+' MB, '
+                        +(str(self.light_cpus_in_use)+' of '+str(self.light_cpu_budget)+' light' if light else
+                          str(self.cpus_in_use)+' of '+str(self.cpu_budget))+' cpus)')
+                    logged = True
+                # poll too, as memory freed outside the governor doesn't notify
+                self.cond.wait(self.poll_interval)
+            waiting.pop(0)
+            self.mem_in_use += mem
+            if light:
+                self.light_cpus_in_use += cpus
+            else:
+                self.cpus_in_use += cpus
+            self.running += 1
+            self.cond.notify_all()
+        if logged:
+            log('admitted '+name)
+        return (mem, cpus, light)
+
+
+    def release(self, reservation):
+        (mem, cpus, light) = reservation
+        with self.cond:
+            self.mem_in_use -= mem
+            if light:
+                self.light_cpus_in_use -= cpus
+            else:
+                self.cpus_in_use -= cpus
+            self.running -= 1
+            self.cond.notify_all()
+
+
+    @contextmanager
+    def admit(self, name, mem, cpus=1, light=False):
+        reservation = self.acquire(name, mem, cpus, light=light)
+        try:
+            yield
+        finally:
+            self.release(reservation)
+
+
+resource_governor = None
+resource_governor_lock = threading.Lock()
+
+
+def get_resource_governor(config=None):
+    '''
+    The governor shared by every job in this process, so concurrent app
+    runs on one node are admitted against the same budget
+    '''
+    global resource_governor
+    with resource_governor_lock:
+        if resource_governor is None:
+            resource_governor = ResourceGovernor.from_config(config or dict())
+        return resource_governor
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import json
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+class StageCheckpoint(object):
+    '''
+    Records a completion manifest for each stage of run_kaiju_with_krona under
+    <output_dir>/checkpoints/<stage>.json.  A manifest holds the stage inputs,
+    its output files with sizes and modification times, and the stage's return
+    value so that a resumed run can pick up where a preempted run stopped.
+    Outputs aren't checksummed: reading back every classification file would
+    cost as much I/O as a stage on every run, resumed or not.
+
+    Manifests are always written.  They are only consulted when resume is set.
+    '''
+
+    def __init__(self, output_dir, resume=False):
+        self.checkpoint_dir = os.path.join(output_dir, 'checkpoints')
+        self.resume = resume
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+
+    def is_complete(self, stage, inputs=None):
+        '''
+        True if resume is on and the stage has a manifest with matching inputs
+        whose output files are all still present and unchanged.
+        '''
+        if not self.resume:
+            return False
+        manifest = self._read_manifest(stage)
+        if manifest is None:
+            return False
+        if manifest['inputs'] != self._normalize(inputs):
+            log('checkpoint for stage '+stage+' has different inputs, rerunning')
+            return False
+        for output in manifest['outputs']:
+            if not os.path.isfile(output['path']) \
+               or os.path.getsize(output['path']) != output['size'] \
+               or os.path.getmtime(output['path']) != output.get('mtime'):
+                log('checkpoint for stage '+stage+' has missing or changed output '+output['path']+', rerunning')
+                return False
+        return True
+
+
+    def get_result(self, stage):
+        return self._read_manifest(stage)['result']
+
+
+    def mark_complete(self, stage, inputs=None, outputs=None, result=None):
+        '''
+        outputs may contain files or folders.  Folders are expanded to all
+        files beneath them.
+        '''
+        output_files = []
+        for output in (outputs or []):
+            if os.path.isdir(output):
+                for (dir_path, dir_names, file_names) in os.walk(output):
+                    for file_name in sorted(file_names):
+                        output_files.append(os.path.join(dir_path, file_name))
+            else:
+                output_files.append(output)
+
+        manifest = {'stage':     stage,
+                    'completed': time.time(),
+                    'inputs':    self._normalize(inputs),
+                    'outputs':   [{'path':  path,
+                                   'size':  os.path.getsize(path),
+                                   'mtime': os.path.getmtime(path)
+                               } for path in output_files],
+                    'result':    result
+                }
+
+        # write then rename so a crash never leaves a partial manifest
+        manifest_path = self._manifest_path(stage)
+        with open(manifest_path+'.tmp', 'w') as manifest_handle:
+            json.dump(manifest, manifest_handle, indent=1)
+        os.rename(manifest_path+'.tmp', manifest_path)
+
+
+    def run_stage(self, stage, inputs, stage_func, outputs=None):
+        '''
+        Return the recorded result of a completed stage, or run stage_func()
+        and record its result.  outputs is a list of paths, or a function
+        mapping the result to a list of paths.
+        '''
+        if self.is_complete(stage, inputs):
+            log('RESUMING: skipping completed stage '+stage)
+            return self.get_result(stage)
+
+        result = stage_func()
+        if callable(outputs):
+            outputs = outputs(result)
+        self.mark_complete(stage, inputs, outputs, result)
+        return result
+
+
+    def _manifest_path(self, stage):
+        return os.path.join(self.checkpoint_dir, stage.replace(os.path.sep, '_')+'.json')
+
+
+    def _read_manifest(self, stage):
+        manifest_path = self._manifest_path(stage)
+        if not os.path.isfile(manifest_path):
+            return None
+        with open(manifest_path, 'r') as manifest_handle:
+            return json.load(manifest_handle)
+
+
+    def _normalize(self, obj):
+        # round trip through json so that tuples, unicode etc. compare equal to a reloaded manifest
+        return json.loads(json.dumps(obj, sort_keys=True))
+
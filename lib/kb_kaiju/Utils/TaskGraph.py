@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+class TaskGraph(object):
+    '''
+    Runs tasks as soon as the tasks they depend on are done, up to workers
+    at a time, earliest added first.  Tasks may be added while the graph
+    runs (e.g. a sample's downstream tasks once it's classified), but only
+    after the tasks they depend on.
+
+    A failing task stops the graph: nothing else is started, on_failure()
+    is called (e.g. to cancel running tools), and wait() raises the task's
+    exception once the running tasks have returned.
+    '''
+
+    def __init__(self, workers=4, on_failure=None):
+        self.workers = max(1, int(workers))
+        self.on_failure = on_failure
+        self.tasks = OrderedDict()  # name -> task, in the order added
+        self.running = 0
+        self.error = None
+        self.cond = threading.Condition()
+
+
+    def add(self, name, func, deps=None):
+        '''
+        Add task name, which runs func() once every task in deps is done.
+        Returns name, for use in later deps.
+        '''
+        with self.cond:
+            if name in self.tasks:
+                raise ValueError ('duplicate task: '+name)
+            for dep in (deps or []):
+                if dep not in self.tasks:
+                    raise ValueError ('unknown dependency '+dep+' of task '+name)
+            self.tasks[name] = {'func':   func,
+                                'deps':   list(deps or []),
+                                'state':  'waiting',
+                                'result': None}
+            self._start_ready()
+        return name
+
+
+    def _start_ready(self):
+        '''
+        Start waiting tasks whose deps are done.  Called with the lock held.
+        '''
+        if self.error is not None:
+            return
+        for (name, task) in self.tasks.items():
+            if self.running >= self.workers:
+                break
+            if task['state'] != 'waiting':
+                continue
+            if not all([self.tasks[dep]['state'] == 'done' for dep in task['deps']]):
+                continue
+            task['state'] = 'running'
+            self.running += 1
+            task_thread = threading.Thread(target=self._run_task, args=(name,))
+            task_thread.daemon = True
+            task_thread.start()
+
+
+    def _run_task(self, name):
+        task = self.tasks[name]
+        try:
+            result = task['func']()
+            error = None
+        except Exception as e:
+            result = None
+            error = e
+        first_error = False
+        with self.cond:
+            self.running -= 1
+            if error is None:
+                task['state'] = 'done'
+                task['result'] = result
+            else:
+                task['state'] = 'failed'
+                if self.error is None:
+                    self.error = error
+                    first_error = True
+            self._start_ready()
+            self.cond.notify_all()
+        if first_error:
+            log('task '+name+' failed ('+str(error)+'), stopping')
+            if self.on_failure is not None:
+                self.on_failure('after task '+name+' failed')
+
+
+    def wait(self, names=None):
+        '''
+        Wait for tasks names (default: every task added, including those
+        added while waiting).  Returns their results, in order.
+        '''
+        with self.cond:
+            while True:
+                if self.error is not None:
+                    if self.running == 0:
+                        raise self.error
+                else:
+                    wait_names = names if names is not None else list(self.tasks.keys())
+                    if all([self.tasks[name]['state'] == 'done' for name in wait_names]):
+                        return [self.tasks[name]['result'] for name in wait_names]
+                self.cond.wait(1)
+
+
+    def get_result(self, name):
+        with self.cond:
+            return self.tasks[name]['result']
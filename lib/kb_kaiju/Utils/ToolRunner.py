@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import signal
+import subprocess
+import threading
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+    sys.stdout.flush()
+
+
+# after SIGTERM, a tool gets this long to exit before SIGKILL
+KILL_GRACE_SECS = 10
+
+# tools without a log file share this process's stdout a line at a time
+stdout_lock = threading.Lock()
+
+
+class ToolTask(object):
+    '''
+    One external tool run (kaiju, kaiju2table, ktImportText, ...) started by
+    ToolRunner.  state goes queued -> running -> done, failed, timed_out or
+    cancelled.
+    '''
+
+    def __init__(self, name, command, log_file=None, timeout=None, ram=None, cpus=1, light=False):
+        self.name = name
+        self.command = command
+        self.log_file = log_file
+        self.timeout = timeout
+        self.ram = ram
+        self.cpus = cpus
+        self.light = light
+        self.state = 'queued'
+        self.exit_code = None
+        self.exception = None
+        self.proc = None
+        self.finished = threading.Event()
+
+
+    def get_error(self):
+        if self.state == 'timed_out':
+            return 'Timed out after '+str(self.timeout)+'s running command: '+' '.join(self.command)
+        if self.state == 'failed' and self.exception is not None:
+            return 'Error running command: '+' '.join(self.command)+'\n'+self.exception
+        if self.state == 'failed':
+            return 'Error running command: '+' '.join(self.command)+'\n'+'Exit Code: '+str(self.exit_code)
+        return None
+
+
+class ToolRunner(object):
+    '''
+    Runs external tools concurrently, each in a thread of its own so the
+    caller can go on (e.g. to start the next stage) while they run.
+
+    stdout and stderr of a tool are streamed line by line into its log file
+    (or this process's stdout, prefixed with the task name), so a chatty
+    tool never blocks on a full pipe and its log is complete up to the
+    moment it fails.  A tool exceeding its timeout is killed.  When one
+    tool fails, wait() cancels its siblings: queued ones never start and
+    running ones are killed, along with any children they spawned.
+
+    With a governor, each tool first waits until its ram and cpus fit
+    (light tools, like kaiju2table and ktImportText, in the governor's
+    light lane).
+    '''
+
+    def __init__(self, cwd=None, governor=None, timeout=None):
+        self.cwd = cwd
+        self.governor = governor
+        self.timeout = timeout
+        self.tasks = []
+        self.cancelled = False
+        self.cond = threading.Condition()
+
+
+    @classmethod
+    def from_config(cls, config, cwd=None, governor=None):
+        '''
+        Default timeout from deploy.cfg tool-timeout-secs, blank for none
+        '''
+        timeout = config.get('tool-timeout-secs')
+        return cls(cwd=cwd, governor=governor, timeout=(int(timeout) if timeout else None))
+
+
+    def start(self, command, log_file=None, timeout=None, ram=None, cpus=1, name=None, light=False):
+        '''
+        Start command in the background.  Returns its ToolTask.  timeout
+        defaults to the runner's; 0 is none.
+        '''
+        if name is None:
+            name = os.path.basename(command[0])
+        if timeout is None:
+            timeout = self.timeout
+        task = ToolTask(name, command, log_file=log_file, timeout=timeout, ram=ram, cpus=cpus, light=light)
+        with self.cond:
+            self.tasks.append(task)
+            if self.cancelled:
+                task.state = 'cancelled'
+                task.finished.set()
+                return task
+        task_thread = threading.Thread(target=self._run_task, args=(task,))
+        task_thread.daemon = True
+        task_thread.start()
+        return task
+
+
+    def run(self, command, log_file=None, timeout=None, ram=None, cpus=1, name=None, light=False):
+        '''
+        Run command to completion.  Returns its exit code, or raises
+        ValueError if it failed or timed out.
+        '''
+        task = self.start(command, log_file=log_file, timeout=timeout, ram=ram, cpus=cpus, name=name, light=light)
+        self.wait([task])
+        return task.exit_code
+
+
+    def wait(self, tasks=None):
+        '''
+        Wait for tasks (default: all started so far).  If one fails, the rest
+        of this runner's tasks are cancelled and ValueError is raised once
+        they've stopped.
+        '''
+        if tasks is None:
+            with self.cond:
+                tasks = list(self.tasks)
+        with self.cond:
+            while True:
+                failed = [task for task in tasks if task.get_error() is not None]
+                if len(failed) > 0 or all([task.finished.is_set() for task in tasks]):
+                    break
+                self.cond.wait(1)
+
+        if len(failed) > 0:
+            self.cancel('after '+failed[0].name+' failed')
+            with self.cond:
+                started = [task for task in self.tasks if task.proc is not None]
+            for task in started:
+                task.finished.wait()
+            raise ValueError ("\n".join([task.get_error() for task in tasks if task.get_error() is not None]))
+        for task in tasks:
+            if task.state == 'cancelled':
+                raise ValueError ('Cancelled command: '+' '.join(task.command))
+        return tasks
+
+
+    def cancel(self, reason=''):
+        '''
+        Cancel every task not yet finished
+        '''
+        with self.cond:
+            self.cancelled = True
+            tasks = list(self.tasks)
+        for task in tasks:
+            if task.finished.is_set():
+                continue
+            if task.proc is not None:
+                log('cancelling '+task.name+(' '+reason if reason else ''))
+            self._kill(task, 'cancelled')
+
+
+    def _kill(self, task, state):
+        with self.cond:
+            if task.finished.is_set() or task.state not in ['queued', 'running']:
+                return
+            task.state = state
+            proc = task.proc
+        if proc is None:
+            return  # stopped before it starts
+        self._signal(proc, signal.SIGTERM)
+        kill_timer = threading.Timer(KILL_GRACE_SECS, self._signal, (proc, signal.SIGKILL))
+        kill_timer.daemon = True
+        kill_timer.start()
+
+
+    def _signal(self, proc, sig):
+        # tools run in their own process group, so this reaches their children too
+        # (returncode, not poll(), as only the task's thread may reap it)
+        if proc.returncode is not None:
+            return
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            pass
+
+
+    def _run_task(self, task):
+        try:
+            if task.ram is not None and self.governor is not None:
+                with self.governor.admit(task.name, task.ram, task.cpus, light=task.light):
+                    self._run_proc(task)
+            else:
+                self._run_proc(task)
+        except Exception as e:
+            log('failed to run '+' '.join(task.command)+': '+str(e))
+            with self.cond:
+                if task.state in ['queued', 'running']:
+                    task.state = 'failed'
+                    task.exception = str(e)
+        finally:
+            with self.cond:
+                task.finished.set()
+                self.cond.notify_all()
+
+
+    def _new_session_args(self):
+        if sys.version_info[0] >= 3:
+            return {'start_new_session': True}
+        return {'preexec_fn': os.setsid}
+
+
+    def _run_proc(self, task):
+        with self.cond:
+            if task.state != 'queued':
+                return
+            log('Running: ' + ' '.join(task.command))
+            task.proc = subprocess.Popen(task.command, cwd=self.cwd, shell=False,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=-1,
+                                         **self._new_session_args())
+            task.state = 'running'
+
+        timer = None
+        if task.timeout:
+            timer = threading.Timer(task.timeout, self._kill, (task, 'timed_out'))
+            timer.daemon = True
+            timer.start()
+
+        log_handle = None
+        if task.log_file:
+            log_handle = open(task.log_file, 'wb')
+        log_lock = stdout_lock if log_handle is None else threading.Lock()
+        streams = [threading.Thread(target=self._stream, args=(task, pipe, log_handle, log_lock))
+                   for pipe in [task.proc.stdout, task.proc.stderr]]
+        try:
+            for stream in streams:
+                stream.daemon = True
+                stream.start()
+            exitCode = task.proc.wait()
+            for stream in streams:
+                stream.join()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if log_handle is not None:
+                log_handle.close()
+
+        with self.cond:
+            task.exit_code = exitCode
+            if task.state == 'running':
+                task.state = 'done' if exitCode == 0 else 'failed'
+            state = task.state
+        if state == 'done':
+            log('Executed command: ' + ' '.join(task.command) + '\n' +
+                'Exit Code: ' + str(exitCode))
+        elif state == 'timed_out':
+            log('killed '+task.name+' after '+str(task.timeout)+'s')
+
+
+    def _stream(self, task, pipe, log_handle, log_lock):
+        '''
+        Copy pipe to the task's log, a line at a time
+        '''
+        prefix = (task.name+': ').encode('utf-8')
+        for line in iter(pipe.readline, b''):
+            with log_lock:
+                if log_handle is not None:
+                    log_handle.write(line)
+                    log_handle.flush()
+                else:
+                    out = getattr(sys.stdout, 'buffer', sys.stdout)
+                    out.write(prefix+line)
+                    out.flush()
+        pipe.close()
@@ -0,0 +1,314 @@
+/*
+ * kb_kaiju stacked abundance plots, drawn in the browser from KAIJU_PLOT_DATA
+ * (see OutputBuilder.generate_kaijuReport_PlotData).  Used by the report when
+ * deploy.cfg has report-plots = js.
+ *
+ * KAIJU_PLOT_DATA = {sort_by, key_top_k, tax_levels: [...],
+ *                    plots: {<tax_level>: {samples, classified_frac, lineages, colors,
+ *                                          values (percent, lineage by sample, row major)}}}
+ *
+ * The container element's data-plot-type is 'bar' or 'area'.
+ */
+(function () {
+    'use strict';
+
+    var SAMPLE_WIDTH = 40;
+    var MAX_PLOT_WIDTH = 1600;
+    var FRAC_HEIGHT = 110;
+    var STACK_HEIGHT = 420;
+    var MARGIN = {left: 60, right: 20, top: 30, gap: 20};
+    var BAR_FRAC = 0.5;
+    var ALPHA = 0.5;
+
+    var SPECIAL_COLORS = [['tail (<', 'lightslategray'],
+                          ['viruses', 'magenta'],
+                          ['unassigned at', 'darkslategray']];
+
+    function isSpecial(label) {
+        for (var i = 0; i < SPECIAL_COLORS.length; i++) {
+            if (label.indexOf(SPECIAL_COLORS[i][0]) === 0) {
+                return SPECIAL_COLORS[i][1];
+            }
+        }
+        return null;
+    }
+
+    // the PNG plots' color (LineageColors.py) when the data has it, else a
+    // stable color per lineage
+    function lineageColor(plot, lineageI) {
+        if (plot.colors) {
+            return plot.colors[lineageI];
+        }
+        return labelColor(plot.lineages[lineageI]);
+    }
+
+    function labelColor(label) {
+        var special = isSpecial(label);
+        if (special !== null) {
+            return special;
+        }
+        var hash = 5381;
+        for (var i = 0; i < label.length; i++) {
+            hash = ((hash * 33) ^ label.charCodeAt(i)) >>> 0;
+        }
+        return 'hsl(' + (hash % 360) + ',' + (55 + (hash >>> 9) % 35) + '%,' + (35 + (hash >>> 17) % 25) + '%)';
+    }
+
+    // stack order, bottom first: taxa in reverse of sort_by order (most
+    // important nearest the top), then the special buckets
+    function stackOrder(plot, sortBy) {
+        var nSamples = plot.samples.length;
+        var taxa = [];
+        var special = [];
+        var totals = [];
+        for (var i = 0; i < plot.lineages.length; i++) {
+            var total = 0;
+            for (var j = 0; j < nSamples; j++) {
+                total += plot.values[i * nSamples + j];
+            }
+            totals.push(total);
+            if (isSpecial(plot.lineages[i]) !== null) {
+                special.push(i);
+            } else {
+                taxa.push(i);
+            }
+        }
+        if (sortBy === 'alpha') {
+            taxa.sort(function (a, b) {
+                return plot.lineages[a] < plot.lineages[b] ? -1 : (plot.lineages[a] > plot.lineages[b] ? 1 : a - b);
+            });
+        } else if (sortBy === 'totals') {
+            taxa.sort(function (a, b) {
+                return (totals[b] - totals[a]) || (a - b);
+            });
+        }
+        taxa.reverse();
+        return {order: taxa.concat(special), totals: totals};
+    }
+
+    function drawPlot(container, plotType, data, taxLevel) {
+        var plot = data.plots[taxLevel];
+        var nSamples = plot.samples.length;
+        var stack = stackOrder(plot, data.sort_by);
+        var order = stack.order;
+
+        var sampleWidth = Math.max(8, Math.min(SAMPLE_WIDTH, MAX_PLOT_WIDTH / Math.max(nSamples, 1)));
+        var plotWidth = sampleWidth * nSamples;
+        var longestSample = 0;
+        for (var s = 0; s < nSamples; s++) {
+            longestSample = Math.max(longestSample, plot.samples[s].length);
+        }
+        var labelHeight = 10 + 6 * longestSample;
+        var fracTop = MARGIN.top;
+        var stackTop = fracTop + FRAC_HEIGHT + MARGIN.gap;
+        var stackBottom = stackTop + STACK_HEIGHT;
+
+        var canvas = document.createElement('canvas');
+        var ratio = window.devicePixelRatio || 1;
+        var width = MARGIN.left + plotWidth + MARGIN.right;
+        var height = stackBottom + labelHeight;
+        canvas.width = width * ratio;
+        canvas.height = height * ratio;
+        canvas.style.width = width + 'px';
+        canvas.style.height = height + 'px';
+        canvas.style.verticalAlign = 'top';
+        var ctx = canvas.getContext('2d');
+        ctx.scale(ratio, ratio);
+        ctx.font = '11px sans-serif';
+
+        function xOf(sampleI) {
+            return MARGIN.left + sampleI * sampleWidth;
+        }
+
+        // axes and grid
+        ctx.strokeStyle = '#bbb';
+        ctx.fillStyle = 'black';
+        ctx.textAlign = 'right';
+        ctx.textBaseline = 'middle';
+        for (var f = 0; f <= 5; f++) {
+            var fy = fracTop + FRAC_HEIGHT * (1 - f / 5);
+            ctx.beginPath();
+            ctx.moveTo(MARGIN.left, fy);
+            ctx.lineTo(MARGIN.left + plotWidth, fy);
+            ctx.stroke();
+            ctx.fillText((f / 5).toFixed(1), MARGIN.left - 4, fy);
+            var sy = stackBottom - STACK_HEIGHT * f / 5;
+            ctx.fillText(String(f * 20), MARGIN.left - 4, sy);
+        }
+        ctx.strokeStyle = 'black';
+        ctx.strokeRect(MARGIN.left, fracTop, plotWidth, FRAC_HEIGHT);
+        ctx.strokeRect(MARGIN.left, stackTop, plotWidth, STACK_HEIGHT);
+        ctx.textAlign = 'center';
+        ctx.fillText(taxLevel.charAt(0).toUpperCase() + taxLevel.slice(1), MARGIN.left + plotWidth / 2, fracTop - 12);
+
+        // fraction classified
+        ctx.globalAlpha = ALPHA;
+        for (s = 0; s < nSamples; s++) {
+            var fh = FRAC_HEIGHT * plot.classified_frac[s];
+            ctx.fillRect(xOf(s) + sampleWidth * (1 - BAR_FRAC) / 2, fracTop + FRAC_HEIGHT - fh, sampleWidth * BAR_FRAC, fh);
+        }
+
+        // stacked abundance
+        var yScale = STACK_HEIGHT / 100.0;
+        var bottoms = [];
+        for (s = 0; s < nSamples; s++) {
+            bottoms.push(0);
+        }
+        var cells = [];
+        for (var k = 0; k < order.length; k++) {
+            var lineageI = order[k];
+            ctx.fillStyle = lineageColor(plot, lineageI);
+            if (plotType === 'area') {
+                ctx.beginPath();
+                for (s = 0; s < nSamples; s++) {
+                    ctx.lineTo(xOf(s) + sampleWidth / 2, stackBottom - yScale * (bottoms[s] + plot.values[lineageI * nSamples + s]));
+                }
+                for (s = nSamples - 1; s >= 0; s--) {
+                    ctx.lineTo(xOf(s) + sampleWidth / 2, stackBottom - yScale * bottoms[s]);
+                }
+                ctx.closePath();
+                ctx.fill();
+            }
+            for (s = 0; s < nSamples; s++) {
+                var val = plot.values[lineageI * nSamples + s];
+                if (val <= 0) {
+                    continue;
+                }
+                var x0 = xOf(s) + sampleWidth * (1 - BAR_FRAC) / 2;
+                var y1 = stackBottom - yScale * (bottoms[s] + val);
+                if (plotType !== 'area') {
+                    ctx.fillRect(x0, y1, sampleWidth * BAR_FRAC, yScale * val);
+                }
+                cells.push([s, bottoms[s], bottoms[s] + val, lineageI]);
+                bottoms[s] += val;
+            }
+        }
+        ctx.globalAlpha = 1.0;
+
+        // sample labels
+        ctx.fillStyle = 'black';
+        ctx.textAlign = 'right';
+        for (s = 0; s < nSamples; s++) {
+            ctx.save();
+            ctx.translate(xOf(s) + sampleWidth / 2, stackBottom + 6);
+            ctx.rotate(-Math.PI / 2);
+            ctx.fillText(plot.samples[s], 0, 0);
+            ctx.restore();
+        }
+
+        // key: the special buckets and the key_top_k largest taxa, top of the stack first
+        var keyTaxa = [];
+        for (k = 0; k < order.length; k++) {
+            if (isSpecial(plot.lineages[order[k]]) === null) {
+                keyTaxa.push(order[k]);
+            }
+        }
+        keyTaxa.sort(function (a, b) {
+            return (stack.totals[b] - stack.totals[a]) || (a - b);
+        });
+        var inKey = {};
+        for (k = 0; k < Math.min(keyTaxa.length, data.key_top_k); k++) {
+            inKey[keyTaxa[k]] = true;
+        }
+        var key = document.createElement('div');
+        key.style.display = 'inline-block';
+        key.style.verticalAlign = 'top';
+        key.style.font = '12px sans-serif';
+        key.style.marginTop = stackTop + 'px';
+        var keyCount = 0;
+        for (k = order.length - 1; k >= 0; k--) {
+            var label = plot.lineages[order[k]];
+            if (isSpecial(label) === null && !inKey[order[k]]) {
+                continue;
+            }
+            var row = document.createElement('div');
+            var swatch = document.createElement('span');
+            swatch.style.display = 'inline-block';
+            swatch.style.width = '14px';
+            swatch.style.height = '10px';
+            swatch.style.marginRight = '6px';
+            swatch.style.background = lineageColor(plot, order[k]);
+            swatch.style.opacity = ALPHA;
+            row.appendChild(swatch);
+            row.appendChild(document.createTextNode(label));
+            key.appendChild(row);
+            keyCount++;
+        }
+        if (keyCount < order.length) {
+            var more = document.createElement('div');
+            more.appendChild(document.createTextNode('(+ ' + (order.length - keyCount) + ' less abundant taxa not in key)'));
+            key.appendChild(more);
+        }
+
+        // hover shows the lineage under the pointer
+        var tip = document.createElement('div');
+        tip.style.position = 'fixed';
+        tip.style.display = 'none';
+        tip.style.background = 'white';
+        tip.style.border = '1px solid #bbb';
+        tip.style.padding = '2px 6px';
+        tip.style.font = '12px sans-serif';
+        tip.style.pointerEvents = 'none';
+        canvas.addEventListener('mousemove', function (event) {
+            var rect = canvas.getBoundingClientRect();
+            var px = event.clientX - rect.left;
+            var py = event.clientY - rect.top;
+            var sampleI = Math.floor((px - MARGIN.left) / sampleWidth);
+            var pct = (stackBottom - py) / yScale;
+            tip.style.display = 'none';
+            if (sampleI < 0 || sampleI >= nSamples || pct < 0 || pct > 100) {
+                return;
+            }
+            for (var c = 0; c < cells.length; c++) {
+                if (cells[c][0] === sampleI && pct >= cells[c][1] && pct < cells[c][2]) {
+                    tip.textContent = plot.samples[sampleI] + ': ' + plot.lineages[cells[c][3]]
+                        + ' (' + (cells[c][2] - cells[c][1]).toFixed(2) + '%)';
+                    tip.style.left = (event.clientX + 12) + 'px';
+                    tip.style.top = (event.clientY + 12) + 'px';
+                    tip.style.display = 'block';
+                    return;
+                }
+            }
+        });
+        canvas.addEventListener('mouseleave', function () {
+            tip.style.display = 'none';
+        });
+
+        container.appendChild(canvas);
+        container.appendChild(key);
+        container.appendChild(tip);
+    }
+
+    function init() {
+        var container = document.getElementById('kaiju-stacked-plots');
+        var data = window.KAIJU_PLOT_DATA;
+        if (!container || !data) {
+            return;
+        }
+        var plotType = container.getAttribute('data-plot-type') || 'bar';
+        var select = document.createElement('select');
+        for (var i = 0; i < data.tax_levels.length; i++) {
+            var option = document.createElement('option');
+            option.value = data.tax_levels[i];
+            option.textContent = data.tax_levels[i];
+            select.appendChild(option);
+        }
+        var plotDiv = document.createElement('div');
+        select.addEventListener('change', function () {
+            plotDiv.innerHTML = '';
+            drawPlot(plotDiv, plotType, data, select.value);
+        });
+        container.appendChild(document.createTextNode('Tax level: '));
+        container.appendChild(select);
+        container.appendChild(plotDiv);
+        if (data.tax_levels.length > 0) {
+            drawPlot(plotDiv, plotType, data, data.tax_levels[0]);
+        }
+    }
+
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', init);
+    } else {
+        init();
+    }
+})();
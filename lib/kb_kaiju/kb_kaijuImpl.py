@@ -4,6 +4,8 @@ import os
 import json
 
 from kb_kaiju.Utils.KaijuUtil import KaijuUtil
+from kb_kaiju.Utils.KaijuDBRegistry import get_db_registry
+from kb_kaiju.Utils.KaijuIndexCache import get_index_cache
 #END_HEADER
 
 
@@ -60,6 +62,13 @@ You should have received a copy of the GNU General Public License along with the
         self.config = config
         self.config['SDK_CALLBACK_URL'] = os.environ['SDK_CALLBACK_URL']
         self.config['KB_AUTH_TOKEN'] = os.environ['KB_AUTH_TOKEN']
+        # discover installed kaiju dbs once, at startup
+        db_registry = get_db_registry()
+
+        # in warm standby mode, preload the configured dbs in the background
+        index_cache = get_index_cache(self.config)
+        if index_cache is not None and self.config.get('warm-standby-dbs'):
+            index_cache.preload(db_registry, self.config['warm-standby-dbs'].split(','))
         #END_CONSTRUCTOR
         pass
 
@@ -77,7 +86,8 @@ You should have received a copy of the GNU General Public License along with the
            should just be used for workspace ** "name" is a string identifier
            of a workspace or object.  This is received from Narrative.),
            parameter "input_refs" of type "data_obj_ref", parameter
-           "tax_levels" of list of String, parameter "db_type" of String,
+           "tax_levels" of list of String, parameter "output_biom_name" of
+           type "data_obj_name", parameter "db_type" of String,
            parameter "filter_percent" of Double, parameter
            "subsample_percent" of Long, parameter "subsample_replicates" of
            Long, parameter "subsample_seed" of Long, parameter "seg_filter"
@@ -86,7 +96,10 @@ You should have received a copy of the GNU General Public License along with the
            "greedy_run_mode" of type "bool" (A boolean - 0 for false, 1 for
            true. @range (0, 1)), parameter "greedy_allowed_mismatches" of
            Long, parameter "greedy_min_match_score" of Long, parameter
-           "greedy_max_e_value" of Double, parameter "sort_taxa_by" of String
+           "greedy_max_e_value" of Double, parameter "sort_taxa_by" of
+           String, parameter "combined_krona" of type "bool" (A boolean -
+           0 for false, 1 for true. @range (0, 1)), parameter "resume" of
+           type "bool" (A boolean - 0 for false, 1 for true. @range (0, 1))
         :returns: instance of type "KaijuOutput" (Kaiju App Output) ->
            structure: parameter "report_name" of type "data_obj_name",
            parameter "report_ref" of type "data_obj_ref"
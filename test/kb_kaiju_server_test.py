@@ -6,12 +6,21 @@ import time
 import requests
 import shutil
 import gzip
+import io
+import tarfile
+import threading
+import errno
+import numpy as np
 
 from os import environ
 try:
     from ConfigParser import ConfigParser  # py2
 except:
     from configparser import ConfigParser  # py3
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler  # py2
+except:
+    from http.server import HTTPServer, BaseHTTPRequestHandler  # py3
 
 from pprint import pprint  # noqa: F401
 
@@ -26,6 +35,18 @@ from kb_kaiju.authclient import KBaseAuth as _KBaseAuth
 from kb_kaiju.Utils.KaijuUtil import KaijuUtil
 from kb_kaiju.Utils.DataStagingUtils import DataStagingUtils
 from kb_kaiju.Utils.OutputBuilder import OutputBuilder
+from kb_kaiju.Utils.ReadsSubsampler import ReadsSubsampler
+from kb_kaiju.Utils.KaijuDBInstaller import install_kaiju_dbs
+from kb_kaiju.Utils.KaijuTaxonomy import KaijuTaxonomy
+from kb_kaiju.Utils.BiomTable import BiomTable
+from kb_kaiju.Utils.ResourceGovernor import ResourceGovernor
+from kb_kaiju.Utils.ToolRunner import ToolRunner
+from kb_kaiju.Utils.KaijuIndexCache import KaijuIndexCache
+from kb_kaiju.Utils import ArtifactManager as artifact_manager_module
+from kb_kaiju.Utils.ArtifactManager import ArtifactManager
+from kb_kaiju.Utils.ClassificationBackend import LocalProcessPoolBackend, SharedQueueBackend
+from kb_kaiju.Utils.StageCheckpoint import StageCheckpoint
+from kb_kaiju.Utils.LineageColors import LineageColors
 
 
 class kb_kaijuTest(unittest.TestCase):
@@ -195,11 +216,11 @@ class kb_kaijuTest(unittest.TestCase):
         # run kaiju
         #input_refs = [self.PE_reads_refs[0]]
         input_refs = [self.PE_reads_refs[0], self.PE_reads_refs[1]]
-        #output_biom_name = 'test_kb_kaiju_test1.BIOM'
+        output_biom_name = 'test_kb_kaiju_test1.BIOM'
         params = {
             'workspace_name':            self.ws_info[1],
             'input_refs':                input_refs,
-            #'output_biom_name':          output_biom_name,
+            'output_biom_name':          output_biom_name,
             'tax_levels':                ['phylum','genus'],
             #'tax_levels':                ['phylum'],
             'db_type':                   'refseq',
@@ -250,11 +271,11 @@ class kb_kaijuTest(unittest.TestCase):
         # run kaiju
         #input_refs = [self.SE_reads_refs[0]]
         input_refs = [self.SE_reads_refs[0], self.SE_reads_refs[1]]
-        #output_biom_name = 'test_kb_kaiju_test2.BIOM'
+        output_biom_name = 'test_kb_kaiju_test2.BIOM'
         params = {
             'workspace_name':            self.ws_info[1],
             'input_refs':                input_refs,
-            #'output_biom_name':          output_biom_name,
+            'output_biom_name':          output_biom_name,
             'tax_levels':                ['phylum','genus'],
             #'tax_levels':                ['phylum'],
             'db_type':                   'refseq',
@@ -273,7 +294,8 @@ class kb_kaijuTest(unittest.TestCase):
             'greedy_max_e_value':        0.05,
             'filter_unclassified':       1,
             'full_tax_path':             0,
-            'sort_taxa_by':              'totals'
+            'sort_taxa_by':              'totals',
+            'combined_krona':            1
         }
         result = self.getImpl().run_kaiju(self.getContext(), params)[0]
 
@@ -344,3 +366,619 @@ class kb_kaijuTest(unittest.TestCase):
         #self.assertEquals(len(rep['html_links']), 1)
         #self.assertEquals(rep['html_links'][0]['name'], 'report.html')
         pass
+
+
+    ### Test 4: single pass subsampling of PE lib into replicates
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_4_subsample_PE_single_pass")
+    def test_4_subsample_PE_single_pass(self):
+        method_name = 'test_4_subsample_PE_single_pass'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        subsample_dir = os.path.join(self.scratch, 'test_subsample_'+str(int(time.time() * 1000)))
+        os.makedirs(subsample_dir)
+        basename = 'seven_species_nonuniform_05K-PE_reads_'
+        input_item = {'ref': self.PE_reads_refs[1], 'name': 'subsample_test', 'type': 'PE'}
+        for direction in ['fwd', 'rev']:
+            input_item[direction+'_file'] = os.path.join(subsample_dir, basename+direction+'-0.fastq')
+            with gzip.open(os.path.join("data", basename+direction+'-0.fastq.gz'), 'rb') as f_in, open(input_item[direction+'_file'], 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+
+        subsampler = ReadsSubsampler(subsample_percent=10, subsample_replicates=2, subsample_seed=1)
+        replicate_input = subsampler.subsample(input_item)
+
+        self.assertEqual(len(replicate_input), 2)
+        seen_ids = set()
+        for replicate in replicate_input:
+            with open(replicate['fwd_file'], 'r') as fwd_handle, open(replicate['rev_file'], 'r') as rev_handle:
+                fwd_lines = fwd_handle.readlines()
+                rev_lines = rev_handle.readlines()
+            self.assertEqual(len(fwd_lines), 4 * 500)  # 10% of 5000 pairs
+            self.assertEqual(len(rev_lines), len(fwd_lines))
+            for line_i in range(0, len(fwd_lines), 4):
+                self.assertEqual(fwd_lines[line_i].split('/')[0], rev_lines[line_i].split('/')[0])
+                self.assertNotIn(fwd_lines[line_i], seen_ids)  # replicates don't overlap
+                seen_ids.add(fwd_lines[line_i])
+
+
+    ### Test 5: resumable db install from a local http server
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_5_db_install_resume")
+    def test_5_db_install_resume(self):
+        method_name = 'test_5_db_install_resume'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        # fake db tarballs
+        tarballs = dict()
+        for db_type in ['fake_a', 'fake_b']:
+            tgz_buf = io.BytesIO()
+            with tarfile.open(fileobj=tgz_buf, mode='w:gz') as tar:
+                for (member_name, member_bytes) in [('kaiju_db_'+db_type+'.fmi', os.urandom(200000)),
+                                                    ('nodes.dmp', b'1\t|\t1\t|\tno rank\t|\n'),
+                                                    ('names.dmp', b'1\t|\troot\t|\t\t|\tscientific name\t|\n')]:
+                    tar_info = tarfile.TarInfo(member_name)
+                    tar_info.size = len(member_bytes)
+                    tar.addfile(tar_info, io.BytesIO(member_bytes))
+            tarballs['/'+db_type+'.tgz'] = tgz_buf.getvalue()
+
+        # serves Range requests, and cuts off the first response for each tarball
+        requested = []
+        class RangeHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def do_GET(self):
+                body = tarballs[self.path]
+                range_header = self.headers.get('Range')
+                requested.append((self.path, range_header))
+                start = 0
+                if range_header:
+                    start = int(range_header.split('=')[1].rstrip('-'))
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes '+str(start)+'-'+str(len(body)-1)+'/'+str(len(body)))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(body)-start))
+                self.end_headers()
+                if range_header:
+                    self.wfile.write(body[start:])
+                else:
+                    self.wfile.write(body[:len(body)//2])
+        server = HTTPServer(('127.0.0.1', 0), RangeHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        data_dir = os.path.join(self.scratch, 'test_db_install_'+str(int(time.time() * 1000)))
+        ready_file = os.path.join(data_dir, '__READY__')
+        url_base = 'http://127.0.0.1:'+str(server.server_port)
+        dbs = [{'db_type': 'fake_a', 'url': url_base+'/fake_a.tgz'},
+               {'db_type': 'fake_b', 'url': url_base+'/fake_b.tgz'}]
+        try:
+            failed = install_kaiju_dbs(data_dir, dbs=dbs, workers=2, ready_file=ready_file, retry_wait=0, prepare=False)
+            first_requested = list(requested)
+            # rerunning init skips what's installed
+            os.remove(ready_file)
+            rerun_failed = install_kaiju_dbs(data_dir, dbs=dbs, workers=2, ready_file=ready_file, retry_wait=0, prepare=False)
+            rerun_requested = list(requested)
+            # but not a db whose files changed since
+            with open(os.path.join(data_dir, 'fake_b', 'kaiju_db_fake_b.fmi'), 'r+b') as fmi_handle:
+                fmi_handle.truncate(1000)
+            repair_failed = install_kaiju_dbs(data_dir, dbs=dbs, workers=2, ready_file=ready_file, retry_wait=0, prepare=False)
+        finally:
+            server.shutdown()
+
+        self.assertEqual(failed, [])
+        self.assertTrue(os.path.exists(ready_file))
+        for db_type in ['fake_a', 'fake_b']:
+            self.assertEqual(sorted(os.listdir(os.path.join(data_dir, db_type))),
+                             ['kaiju_db_'+db_type+'.fmi', 'names.dmp', 'nodes.dmp'])
+            self.assertTrue(os.path.isfile(os.path.join(data_dir, '.'+db_type+'.installed')))
+            path = '/'+db_type+'.tgz'
+            self.assertIn((path, 'bytes='+str(len(tarballs[path])//2)+'-'), first_requested)
+
+        self.assertEqual(rerun_failed, [])
+        self.assertEqual(rerun_requested, first_requested)
+
+        self.assertEqual(repair_failed, [])
+        self.assertEqual(set([request[0] for request in requested[len(rerun_requested):]]), set(['/fake_b.tgz']))
+        self.assertEqual(os.path.getsize(os.path.join(data_dir, 'fake_b', 'kaiju_db_fake_b.fmi')), 200000)
+
+
+    ### Test 6: stacked plot ordering at a big cohort's species level
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_6_order_elements_benchmark")
+    def test_6_order_elements_benchmark(self):
+        method_name = 'test_6_order_elements_benchmark'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        num_taxa = 10000
+        num_samples = 500
+        special_labels = ['tail (< 0.5% each taxon)', 'viruses', 'unassigned at species level']
+        element_labels = ['species_'+str(taxon_i) for taxon_i in range(num_taxa)] + special_labels
+        np_vals = np.random.RandomState(1).exponential(size=(len(element_labels), num_samples))
+        outputBuilder = OutputBuilder([], self.scratch, self.callback_url, self.wsURL)
+
+        for sort_by in ['totals', 'alpha', None]:
+            start_time = time.time()
+            element_order = outputBuilder._order_elements(element_labels, np_vals, sort_by)
+            elapsed = time.time() - start_time
+            print ("ordered "+str(num_taxa)+" taxa x "+str(num_samples)+" samples by "+str(sort_by)+" in "+'{0:.3f}'.format(elapsed)+"s")
+            self.assertLess(elapsed, 5.0)
+
+            ordered_labels = [element_labels[element_i] for element_i in element_order]
+            self.assertEqual(ordered_labels[-3:], special_labels)
+            self.assertEqual(sorted(ordered_labels), sorted(element_labels))
+            if sort_by == 'totals':
+                totals = np_vals[element_order[:-3]].sum(axis=1)
+                self.assertTrue(np.all(np.diff(totals) >= 0))  # most abundant on top
+            elif sort_by == 'alpha':
+                self.assertEqual(ordered_labels[:-3], sorted(element_labels[:-3]))
+            else:
+                self.assertEqual(ordered_labels[:-3], element_labels[:-3][::-1])
+
+
+    ### Test 7: replicate assignment dtypes follow the replicate count
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_7_assign_many_replicates")
+    def test_7_assign_many_replicates(self):
+        method_name = 'test_7_assign_many_replicates'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        total_reads = 100000
+        for (replicates, expected_dtype) in [(2, np.int8), (128, np.int8), (200, np.int16)]:
+            subsampler = ReadsSubsampler(subsample_percent=0.5, subsample_replicates=replicates, subsample_seed=1)
+            assignment = subsampler.assign_replicates(total_reads)
+            self.assertEqual(assignment.dtype, expected_dtype)
+            self.assertEqual(len(assignment), total_reads)
+            counts = np.bincount(assignment[assignment >= 0], minlength=replicates)
+            self.assertEqual(len(counts), replicates)
+            self.assertTrue(np.all(counts == 500))  # 0.5% of 100000 each, no replicate wrapped around
+
+        # the default seed is the run suffix, an md5-derived number well past 2**32
+        default_seed = int('a3f1c09e52d7', 16)
+        self.assertTrue(default_seed >= 2**32)
+        assignments = [ReadsSubsampler(subsample_percent=0.5, subsample_replicates=2, subsample_seed=default_seed).assign_replicates(total_reads)
+                       for run in range(2)]
+        self.assertTrue(np.array_equal(assignments[0], assignments[1]))
+        self.assertTrue(np.all(np.bincount(assignments[0][assignments[0] >= 0], minlength=2) == 500))
+
+
+    ### Test 8: in-process krona text matches kaiju2krona
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_8_krona_text_matches_kaiju2krona")
+    def test_8_krona_text_matches_kaiju2krona(self):
+        method_name = 'test_8_krona_text_matches_kaiju2krona'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        # sample.krona is what kaiju2krona (without -u) writes for sample.kaiju against
+        # this nodes.dmp/names.dmp: one line per taxon with reads, the scientific names
+        # from below root down to the taxon, unclassified reads left out
+        fixture_dir = os.path.join("data", "krona_fixture")
+        outputBuilder = OutputBuilder([], self.scratch, self.callback_url, self.wsURL)
+        outputBuilder.taxonomy_by_db['krona_fixture'] = KaijuTaxonomy.open(fixture_dir)
+
+        out_file = os.path.join(self.scratch, 'test_krona_text_'+str(int(time.time() * 1000))+'.krona')
+        outputBuilder.write_krona_text(os.path.join(fixture_dir, 'sample.kaiju'), 'krona_fixture', out_file)
+
+        # kaiju2krona writes taxa in no particular order
+        with open(out_file, 'r') as out_handle:
+            krona_lines = sorted(out_handle.readlines())
+        with open(os.path.join(fixture_dir, 'sample.krona'), 'r') as expected_handle:
+            expected_lines = sorted(expected_handle.readlines())
+        self.assertEqual(krona_lines, expected_lines)
+
+
+    ### Test 9: BIOM COO matrices and BIOM 2.1 HDF5 layout
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_9_biom_table")
+    def test_9_biom_table(self):
+        method_name = 'test_9_biom_table'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+        import h5py
+
+        biom_table = BiomTable()
+        biom_table.add_sample('s1', {'Escherichia': 5, 'Bacillus': 0, 'Vibrio': 2}, ['Escherichia', 'Bacillus', 'Vibrio'])
+        biom_table.add_sample('s2', {'Vibrio': 7, 'Pseudomonas': 1}, ['Vibrio', 'Pseudomonas'])
+
+        # rows in order of first appearance, zero counts dropped, ordered by row then column
+        self.assertEqual(biom_table.row_ids, ['Escherichia', 'Bacillus', 'Vibrio', 'Pseudomonas'])
+        self.assertEqual(biom_table.shape, [4, 2])
+        (rows, cols, vals) = biom_table.to_coo()
+        self.assertEqual(rows.tolist(), [0, 2, 2, 3])
+        self.assertEqual(cols.tolist(), [0, 0, 1, 1])
+        self.assertEqual(vals.tolist(), [5, 2, 7, 1])
+        self.assertEqual(biom_table.to_biom1_0_data(), [[0, 0, 5], [2, 0, 2], [2, 1, 7], [3, 1, 1]])
+
+        biom_file = os.path.join(self.scratch, 'test_biom_'+str(int(time.time() * 1000))+'.biom')
+        biom_table.write_biom2_hdf5(biom_file, 'test_table', generated_by='kb_kaiju', timestamp_iso='2020-01-01T00:00:00')
+        self.assertFalse(os.path.exists(biom_file+'.tmp'))
+        with h5py.File(biom_file, 'r') as h5_handle:
+            self.assertEqual(h5_handle.attrs['format-version'].tolist(), [2, 1])
+            self.assertEqual(h5_handle.attrs['shape'].tolist(), [4, 2])
+            self.assertEqual(int(h5_handle.attrs['nnz']), 4)
+            for axis in ['observation', 'sample']:
+                for grp_name in ['ids', 'metadata', 'group-metadata', 'matrix/data', 'matrix/indices', 'matrix/indptr']:
+                    self.assertIn(grp_name, h5_handle[axis])
+            ids = [axis_id.decode('utf-8') if isinstance(axis_id, bytes) else axis_id
+                   for axis_id in h5_handle['observation/ids'][()]]
+            self.assertEqual(ids, ['Escherichia', 'Bacillus', 'Vibrio', 'Pseudomonas'])
+
+            # by observation (CSR)
+            self.assertEqual(h5_handle['observation/matrix/indptr'][()].tolist(), [0, 1, 1, 3, 4])
+            self.assertEqual(h5_handle['observation/matrix/indices'][()].tolist(), [0, 0, 1, 1])
+            self.assertEqual(h5_handle['observation/matrix/data'][()].tolist(), [5.0, 2.0, 7.0, 1.0])
+
+            # by sample (CSC)
+            self.assertEqual(h5_handle['sample/matrix/indptr'][()].tolist(), [0, 2, 4])
+            self.assertEqual(h5_handle['sample/matrix/indices'][()].tolist(), [0, 2, 2, 3])
+            self.assertEqual(h5_handle['sample/matrix/data'][()].tolist(), [5.0, 2.0, 7.0, 1.0])
+
+
+    ### Test 10: a sample's reports run while kaiju classifies the next sample
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_10_light_tools_overlap_classification")
+    def test_10_light_tools_overlap_classification(self):
+        method_name = 'test_10_light_tools_overlap_classification'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        # kaiju takes every cpu not set aside for light tools, the next kaiju queues behind it
+        governor = ResourceGovernor(mem_budget=1024*1024*1024, cpu_budget=4, poll_interval=0.1, light_cpus=1)
+        tool_runner = ToolRunner(cwd=self.scratch, governor=governor)
+        kaiju_tasks = [tool_runner.start(['sleep', '3'], ram=0, cpus=4, name='kaiju sample_'+str(sample_i))
+                       for sample_i in range(2)]
+        wait_start = time.time()
+        while kaiju_tasks[0].state != 'running' and time.time() - wait_start < 10:
+            time.sleep(0.05)
+        self.assertEqual(kaiju_tasks[0].state, 'running')
+
+        # the first sample's kaiju2table and ktImportText get in ahead of the queued kaiju
+        light_tasks = [tool_runner.start(['true'], ram=0, name=tool_name+' sample_0', light=True)
+                       for tool_name in ['kaiju2table', 'ktImportText']]
+        tool_runner.wait(light_tasks)
+        self.assertEqual([task.state for task in light_tasks], ['done', 'done'])
+        self.assertEqual(kaiju_tasks[0].state, 'running')
+        self.assertEqual(kaiju_tasks[1].state, 'queued')
+
+        tool_runner.wait()
+        self.assertEqual([task.state for task in kaiju_tasks], ['done', 'done'])
+        self.assertEqual((governor.running, governor.cpus_in_use, governor.light_cpus_in_use), (0, 0, 0))
+
+
+    ### Test 11: warm standby index cache evicts idle dbs, least recently used first
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_11_index_cache_eviction")
+    def test_11_index_cache_eviction(self):
+        method_name = 'test_11_index_cache_eviction'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        # fake dbs of 3000 bytes each (fmi, nodes.dmp, names.dmp), no taxonomy index
+        class FakeKaijuDB(object):
+            def __init__(self, db_type, db_dir):
+                self.db_type = db_type
+                self.db_dir = db_dir
+                self.fmi_file = os.path.join(db_dir, 'kaiju_db_'+db_type+'.fmi')
+                self.nodes_file = os.path.join(db_dir, 'nodes.dmp')
+                self.names_file = os.path.join(db_dir, 'names.dmp')
+                self.taxonomy_index = None
+        cache_dir = os.path.join(self.scratch, 'test_index_cache_'+str(int(time.time() * 1000)))
+        kaiju_dbs = dict()
+        for (db_type, db_size) in [('db_a', 3000), ('db_b', 3000), ('db_c', 3000), ('db_big', 9000)]:
+            kaiju_db = FakeKaijuDB(db_type, os.path.join(cache_dir, db_type))
+            os.makedirs(kaiju_db.db_dir)
+            for db_file in [kaiju_db.fmi_file, kaiju_db.nodes_file, kaiju_db.names_file]:
+                with open(db_file, 'wb') as db_handle:
+                    db_handle.write(os.urandom(db_size // 3))
+            kaiju_dbs[db_type] = kaiju_db
+
+        index_cache = KaijuIndexCache(mem_cap=7000)
+        resident = lambda: [entry['db_type'] for entry in index_cache.get_status()]
+
+        # two fit
+        self.assertTrue(index_cache.acquire(kaiju_dbs['db_a']))
+        self.assertTrue(index_cache.acquire(kaiju_dbs['db_b']))
+        self.assertEqual(resident(), ['db_a', 'db_b'])
+        self.assertEqual(index_cache.resident_size, 6000)
+
+        # held dbs are never evicted, so a third doesn't fit
+        with index_cache.lock:
+            self.assertFalse(index_cache._evict_for(3000))
+        self.assertEqual(resident(), ['db_a', 'db_b'])
+
+        # once released, the least recently used idle db goes first
+        index_cache.release(kaiju_dbs['db_a'])
+        index_cache.release(kaiju_dbs['db_b'])
+        self.assertTrue(index_cache.acquire(kaiju_dbs['db_a']))  # db_a most recently used now
+        index_cache.release(kaiju_dbs['db_a'])
+        self.assertTrue(index_cache.acquire(kaiju_dbs['db_c']))
+        self.assertEqual(resident(), ['db_a', 'db_c'])
+        self.assertEqual(index_cache.resident_size, 6000)
+
+        # bigger than the whole cap: used cold, and nothing is evicted for it
+        self.assertFalse(index_cache.acquire(kaiju_dbs['db_big']))
+        self.assertEqual(resident(), ['db_a', 'db_c'])
+
+        # making room evicts the idle db and keeps the held one
+        with index_cache.lock:
+            self.assertTrue(index_cache._evict_for(4000))
+        self.assertEqual(resident(), ['db_c'])
+        index_cache.release(kaiju_dbs['db_c'])
+        self.assertEqual([entry['users'] for entry in index_cache.get_status()], [0])
+
+
+    ### Test 12: artifacts are linked where possible, copied where not
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_12_artifact_link_fallback")
+    def test_12_artifact_link_fallback(self):
+        method_name = 'test_12_artifact_link_fallback'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        artifact_dir = os.path.join(self.scratch, 'test_artifacts_'+str(int(time.time() * 1000)))
+        for tree in ['output', 'html']:
+            os.makedirs(os.path.join(artifact_dir, tree))
+        src_path = os.path.join(artifact_dir, 'output', 'plot.png')
+        with open(src_path, 'wb') as src_handle:
+            src_handle.write(os.urandom(5000))
+
+        # same filesystem: a hard link, counted once on disk
+        artifact_manager = ArtifactManager('auto')
+        dst_path = artifact_manager.expose(src_path, os.path.join(artifact_dir, 'html', 'plot.png'))
+        self.assertTrue(os.path.samefile(src_path, dst_path))
+        self.assertEqual(artifact_manager.get_placed(), {'hardlink': (1, 5000)})
+        self.assertEqual(artifact_manager.get_usage([artifact_dir]), (10000, 5000))
+
+        # across filesystems neither link can be made, so it's copied
+        def cross_device(src, dst):
+            raise OSError (errno.EXDEV, 'Invalid cross-device link')
+        (real_link, real_reflink) = (os.link, artifact_manager_module.reflink)
+        os.link = cross_device
+        artifact_manager_module.reflink = cross_device
+        try:
+            artifact_manager = ArtifactManager('auto')
+            dst_path = artifact_manager.expose(src_path, os.path.join(artifact_dir, 'html', 'plot_1.png'))
+            self.assertFalse(os.path.samefile(src_path, dst_path))
+            with open(src_path, 'rb') as src_handle, open(dst_path, 'rb') as dst_handle:
+                self.assertEqual(src_handle.read(), dst_handle.read())
+            self.assertEqual(artifact_manager.get_placed(), {'copy': (1, 5000)})
+            self.assertEqual(artifact_manager.get_usage([artifact_dir]), (15000, 10000))
+
+            # a refused link (e.g. EPERM on a protected_hardlinks mount) falls back the same way
+            def not_permitted(src, dst):
+                raise OSError (errno.EPERM, 'Operation not permitted')
+            os.link = not_permitted
+            artifact_manager = ArtifactManager('hardlink')
+            dst_path = artifact_manager.expose(src_path, os.path.join(artifact_dir, 'html', 'plot_2.png'))
+            self.assertTrue(os.path.isfile(dst_path))
+            self.assertEqual(artifact_manager.get_placed(), {'copy': (1, 5000)})
+
+            # anything else isn't papered over
+            def no_space(src, dst):
+                raise OSError (errno.ENOSPC, 'No space left on device')
+            os.link = no_space
+            artifact_manager = ArtifactManager('hardlink')
+            with self.assertRaises(OSError):
+                artifact_manager.expose(src_path, os.path.join(artifact_dir, 'html', 'plot_3.png'))
+            self.assertEqual(artifact_manager.get_placed(), {})
+        finally:
+            os.link = real_link
+            artifact_manager_module.reflink = real_reflink
+
+
+    ### Test 13: kaiju runs on the job's tool runner, so cancelling the job stops it
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_13_classification_cancel")
+    def test_13_classification_cancel(self):
+        method_name = 'test_13_classification_cancel'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        classify_dir = os.path.join(self.scratch, 'test_classify_cancel_'+str(int(time.time() * 1000)))
+        os.makedirs(classify_dir)
+        reads_file = os.path.join(classify_dir, 'reads.fastq')
+        with open(reads_file, 'w') as reads_handle:
+            reads_handle.write('@r1\nACGT\n+\nIIII\n')
+        tool_runner = ToolRunner(cwd=classify_dir)
+        classification_backend = LocalProcessPoolBackend(workers=2, cwd=classify_dir, tool_runner=tool_runner)
+
+        # a finished task streams its log and frees its reads
+        classified = []
+        classification_backend.submit({'name': 'quick',
+                                       'command': ['sh', '-c', 'echo classified'],
+                                       'log_file': os.path.join(classify_dir, 'quick.kaiju.stdout'),
+                                       'cleanup_files': [reads_file]},
+                                      callback=lambda task: classified.append(task['name']))
+        classification_backend.wait()
+        self.assertEqual(classified, ['quick'])
+        self.assertFalse(os.path.exists(reads_file))
+        with open(os.path.join(classify_dir, 'quick.kaiju.stdout'), 'r') as log_handle:
+            self.assertEqual(log_handle.read(), 'classified\n')
+
+        # one that runs past its timeout is killed
+        classification_backend.submit({'name': 'slow', 'command': ['sleep', '30'], 'timeout': 1})
+        start_time = time.time()
+        with self.assertRaises(ValueError):
+            classification_backend.wait()
+        self.assertLess(time.time() - start_time, 20)
+
+        # a cancelled job (e.g. another sample's report failed) stops the kaiju still running
+        tool_runner = ToolRunner(cwd=classify_dir)
+        classification_backend = LocalProcessPoolBackend(workers=2, cwd=classify_dir, tool_runner=tool_runner)
+        for name in ['lib_1', 'lib_2']:
+            classification_backend.submit({'name': name, 'command': ['sleep', '30']})
+        cancel_timer = threading.Timer(1, tool_runner.cancel, ('after a report failed',))
+        cancel_timer.start()
+        start_time = time.time()
+        with self.assertRaises(ValueError):
+            classification_backend.wait()
+        self.assertLess(time.time() - start_time, 20)
+        self.assertEqual([task.state for task in tool_runner.tasks], ['cancelled', 'cancelled'])
+
+
+    ### Test 14: shared queue backend claims, finishes and requeues tasks
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_14_classification_queue")
+    def test_14_classification_queue(self):
+        method_name = 'test_14_classification_queue'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        queue_dir = os.path.join(self.scratch, 'test_classification_queue_'+str(int(time.time() * 1000)))
+        list_queue = lambda state: sorted(os.listdir(os.path.join(queue_dir, state)))
+
+        # another job's task on the same queue, which this job's workers must leave alone
+        other_backend = SharedQueueBackend(queue_dir, local_workers=0, cwd=self.scratch)
+        other_backend.submit({'name': 'other_job', 'command': ['true']})
+        other_task_files = list_queue(SharedQueueBackend.PENDING)
+
+        classified = []
+        classification_backend = SharedQueueBackend(queue_dir, local_workers=1, cwd=self.scratch,
+                                                    poll_interval=0.2, stale_claim_secs=2)
+        classification_backend.submit({'name': 'lib_1', 'command': ['true']},
+                                      callback=lambda task: classified.append(task['name']))
+        classification_backend.submit({'name': 'lib_2', 'command': ['true']},
+                                      callback=lambda task: classified.append(task['name']))
+
+        # a worker that died after claiming lib_2 left its claim behind, last touched long ago
+        lib_2_file = [task_file for task_file in classification_backend.remaining.keys()
+                      if classification_backend.remaining[task_file][0]['name'] == 'lib_2'][0]
+        claimed_path = os.path.join(queue_dir, SharedQueueBackend.CLAIMED, lib_2_file)
+        os.rename(os.path.join(queue_dir, SharedQueueBackend.PENDING, lib_2_file), claimed_path)
+        os.utime(claimed_path, (time.time() - 60, time.time() - 60))
+
+        classification_backend.wait()
+        self.assertEqual(sorted(classified), ['lib_1', 'lib_2'])
+        self.assertEqual(len(list_queue(SharedQueueBackend.DONE)), 2)
+        self.assertIn(lib_2_file, list_queue(SharedQueueBackend.DONE))
+        self.assertEqual(list_queue(SharedQueueBackend.CLAIMED), [])
+        self.assertEqual(list_queue(SharedQueueBackend.PENDING), other_task_files)
+
+        # a failed task ends up in failed/, and wait() raises with its exit code
+        classification_backend.submit({'name': 'lib_3', 'command': ['false']},
+                                      callback=lambda task: classified.append(task['name']))
+        with self.assertRaises(ValueError) as raised:
+            classification_backend.wait()
+        self.assertIn('Exit Code: 1', str(raised.exception))
+        self.assertEqual(len(list_queue(SharedQueueBackend.FAILED)), 1)
+        self.assertEqual(sorted(classified), ['lib_1', 'lib_2'])
+        self.assertEqual(list_queue(SharedQueueBackend.PENDING), other_task_files)
+
+
+    ### Test 15: resumed stages are skipped only while their outputs are intact
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_15_stage_checkpoint_resume")
+    def test_15_stage_checkpoint_resume(self):
+        method_name = 'test_15_stage_checkpoint_resume'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        output_dir = os.path.join(self.scratch, 'test_checkpoint_'+str(int(time.time() * 1000)))
+        report_file = os.path.join(output_dir, 'kaiju_report', 'lib_1-genus.kaijuReport')
+        img_folder = os.path.join(output_dir, 'img')
+        for folder in [os.path.dirname(report_file), img_folder]:
+            os.makedirs(folder)
+
+        runs = []
+        def run_report(report_text):
+            runs.append(report_text)
+            with open(report_file, 'w') as report_handle:
+                report_handle.write(report_text)
+            with open(os.path.join(img_folder, 'bar-genus.png'), 'w') as img_handle:
+                img_handle.write('png')
+            return {'genus': report_file}
+        inputs = {'input_reads': ['lib_1'], 'tax_levels': ['genus']}
+        run_stage = lambda checkpoint, report_text='report 1', stage_inputs=inputs: \
+            checkpoint.run_stage('kaiju_report', stage_inputs, lambda: run_report(report_text), outputs=[report_file, img_folder])
+
+        # the first run always runs it, and so does any run that doesn't resume
+        self.assertEqual(run_stage(StageCheckpoint(output_dir)), {'genus': report_file})
+        run_stage(StageCheckpoint(output_dir, resume=False))
+        self.assertEqual(len(runs), 2)
+
+        # resumed with the outputs intact: skipped, with the recorded result
+        self.assertEqual(run_stage(StageCheckpoint(output_dir, resume=True)), {'genus': report_file})
+        self.assertEqual(len(runs), 2)
+
+        # an output rewritten (new size, or same size but newer): rerun
+        with open(report_file, 'w') as report_handle:
+            report_handle.write('partial')
+        run_stage(StageCheckpoint(output_dir, resume=True))
+        self.assertEqual(len(runs), 3)
+        os.utime(report_file, (time.time() + 10, time.time() + 10))
+        run_stage(StageCheckpoint(output_dir, resume=True))
+        self.assertEqual(len(runs), 4)
+
+        # an output removed, including a file under an output folder: rerun
+        os.remove(report_file)
+        run_stage(StageCheckpoint(output_dir, resume=True))
+        self.assertEqual(len(runs), 5)
+        os.remove(os.path.join(img_folder, 'bar-genus.png'))
+        run_stage(StageCheckpoint(output_dir, resume=True))
+        self.assertEqual(len(runs), 6)
+
+        # different inputs: rerun
+        run_stage(StageCheckpoint(output_dir, resume=True), stage_inputs=dict(inputs, tax_levels=['genus', 'species']))
+        self.assertEqual(len(runs), 7)
+        run_stage(StageCheckpoint(output_dir, resume=True), stage_inputs=dict(inputs, tax_levels=['genus', 'species']))
+        self.assertEqual(len(runs), 7)
+
+
+    ### Test 16: no two lineages of a figure share a color while the palette lasts
+    #
+    # Uncomment to skip this test
+    # HIDE @unittest.skip("skipped test_16_lineage_colors_distinct")
+    def test_16_lineage_colors_distinct(self):
+        method_name = 'test_16_lineage_colors_distinct'
+        print ("\n"+('='*(10+len(method_name))))
+        print ("RUNNING "+method_name+"()")
+        print (('='*(10+len(method_name)))+"\n")
+
+        lineage_colors = LineageColors()
+        palette_size = len(lineage_colors.palette_names)
+        lineages = ['Genus_'+str(lineage_i) for lineage_i in range(palette_size)]
+        special_buckets = ['tail (< 0.5% each taxon)', 'viruses', 'unassigned at genus level']
+
+        hex_colors = lineage_colors.get_hex_colors(lineages + special_buckets)
+        self.assertEqual(len(set(hex_colors[:palette_size])), palette_size)
+        self.assertEqual(hex_colors[palette_size:], ['#778899', '#ff00ff', '#2f4f4f'])
+
+        # the same figure gets the same colors whatever order its lineages come in
+        shuffled = list(reversed(lineages))
+        self.assertEqual(lineage_colors.get_hex_colors(shuffled), list(reversed(hex_colors[:palette_size])))
+        rgba = lineage_colors.get_colors(lineages)
+        self.assertEqual(len(set([tuple(row) for row in rgba])), palette_size)
+
+        # past the palette size colors repeat, but evenly
+        hex_colors = lineage_colors.get_hex_colors(lineages + ['Genus_extra'])
+        self.assertEqual(len(set(hex_colors)), palette_size)